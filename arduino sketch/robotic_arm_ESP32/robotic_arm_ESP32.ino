@@ -40,6 +40,300 @@ float dataServo5_smooth_prev;
 float dataServo6_smooth;
 float dataServo6_smooth_prev;
 
+// serial protocol (see `serial_protocol.py`)
+// ASCII frame: 18 numbers + '\n', e.g. "090060110090090090\n"
+// binary absolute frame: [SYNC, FRAME_ABSOLUTE, seq, servo1, ..., servo6, crc]
+// binary delta frame:    [SYNC, FRAME_DELTA, seq, d1|d2, d3|d4, d5|d6, crc], signed 4-bit changes
+// binary queue frame:    [SYNC, FRAME_QUEUE, seq, ticks_low, ticks_high, servo1, ..., servo6, crc]
+// binary control frame:  [SYNC, FRAME_CONTROL, seq, command, crc]
+// both formats are accepted at any time, the byte buffers are fixed so parsing does not allocate memory
+const byte SYNC = 0xA5;
+const byte FRAME_ABSOLUTE = 0x01;
+const byte FRAME_DELTA = 0x02;
+const byte FRAME_QUEUE = 0x03;
+const byte FRAME_CONTROL = 0x04;
+const byte ABSOLUTE_LENGTH = 10;
+const byte DELTA_LENGTH = 7;
+const byte QUEUE_LENGTH = 12;
+const byte CONTROL_LENGTH = 5;
+const byte BINARY_MAX_LENGTH = 12;
+const byte ASCII_MAX_LENGTH = 24;
+
+char ascii_buffer[ASCII_MAX_LENGTH];
+byte ascii_length = 0;
+byte binary_buffer[BINARY_MAX_LENGTH];
+byte binary_length = 0;
+byte binary_expected = 0;
+
+// last received servo positions and sequence number, delta frames are applied on top of them
+int target[6] = {90, 60, 110, 90, 90, 90};
+int last_seq = -1;
+
+// uploaded trajectory (see `upload.py`): the host fills a ring buffer with queue frames,
+// each frame is played for its number of loops (ticks of 5 ms), independently of the serial communication
+const byte QUEUE_START = 1;   // start playing the buffer
+const byte QUEUE_END = 2;     // no more frames, finish when the buffer is empty
+const byte QUEUE_CLEAR = 3;   // stop playing and empty the buffer
+const byte QUEUE_STATUS = 4;  // answer with the status line
+const byte QUEUE_PAUSE = 5;
+const byte QUEUE_RESUME = 6;
+
+const byte STATE_IDLE = 0;
+const byte STATE_PLAYING = 1;
+const byte STATE_PAUSED = 2;
+const byte STATE_FINISHED = 3;
+
+const int QUEUE_SIZE = 512;
+byte queue_angles[QUEUE_SIZE][6];
+unsigned int queue_ticks[QUEUE_SIZE];
+int queue_head = 0;   // next free slot
+int queue_tail = 0;   // next frame to play
+int queue_count = 0;
+
+byte queue_state = STATE_IDLE;
+bool queue_ended = false;
+bool queue_starved = false;
+unsigned int ticks_left = 0;
+// counters since the last QUEUE_CLEAR, sent in the status line
+unsigned long queue_received = 0;
+unsigned long queue_played = 0;
+unsigned long queue_underruns = 0;
+
+// CRC-8, polynomial 0x07
+byte crc8(const byte *data, byte length) {
+  byte crc = 0;
+  for (byte i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (byte bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (byte)((crc << 1) ^ 0x07) : (byte)(crc << 1);
+    }
+  }
+  return crc;
+}
+
+// copy the received positions to the servo targets
+void apply_target() {
+  dataServo1 = target[0];
+  dataServo2 = target[1];
+  dataServo3 = target[2];
+  dataServo4 = target[3];
+  dataServo5 = target[4];
+  dataServo6 = target[5];
+}
+
+// the rotation degree is denoted by 3 numbers
+// e.g. '090' for 90 degrees
+// 6 servos in total, so a total of 18 numbers
+// an extra 'B' at the end asks whether the binary format is supported
+void handle_ascii_line() {
+  byte length = ascii_length;
+  if (length > 0 && ascii_buffer[length - 1] == '\r') {
+    length--;
+  }
+  bool handshake = false;
+  if (length > 0 && ascii_buffer[length - 1] == 'B') {
+    handshake = true;
+    length--;
+  }
+  if (length != 18) {
+    return;
+  }
+  for (byte i = 0; i < 18; i++) {
+    if (ascii_buffer[i] < '0' || ascii_buffer[i] > '9') {
+      return;
+    }
+  }
+  for (byte servo = 0; servo < 6; servo++) {
+    const char *digits = ascii_buffer + 3 * servo;
+    target[servo] = (digits[0] - '0') * 100 + (digits[1] - '0') * 10 + (digits[2] - '0');
+  }
+  // the binary sequence has to restart with an absolute frame
+  last_seq = -1;
+  apply_target();
+
+  if (handshake) {
+    Serial.print("BIN1\n");
+  }
+}
+
+// status line: "Q state free received played underruns\n"
+void send_status() {
+  Serial.print("Q ");
+  Serial.print(queue_state);
+  Serial.print(" ");
+  Serial.print(QUEUE_SIZE - queue_count);
+  Serial.print(" ");
+  Serial.print(queue_received);
+  Serial.print(" ");
+  Serial.print(queue_played);
+  Serial.print(" ");
+  Serial.print(queue_underruns);
+  Serial.print("\n");
+}
+
+// a queue frame is only accepted in order (its seq is the number of frames received),
+// so the host can resend from the first lost frame
+void handle_queue_frame() {
+  byte seq = binary_buffer[2];
+  if (seq != (byte)queue_received || queue_count == QUEUE_SIZE) {
+    return;
+  }
+  queue_ticks[queue_head] = binary_buffer[3] | (binary_buffer[4] << 8);
+  for (byte servo = 0; servo < 6; servo++) {
+    queue_angles[queue_head][servo] = binary_buffer[5 + servo];
+  }
+  queue_head = (queue_head + 1) % QUEUE_SIZE;
+  queue_count++;
+  queue_received++;
+}
+
+void handle_control_frame() {
+  byte command = binary_buffer[3];
+  if (command == QUEUE_START) {
+    queue_state = STATE_PLAYING;
+  }
+  else if (command == QUEUE_END) {
+    queue_ended = true;
+  }
+  else if (command == QUEUE_CLEAR) {
+    queue_state = STATE_IDLE;
+    queue_head = 0;
+    queue_tail = 0;
+    queue_count = 0;
+    queue_ended = false;
+    queue_starved = false;
+    ticks_left = 0;
+    queue_received = 0;
+    queue_played = 0;
+    queue_underruns = 0;
+  }
+  else if (command == QUEUE_PAUSE && queue_state == STATE_PLAYING) {
+    queue_state = STATE_PAUSED;
+  }
+  else if (command == QUEUE_RESUME && queue_state == STATE_PAUSED) {
+    queue_state = STATE_PLAYING;
+  }
+  else if (command != QUEUE_STATUS) {
+    return;
+  }
+  send_status();
+}
+
+// play the uploaded frames, called once per loop
+void play_queue() {
+  if (queue_state != STATE_PLAYING) {
+    return;
+  }
+  if (ticks_left == 0) {
+    if (queue_count == 0) {
+      if (queue_ended) {
+        queue_state = STATE_FINISHED;
+        send_status();
+      }
+      else if (!queue_starved) {
+        // the host did not upload in time, hold the last frame until more frames arrive
+        queue_starved = true;
+        queue_underruns++;
+      }
+      return;
+    }
+    for (byte servo = 0; servo < 6; servo++) {
+      target[servo] = queue_angles[queue_tail][servo];
+    }
+    ticks_left = max(queue_ticks[queue_tail], 1u);
+    queue_tail = (queue_tail + 1) % QUEUE_SIZE;
+    queue_count--;
+    queue_played++;
+    queue_starved = false;
+    // live delta frames have to restart with an absolute frame
+    last_seq = -1;
+    apply_target();
+  }
+  ticks_left--;
+}
+
+void handle_binary_frame() {
+  if (crc8(binary_buffer + 1, binary_length - 2) != binary_buffer[binary_length - 1]) {
+    last_seq = -1;
+    return;
+  }
+  if (binary_buffer[1] == FRAME_QUEUE) {
+    handle_queue_frame();
+    return;
+  }
+  if (binary_buffer[1] == FRAME_CONTROL) {
+    handle_control_frame();
+    return;
+  }
+  byte seq = binary_buffer[2];
+
+  if (binary_buffer[1] == FRAME_ABSOLUTE) {
+    for (byte servo = 0; servo < 6; servo++) {
+      target[servo] = binary_buffer[3 + servo];
+    }
+  }
+  else {
+    // a delta frame is only valid right after the previous frame
+    if (last_seq < 0 || seq != (byte)(last_seq + 1)) {
+      last_seq = -1;
+      return;
+    }
+    for (byte servo = 0; servo < 6; servo++) {
+      byte packed = binary_buffer[3 + servo / 2];
+      int nibble = (servo % 2 == 0) ? (packed >> 4) : (packed & 0x0F);
+      target[servo] += (nibble > 7) ? nibble - 16 : nibble;
+    }
+  }
+  last_seq = seq;
+  apply_target();
+}
+
+// read the available bytes one at a time, without waiting for the rest of the frame
+void read_serial() {
+  while (Serial.available()) {
+    byte incoming = Serial.read();
+
+    // in the middle of a binary frame
+    if (binary_length > 0) {
+      binary_buffer[binary_length++] = incoming;
+      if (binary_length == 2) {
+        if (incoming == FRAME_ABSOLUTE) {
+          binary_expected = ABSOLUTE_LENGTH;
+        }
+        else if (incoming == FRAME_DELTA) {
+          binary_expected = DELTA_LENGTH;
+        }
+        else if (incoming == FRAME_QUEUE) {
+          binary_expected = QUEUE_LENGTH;
+        }
+        else if (incoming == FRAME_CONTROL) {
+          binary_expected = CONTROL_LENGTH;
+        }
+        else {
+          binary_length = 0;
+        }
+      }
+      else if (binary_length == binary_expected) {
+        handle_binary_frame();
+        binary_length = 0;
+      }
+    }
+    // start of a binary frame
+    else if (incoming == SYNC) {
+      ascii_length = 0;
+      binary_buffer[binary_length++] = incoming;
+    }
+    // ASCII line
+    else if (incoming == '\n') {
+      handle_ascii_line();
+      ascii_length = 0;
+    }
+    else if (ascii_length < ASCII_MAX_LENGTH) {
+      ascii_buffer[ascii_length++] = incoming;
+    }
+  }
+}
+
 void setup() {
   // serial baud
   Serial.begin(115200);
@@ -63,19 +357,11 @@ void setup() {
 
 void loop() {
 
-  while(Serial.available()){
-    // get new servo positions from serial communication
-    // the rotation degree is denoted by 3 numbers
-    // e.g. '090' for 90 degrees
-    // 6 servos in total, so a total of 18 numbers
-    String input = Serial.readStringUntil('\n');
-    dataServo1 = input.substring(0,3).toInt();
-    dataServo2 = input.substring(3,6).toInt();
-    dataServo3 = input.substring(6,9).toInt();
-    dataServo4 = input.substring(9,12).toInt();
-    dataServo5 = input.substring(12,15).toInt();
-    dataServo6 = input.substring(15,18).toInt();
-  }
+  // get new servo positions from serial communication (ASCII or binary frames)
+  read_serial();
+
+  // play the next uploaded frame when the current one has been played for its number of loops
+  play_queue();
 
   // instead of directly writing the new servo positions, write with gradually increasing/decreasing values for smooth motion
   dataServo1_smooth = (dataServo1 * (1-refresh_rate)) + (dataServo1_smooth_prev * refresh_rate);
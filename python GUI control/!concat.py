@@ -9,6 +9,8 @@ This function concatenates a list of txt files, and outputs the concatenated act
 '''
 
 #%% 
+import pipeline
+
 files = ['1_first_turn_step10.txt',
 '2_lift_jug_step2.txt',
 '3_tilt_cup.txt',
@@ -25,18 +27,10 @@ files = ['1_first_turn_step10.txt',
 '13_tulip_3.txt',
 '14_replace_jug_easeinout10.txt']
 
-all_positions = []
 concat_filename = 'concat.txt'
 
-# loop through the files and concat them to all_positions
-for filename in files:
-    file = open(filename, "r")
-    data=file.read()
-    saved_positions=eval(data)
-    file.close()
-
-    all_positions += saved_positions
+# load the files and concat them to all_positions (see the `concat` stage in `pipeline.py`)
+all_positions = pipeline.collect(pipeline.concat(*(pipeline.frames_of(filename) for filename in files)))
 
 # save the file
-with open(concat_filename, 'w') as f:
-    f.write(str(all_positions))
+all_positions.save(concat_filename)
@@ -13,6 +13,8 @@ This is achieved by rotating the wrist (servo 4) back and forth quickly.
             filename_execute.txt: txt file containing the actions to rock the jug
 '''
 #%%
+import pipeline
+
 # txt file name to be read
 filename = '9_rock_jug.txt'
 # txt file name to be saved
@@ -25,47 +27,14 @@ shake_start = 145
 shake_end = 180
 # rock speed, controlled by number of steps from shake_start to shake_end
 shake_steps = 1
-# shake step size
-shake_step_size = int((shake_end - shake_start)/shake_steps)
 
 # total number of times to shake
 shake_num = 5
 
 #%%
-# open file
-file = open(filename, "r")
-data=file.read()
-saved_positions=eval(data)
-
-last_positions = saved_positions[-1]
-file.close()
-
-#%%
-slight_shake = []
-
-# first loop through total number of times to shake it
-for i in range(shake_num):
-    position = last_positions[:]
-    # initialize servo 4 angle before shaking to `shake_end`
-    position[3] = shake_end
-    
-    new_position = position[:]
-    slight_shake.append(new_position)
-
-    # decrease servo 4 angle by the `shake_step_size` until reaching the `shake_start` angle
-    for step in range(shake_steps):
-        position[3] -= shake_step_size
-
-        new_position = position[:]
-        slight_shake.append(new_position)
-
-    # increase servo 4 angle by the `shake_step_size` until reaching the `shake_end` angle
-    for step in range(shake_steps):
-        position[3] += shake_step_size
+# rock the wrist at the last position of the file (see the `rock` stage in `pipeline.py`)
+slight_shake = pipeline.collect(pipeline.rock(pipeline.frames_of(filename), shake_start, shake_end, shake_steps, shake_num))
 
-        new_position = position[:]
-        slight_shake.append(new_position)
 #%%
 # save to txt file
-with open(save_name, 'w') as f:
-    f.write(str(slight_shake))
\ No newline at end of file
+slight_shake.save(save_name)
@@ -1,32 +1,41 @@
 #%%
 '''
 This function shortens the list of actions by saving only every n actions.
+Alternatively, it keeps only the actions needed to stay within a tolerance of the recording (see `simplify.py`),
+static sections then shrink to a few actions, fast moves keep their detail, and the timing of the recording is kept.
     Parameters:
             filename (str): the txt file containing the list of actions
             read_step (int): reading step size, e.g. 5, only save one action every 5 actions
+            tolerance (float): tolerance (degrees) of the simplification, None to keep every `read_step` actions
+            save_time (float): save interval (s) of the recording, to keep its timing
 
     Returns:
             filename_step{read_step}.txt: a txt file with the shortened actions
+            filename_tol{tolerance}.traj: the simplified actions with their timestamps, if `tolerance` is set
 '''
 #%%
+import pipeline
+
 # txt file name to be shortened
 filename = '1_first_turn.txt'
 # reading step size, e.g. 5, only save every 5 positions
 read_step = 10
+# tolerance (degrees) of the simplification, e.g. 1, None to keep every `read_step` positions
+tolerance = None
+# save interval (s) of the recording, see `robotic_arm_main.py`
+save_time = 0.1
 
 #%%
-# open file
-file = open(filename, "r")
-data=file.read()
-saved_positions=eval(data)
-file.close()
-
-# loop through the positions to shorten the list
-short_saved_positions = []
-for i in range(0, len(saved_positions), read_step):
-    short_saved_positions.append(saved_positions[i])
+if tolerance is None:
+    # keep every `read_step` positions to shorten the list (see the `decimate` stage in `pipeline.py`)
+    short_saved_positions = pipeline.collect(pipeline.decimate(pipeline.frames_of(filename), read_step))
+    short_filename = filename.split('.txt')[0] + f'_step{read_step}.txt'
+else:
+    # keep the positions needed to stay within `tolerance` degrees, with their timestamps (.traj)
+    import simplify
+    from trajectory import Trajectory
+    short_saved_positions = simplify.simplify(Trajectory.load(filename, period=save_time), tolerance)
+    short_filename = filename.split('.txt')[0] + f'_tol{tolerance}.traj'
 
 # save the file
-short_filename = filename.split('.txt')[0] + f'_step{read_step}.txt'
-with open(short_filename, 'w') as f:
-    f.write(str(short_saved_positions))
+short_saved_positions.save(short_filename)
@@ -0,0 +1,528 @@
+#%%
+'''
+This module is the headless core of the robot arm controller: the serial connection, the servo positions,
+the kinematics, recording and replaying. `robotic_arm_main.py` is a tkinter client of `ArmController`,
+scripts, services and tests can drive the arm without a display.
+Numpy, pyserial and the replay modules are only imported when they are needed, so the command line starts fast.
+    Parameters:
+            positions (list): initial 6 servo angles
+            save_time (float): the recordings are resampled every `save_time` seconds
+            save_timestamps (bool): keep the time of every change in the recordings instead of resampling them
+            replay_period (float): time (s) between two replayed frames
+            replay_speed (float): replay speed, e.g. 2 replays twice as fast
+            binary_protocol (bool): try to use the compact binary serial format (see `serial_protocol.py`)
+            upload_replay (bool): upload the replays to the buffer of the ESP32 (see `upload.py`)
+            collapse_holds (bool): send repeated positions once and hold them (see `Trajectory.collapse_holds`)
+            clamp_unreachable (bool): move unreachable coordinates to the nearest reachable pose (see `workspace.py`)
+            workspace_file (str): .npz file of the reachability grid, loaded in the background at start-up,
+                                  defaults to `workspace_grid.npz` (built with `python workspace.py build`)
+            preflight (bool): check the opened and replayed trajectories (see `preflight.py`), errors stop the replay
+            on_frame (function): called with (index, position) for the replayed frames, optional
+            open_serial (function): opens a port, called with (port, baudrate), defaults to serial.Serial
+            metrics (Instrumentation): latency histograms and counters, defaults to `instrumentation.metrics`
+
+    Usage:
+            controller = ArmController()
+            controller.connect('COM3')
+            controller.open_file('heart/heart.txt')
+            controller.play()
+            controller.wait()
+
+Command line:
+    python arm_controller.py fk 90 60 110
+    python arm_controller.py ik 0 -20 10
+    python arm_controller.py move 90 60 110 180 90 90 --port COM3
+    python arm_controller.py goto 0 -20 10 --port COM3
+    python arm_controller.py play heart/heart.txt --port COM3
+    python arm_controller.py --simulate --speed 10 play heart/heart.txt    # simulated ESP32, no arm needed
+    python arm_controller.py --simulate --live --stats stats.json play heart/heart.txt
+'''
+#%%
+import serial_protocol
+from instrumentation import metrics as default_metrics
+
+default_positions = (90, 60, 110, 90, 90, 90)
+
+#######################################
+# controller
+#######################################
+class ArmController:
+    def __init__(self, positions=default_positions, save_time=0.1, save_timestamps=False, replay_period=0.15,
+                 replay_speed=1.0, binary_protocol=True, upload_replay=True, collapse_holds=True,
+                 clamp_unreachable=True, workspace_file=None, preflight=True, on_frame=None, open_serial=None,
+                 baudrate=115200, metrics=None):
+        from trajectory import Trajectory
+        from recorder import Recorder
+
+        self.default_positions = list(positions)
+        self.positions = list(positions)
+        self.save_time = save_time
+        self.save_timestamps = save_timestamps
+        self.replay_period = replay_period
+        self.replay_speed = replay_speed
+        self.binary_protocol = binary_protocol
+        self.upload_replay = upload_replay
+        self.collapse_holds = collapse_holds
+        self.clamp_unreachable = clamp_unreachable
+        self.workspace_file = workspace_file
+        self.preflight = preflight
+        self.on_frame = on_frame
+        self.open_serial = open_serial
+        self.baudrate = baudrate
+        self.metrics = default_metrics if metrics is None else metrics
+
+        self.arduino = None
+        self.encoder = serial_protocol.AsciiEncoder()
+        self.saved_positions = Trajectory(period=save_time)
+        self.recorder = Recorder()
+        self._replay = None
+        self._uploader = None
+        self._workspace = None
+        self._workspace_loader = None
+        self.player = None
+        # report of the last checked trajectory
+        self.preflight_report = None
+        if clamp_unreachable:
+            self.load_workspace(background=True)
+
+    #######################################
+    # connection
+    #######################################
+    @property
+    def connected(self):
+        return self.arduino is not None
+
+    def connect(self, port):
+        '''
+        Opens the serial port, negotiates the serial format and chooses the replay mode.
+            Parameters:
+                    port (str or port): name of the port, e.g. 'COM3', or an opened port (e.g. `FakeSerial`)
+        '''
+        if isinstance(port, str):
+            if self.open_serial is None:
+                import serial
+                self.arduino = serial.Serial(port, self.baudrate)
+            else:
+                self.arduino = self.open_serial(port, self.baudrate)
+        else:
+            self.arduino = port
+
+        # ask the firmware whether it understands the binary format
+        self.encoder = serial_protocol.AsciiEncoder()
+        if self.binary_protocol:
+            self.encoder = serial_protocol.negotiate(self.arduino, self.positions,
+                                                     log=lambda message: self.metrics.log(message, 'warning'))
+
+        # the firmware plays uploaded replays on its own timer, the old firmware only understands live frames
+        if self.upload_replay and isinstance(self.encoder, serial_protocol.FrameEncoder):
+            self.player = self.uploader
+        else:
+            self.player = self.replay
+        return self.encoder
+
+    def close(self):
+        if self.player is not None and self.player.running:
+            self.player.abort()
+            self.player.wait(5.0)
+        if self.arduino is not None:
+            self.arduino.close()
+            self.arduino = None
+
+    @property
+    def replay(self):
+        # replays `saved_positions` live on its own thread, see `replay.py`
+        if self._replay is None:
+            from replay import ReplayEngine
+            self._replay = ReplayEngine(self.send_positions, self.replay_period, self.replay_speed,
+                                        on_frame=self.played, metrics=self.metrics)
+        return self._replay
+
+    @property
+    def uploader(self):
+        # uploads `saved_positions` to the buffer of the ESP32, see `upload.py`
+        if self._uploader is None:
+            from upload import Uploader
+            # the firmware restarts the binary sequence after an upload, the next live frame has to be absolute
+            self._uploader = Uploader(self.write, lambda: self.arduino.read(self.arduino.in_waiting),
+                                      self.replay_period, self.replay_speed, on_frame=self.played,
+                                      on_finish=self.encoder_reset, metrics=self.metrics)
+        return self._uploader
+
+    def encoder_reset(self):
+        self.encoder.reset()
+
+    def write(self, data):
+        self.arduino.write(data)
+        self.metrics.count('serial_bytes', len(data))
+
+    def send_positions(self, position):
+        # ASCII: 18 numbers, binary: 10 byte absolute or 7 byte delta frames (see `serial_protocol.py`)
+        with self.metrics.timer('send_positions'):
+            self.write(self.encoder.encode(position))
+        self.metrics.count('serial_frames')
+
+    def send(self):
+        # sends the current positions
+        self.send_positions(self.positions)
+
+    #######################################
+    # positions and kinematics
+    #######################################
+    def set_positions(self, positions):
+        # new servo positions, e.g. the slider values, recorded if a recording is running
+        positions = [int(round(angle)) for angle in positions]
+        if len(positions) != len(self.positions):
+            raise ValueError(f'expected {len(self.positions)} servo angles, got {len(positions)}')
+        self.positions = positions
+        if self.recorder.recording:
+            with self.metrics.timer('record_positions'):
+                self.recorder.record(positions)
+
+    def set_servo(self, index, angle):
+        # index 0 is servo 1
+        positions = list(self.positions)
+        positions[index] = angle
+        self.set_positions(positions)
+
+    def reset(self):
+        self.set_positions(self.default_positions)
+
+    def forward_kinematics(self, servo_3angles=None):
+        # x, y, z coordinates (cm, rounded to 0.1) of servos 1-3, the current positions by default
+        import kinematics
+        import numpy as np
+
+        servo_3angles = self.positions[:3] if servo_3angles is None else servo_3angles
+        with self.metrics.timer('forward_kinematics'):
+            return np.round(kinematics.forward_kinematics(servo_3angles), decimals=1)
+
+    @property
+    def coordinates(self):
+        return self.forward_kinematics()
+
+    @property
+    def spout(self):
+        # spout coordinates (cm) and tilt (degrees) of the current positions, see `tool_kinematics.py`
+        import tool_kinematics
+        return tool_kinematics.spout_pose(self.positions)
+
+    @property
+    def workspace(self):
+        # reachability grid of servos 1-3 (see `workspace.py`), None until it is loaded or if it is missing
+        return self._workspace
+
+    def load_workspace(self, background=False):
+        '''
+        Loads the reachability grid of `workspace_file`. The grid is never built here, building takes seconds
+        and would freeze the sliders; without the grid, unreachable coordinates are rejected.
+            Parameters:
+                    background (bool): load on a thread, `workspace` is None until it is done
+        '''
+        if background:
+            import threading
+            self._workspace_loader = threading.Thread(target=self.load_workspace, daemon=True)
+            self._workspace_loader.start()
+            return
+        import workspace
+
+        filename = self.workspace_file or workspace.default_filename
+        try:
+            self._workspace = workspace.ReachabilityGrid.load(filename)
+        except (OSError, ValueError, KeyError) as error:
+            self.metrics.log(f'Warning: no workspace grid ({error}), unreachable coordinates are rejected; '
+                             f'build it with `python workspace.py build`', 'warning')
+
+    def wait_workspace(self, timeout=None):
+        # waits for the background loading of the reachability grid, returns the grid or None
+        if self._workspace_loader is not None:
+            self._workspace_loader.join(timeout)
+        return self._workspace
+
+    def inverse_kinematics(self, coordinates):
+        '''
+        Servo 1-3 angles reaching the coordinates, the closest solution to the current positions.
+            Returns:
+                    servo_3angles (array): rounded servo angles; if out of reach, the pose of the nearest reachable
+                                           point with `clamp_unreachable` (the current angles while the grid is
+                                           not loaded), the best guess otherwise
+                    reachable (bool): whether the coordinates can be reached
+        '''
+        import kinematics
+        import numpy as np
+
+        with self.metrics.timer('inverse_kinematics'):
+            servo_3angles, reachable = kinematics.inverse_kinematics(coordinates, seed=self.positions[:3])
+            if not reachable and self.clamp_unreachable:
+                if self._workspace is not None:
+                    servo_3angles = self._workspace.solve(coordinates, seed=self.positions[:3])[0][0]
+                    self.metrics.count('coordinates_clamped')
+                else:
+                    # no grid to clamp with, the target is rejected
+                    servo_3angles = np.asarray(self.positions[:3], dtype=float)
+                    self.metrics.count('coordinates_rejected')
+        return np.round(servo_3angles), reachable
+
+    def move_to(self, coordinates):
+        # sets servos 1-3 to reach the coordinates, unreachable coordinates are not applied
+        servo_3angles, reachable = self.inverse_kinematics(coordinates)
+        if reachable:
+            self.set_positions(list(servo_3angles) + self.positions[3:])
+        return reachable
+
+    #######################################
+    # recording
+    #######################################
+    @property
+    def recording(self):
+        return self.recorder.recording
+
+    def start_recording(self):
+        if not self.recorder.recording:
+            self.recorder.start(self.positions)
+
+    def stop_recording(self):
+        '''
+        Stops the recording and adds it to `saved_positions`.
+            Returns:
+                    recording (Trajectory): the recorded positions, None if nothing was recording
+        '''
+        if not self.recorder.recording:
+            return None
+        self.recorder.stop()
+        recording = self.recorder.trajectory(None if self.save_timestamps else self.save_time)
+        if len(self.saved_positions) == 0:
+            self.saved_positions = recording
+            self.saved_positions.period = self.save_time
+        else:
+            self.saved_positions = self.saved_positions + recording
+        return recording
+
+    #######################################
+    # saved positions
+    #######################################
+    def clear_positions(self):
+        self.saved_positions.clear()
+
+    def clear_last_position(self):
+        # removes and returns the last saved position, None if there is none
+        if len(self.saved_positions) == 0:
+            return None
+        return self.saved_positions.pop()
+
+    def add_waypoint(self):
+        # adds the current positions to `saved_positions`, e.g. as a waypoint of `interpolate_positions`
+        self.saved_positions.append(self.positions)
+        return self.saved_positions.last
+
+    def interpolate_positions(self, duration=None, profile='minimum_jerk', space='joint', speed=30.0):
+        '''
+        Replaces `saved_positions` with a smooth motion through them (see `interpolation.py`),
+        e.g. through the waypoints added with `add_waypoint`.
+            Parameters:
+                    duration (float): time (s) of the whole motion, defaults to the largest servo change at `speed`
+                    profile (str): 'minimum_jerk', 'cubic', 'sin' or 'linear'
+                    space (str): 'joint' or 'cartesian'
+                    speed (float): degrees per second of the servo moving the most, used without `duration`
+
+            Returns:
+                    positions (Trajectory): the interpolated positions, `replay_period` apart
+        '''
+        import interpolation
+        import numpy as np
+
+        waypoints = self.saved_positions.positions
+        if len(waypoints) < 2:
+            raise ValueError('interpolating needs at least 2 saved positions')
+        if duration is None:
+            duration = np.abs(np.diff(waypoints, axis=0)).max(axis=1).sum() / speed
+        if duration <= 0:
+            raise ValueError('the saved positions do not move')
+        with self.metrics.timer('interpolate_positions'):
+            self.saved_positions = interpolation.interpolate(waypoints, duration, self.replay_period,
+                                                             profile=profile, space=space)
+        return self.saved_positions
+
+    def open_file(self, filename):
+        # loads a txt/traj file to `saved_positions`, raises ValueError if it is not a trajectory file
+        from trajectory import Trajectory
+
+        self.saved_positions = Trajectory.load(filename, period=self.save_time)
+        if self.preflight:
+            self.check(self.saved_positions, self.replay_period)
+        return self.saved_positions
+
+    def check(self, positions, period=None, log=True):
+        '''
+        Checks a whole trajectory before replaying it (see `preflight.py`), the issues are logged as warnings.
+            Returns:
+                    report (PreflightReport): the flagged frames and their reasons, `report.ok` if there is no error
+        '''
+        import preflight
+
+        with self.metrics.timer('preflight'):
+            self.preflight_report = preflight.validate(positions, period)
+        if log and self.preflight_report.checks:
+            self.metrics.log(self.preflight_report.summary(), 'warning')
+        return self.preflight_report
+
+    def save_file(self, filename):
+        self.saved_positions.save(filename)
+
+    #######################################
+    # replay
+    #######################################
+    @property
+    def running(self):
+        return self.player is not None and self.player.running
+
+    @property
+    def paused(self):
+        return self.player is not None and self.player.paused
+
+    def play(self, positions=None, on_ready=None):
+        '''
+        Starts replaying `positions` (defaults to `saved_positions`) in the background.
+            Parameters:
+                    positions (Trajectory or array): (N, 6) servo positions, optional
+                    on_ready (function): called just before the first frame is played, e.g. a start barrier,
+                                         after the first frames are uploaded when uploading the replay, optional
+
+            Returns:
+                    positions (Trajectory): the replayed frames, with the repeated positions collapsed
+        '''
+        from trajectory import Trajectory
+
+        if not self.connected:
+            raise RuntimeError('not connected, set the port first')
+        if self.running:
+            raise RuntimeError('a replay is already running')
+        positions = self.saved_positions if positions is None else positions
+        # the warnings are logged when the file is opened, the errors stop the replay
+        if self.preflight and not self.check(positions, self.replay_period, log=False).ok:
+            raise ValueError('the trajectory did not pass the preflight checks\n' + self.preflight_report.summary())
+        if not isinstance(positions, Trajectory):
+            positions = Trajectory(positions, self.replay_period)
+        if len(positions) == 0:
+            raise ValueError('no positions to replay')
+
+        # replay a copy, so recording or clearing positions does not affect the running replay
+        if self.player is self._uploader:
+            self.player.on_ready = on_ready
+            self.encoder.reset()
+        elif on_ready is not None:
+            on_ready()
+        with self.metrics.timer('play_positions'):
+            positions = positions.collapse_holds(self.replay_period) if self.collapse_holds else positions.copy()
+            self.player.set_speed(self.replay_speed)
+            self.player.start(positions)
+        self.metrics.count('replays')
+        return positions
+
+    def played(self, index, position):
+        # the replay stops at the last played position
+        self.positions = [int(angle) for angle in position]
+        if self.on_frame is not None:
+            self.on_frame(index, position)
+
+    def pause(self):
+        self.player.pause()
+
+    def resume(self):
+        self.player.resume()
+
+    def abort(self):
+        self.player.abort()
+
+    def wait(self, timeout=None):
+        return self.player is None or self.player.wait(timeout)
+
+    def stats(self):
+        return self.player.stats() if self.player is not None else {}
+
+    @property
+    def error(self):
+        # the exception that stopped the last replay, None if it finished or was aborted
+        return self.player.error if self.player is not None else None
+
+def print_frame(index, position):
+    # per-frame message, only formatted with the 'debug' log level
+    if default_metrics.logs('debug'):
+        print("playing: "+str(position.tolist()))
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Control the robot arm without the GUI.')
+    parser.add_argument('--port', help='serial port of arduino, e.g. COM3')
+    parser.add_argument('--simulate', action='store_true', help='use a simulated ESP32 instead of a port')
+    parser.add_argument('--ascii', action='store_true', help='use the ASCII serial format')
+    parser.add_argument('--live', action='store_true', help='send the frames live instead of uploading the replay')
+    parser.add_argument('--log-level', choices=['debug', 'info', 'warning', 'quiet'], default='info',
+                        help='debug prints every replayed frame')
+    parser.add_argument('--stats', help='save the latency histograms and counters to a json or csv file')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed')
+    parser.add_argument('--period', type=float, default=0.15, help='time (s) between two replayed frames')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fk_parser = subparsers.add_parser('fk', help='coordinates of servo 1-3 angles')
+    fk_parser.add_argument('angles', type=float, nargs=3)
+    ik_parser = subparsers.add_parser('ik', help='servo 1-3 angles of coordinates')
+    ik_parser.add_argument('coordinates', type=float, nargs=3)
+    move_parser = subparsers.add_parser('move', help='send 6 servo angles')
+    move_parser.add_argument('angles', type=int, nargs=6)
+    goto_parser = subparsers.add_parser('goto', help='move the jug to x, y, z coordinates')
+    goto_parser.add_argument('coordinates', type=float, nargs=3)
+    goto_parser.add_argument('--from', dest='start', type=int, nargs=6, default=list(default_positions),
+                             help='current servo angles, the inverse kinematics picks the closest solution')
+    play_parser = subparsers.add_parser('play', help='replay a txt/traj file')
+    play_parser.add_argument('filename')
+    args = parser.parse_args()
+
+    controller = ArmController(replay_period=args.period, replay_speed=args.speed, binary_protocol=not args.ascii,
+                               upload_replay=not args.live, on_frame=print_frame)
+    default_metrics.set_level(args.log_level)
+
+    if args.command == 'fk':
+        print(controller.forward_kinematics(args.angles).tolist())
+    elif args.command == 'ik':
+        controller.wait_workspace()
+        servo_3angles, reachable = controller.inverse_kinematics(args.coordinates)
+        clamped = controller.workspace is not None
+        print(servo_3angles.tolist() + ([] if reachable else
+                                        ['out of reach, ' + ('nearest reachable pose' if clamped else 'rejected')]))
+    else:
+        if args.simulate:
+            from esp32_simulator import ESP32Simulator, FakeSerial
+            controller.connect(FakeSerial(ESP32Simulator(time.monotonic, log_ticks=False)))
+        elif args.port:
+            controller.connect(args.port)
+        else:
+            parser.error('give the --port or --simulate')
+        print('serial format: ' + type(controller.encoder).__name__)
+
+        if args.command == 'move':
+            controller.set_positions(args.angles)
+            controller.send()
+        elif args.command == 'goto':
+            controller.set_positions(args.start)
+            if not controller.move_to(args.coordinates):
+                print('coordinates out of reach: ' + str(args.coordinates))
+            else:
+                controller.send()
+                print('servo angles: ' + str(controller.positions))
+        else:
+            controller.open_file(args.filename)
+            try:
+                positions = controller.play()
+                print(f'replaying {len(positions)} frames ({type(controller.player).__name__})')
+                controller.wait()
+            except KeyboardInterrupt:
+                controller.abort()
+                controller.wait(5.0)
+            print('replay finished: ' + str(controller.stats()))
+        controller.close()
+        if args.stats:
+            default_metrics.save(args.stats)
+            print(default_metrics.report())
+            print('saved: ' + args.stats)
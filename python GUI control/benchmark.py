@@ -0,0 +1,187 @@
+#%%
+'''
+This script benchmarks the hot paths of the controller without the arm attached:
+    1. inverse kinematics: solves per second, single target and batched
+    2. forward kinematics: batched frames per second
+    3. trajectory loading: MB per second for heart.txt/tulip.txt and a synthetic 100k-frame recording (txt and .traj)
+    4. frame encoding: frames per second for the ASCII and binary serial formats
+    5. replay timing: period jitter of a real-time replay to a simulated ESP32 (see `esp32_simulator.py`)
+    6. interpolation: frames per second of the joint (cubic spline) and cartesian (straight line) interpolation
+    7. preflight: frames per second of the checks run on every opened file and every recipe build
+
+The results are printed and can be saved as json, to compare them across releases:
+    python benchmark.py -o benchmark_results.json
+    python benchmark.py --quick
+'''
+#%%
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+
+import esp32_simulator
+import interpolation
+import kinematics
+import preflight
+import serial_protocol
+import trajectory_io
+from replay import ReplayEngine
+
+directory = os.path.dirname(os.path.abspath(__file__))
+
+#######################################
+# helper functions
+#######################################
+def best_time(function, repeat=5):
+    # best of `repeat` runs (s), the least disturbed by other processes
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def random_positions(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 181, size=(n, 6))
+
+#######################################
+# benchmarks
+#######################################
+def benchmark_inverse_kinematics(n=10000, repeat=5):
+    coordinates = kinematics.forward_kinematics_batch(random_positions(n))
+    single = coordinates[:min(n, 1000)]
+    single_time = best_time(lambda: [kinematics.inverse_kinematics(coordinate) for coordinate in single], repeat)
+    batch_time = best_time(lambda: kinematics.inverse_kinematics_batch(coordinates), repeat)
+    return {'single_solves_per_s': len(single) / single_time,
+            'batch_solves_per_s': n / batch_time}
+
+def benchmark_forward_kinematics(n=100000, repeat=5):
+    positions = random_positions(n)
+    batch_time = best_time(lambda: kinematics.forward_kinematics_batch(positions), repeat)
+    return {'batch_frames_per_s': n / batch_time}
+
+def benchmark_loading(synthetic_frames=100000, repeat=3):
+    results = {}
+    files = {'heart_txt': os.path.join(directory, 'heart', 'heart.txt'),
+             'tulip_txt': os.path.join(directory, 'tulip', 'tulip.txt')}
+
+    with tempfile.TemporaryDirectory() as temporary:
+        positions = random_positions(synthetic_frames)
+        files['synthetic_txt'] = os.path.join(temporary, 'synthetic.txt')
+        files['synthetic_traj'] = os.path.join(temporary, 'synthetic.traj')
+        trajectory_io.write_text(files['synthetic_txt'], positions)
+        trajectory_io.write_binary(files['synthetic_traj'], positions)
+
+        for name, filename in files.items():
+            if not os.path.exists(filename):
+                continue
+            size = os.path.getsize(filename)
+            # np.asarray reads the memory-mapped .traj file completely
+            load_time = best_time(lambda: np.asarray(trajectory_io.load(filename)).sum(), repeat)
+            results[name] = {'frames': len(trajectory_io.load(filename)),
+                             'bytes': size,
+                             'mb_per_s': size / load_time / 1e6,
+                             'frames_per_s': len(trajectory_io.load(filename)) / load_time}
+    return results
+
+def benchmark_encoding(n=20000, repeat=3):
+    # smooth motion, so the binary encoder mostly sends delta frames
+    steps = np.cumsum(np.random.default_rng(0).integers(-2, 3, size=(n, 6)), axis=0)
+    positions = np.clip(90 + steps, 0, 180).tolist()
+
+    results = {}
+    encoders = {'ascii': serial_protocol.AsciiEncoder, 'binary': serial_protocol.FrameEncoder}
+    for name, encoder_class in encoders.items():
+        encoder = encoder_class()
+        encode_time = best_time(lambda: [encoder.encode(position) for position in positions], repeat)
+        encoder = encoder_class()
+        total_bytes = sum(len(encoder.encode(position)) for position in positions)
+        results[name] = {'frames_per_s': n / encode_time, 'bytes_per_frame': total_bytes / n}
+    return results
+
+def benchmark_replay(frames=200, period=0.01):
+    # real-time replay to a simulated ESP32, the lateness shows the scheduling jitter of the host
+    simulator = esp32_simulator.ESP32Simulator(time.monotonic, log_ticks=False)
+    arduino = esp32_simulator.FakeSerial(simulator)
+    encoder = serial_protocol.FrameEncoder()
+    engine = ReplayEngine(lambda position: arduino.write(encoder.encode(position)), period)
+
+    send_times = []
+    engine.on_frame = lambda index, position: send_times.append(time.monotonic())
+    start = time.monotonic()
+    engine.run(random_positions(frames).tolist())
+    duration = time.monotonic() - start
+
+    periods = np.diff(send_times)
+    results = engine.stats()
+    results.update({'period': period,
+                    'period_mean': float(periods.mean()),
+                    'period_jitter_std': float(periods.std()),
+                    'period_jitter_max': float(np.abs(periods - period).max()),
+                    'drift': duration - (frames - 1) * period})
+    return results
+
+def benchmark_interpolation(frames=100000, waypoints=50, repeat=3):
+    keyframes = np.clip(random_positions(waypoints), 20, 160)
+    period = 0.01
+    duration = (frames - 1) * period
+    joint_time = best_time(lambda: interpolation.interpolate(keyframes, duration, period, profile='cubic'), repeat)
+    # a reachable straight line in front of the arm
+    line = [[90, 60, 110, 90, 90, 90], [120, 80, 100, 150, 90, 90]]
+    cartesian_time = best_time(lambda: interpolation.interpolate(line, duration, period, space='cartesian'), repeat)
+    return {'joint_frames_per_s': frames / joint_time, 'cartesian_frames_per_s': frames / cartesian_time}
+
+def benchmark_preflight(frames=100000, repeat=3):
+    positions = random_positions(frames)
+    heart = trajectory_io.load(os.path.join(directory, 'heart', 'heart.txt'))
+    check_time = best_time(lambda: preflight.validate(positions, period=0.15), repeat)
+    heart_time = best_time(lambda: preflight.validate(heart, period=0.15), repeat)
+    return {'frames_per_s': frames / check_time, 'heart_ms': heart_time * 1000}
+
+#######################################
+# run all benchmarks
+#######################################
+def run(quick=False):
+    scale = 10 if quick else 1
+    results = {'python': platform.python_version(),
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'quick': quick}
+    results['inverse_kinematics'] = benchmark_inverse_kinematics(10000 // scale)
+    results['forward_kinematics'] = benchmark_forward_kinematics(100000 // scale)
+    results['loading'] = benchmark_loading(100000 // scale)
+    results['encoding'] = benchmark_encoding(20000 // scale)
+    results['replay'] = benchmark_replay(200 // scale if quick else 200)
+    results['interpolation'] = benchmark_interpolation(100000 // scale)
+    results['preflight'] = benchmark_preflight(100000 // scale)
+    return results
+
+def print_results(results, indent=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print(f'{indent}{key}:')
+            print_results(value, indent + '    ')
+        elif isinstance(value, float):
+            print(f'{indent}{key}: {value:.6g}')
+        else:
+            print(f'{indent}{key}: {value}')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the kinematics, file loading, serial encoding and replay timing.')
+    parser.add_argument('-o', '--output', help='json file to save the results')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs, for a fast check')
+    args = parser.parse_args()
+
+    results = run(args.quick)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print('saved: ' + args.output)
@@ -0,0 +1,216 @@
+#%%
+'''
+This module schedules sending the servo positions to arduino and the kinematics from the tkinter event loop.
+
+Send scheduler:
+Instead of sending the slider values in a `while True:` loop, a frame is only sent when the servo positions change,
+at most `max_send_rate` times per second.
+If nothing changes, the last frame is sent again every `keep_alive_time` seconds so the connection stays alive.
+    Parameters:
+            window (Tk): the tkinter window, its `after` method schedules the checks
+            get_positions (function): returns the current servo positions, e.g. the 6 slider values
+            send (function): sends one list of servo positions to arduino
+            max_send_rate (float): maximum number of frames sent per second
+            keep_alive_time (float): resend the last frame after this many seconds without changes, None to disable
+
+    Counters:
+            frames_sent (int): number of frames sent to arduino
+            frames_suppressed (int): number of checks where nothing changed, so no frame was sent
+
+Kinematics sync:
+The servo 1-3 sliders and the x,y,z sliders update each other. Setting a slider from code fires its command again,
+so without a guard one drag bounces between forward and inverse kinematics, and the rounding of the servo angles
+(1 degree) and coordinates (0.1 cm) moves the slider that was not touched.
+`KinematicsSync` merges the changes into at most one solve per `frame_time`: the side changed last (joints or
+coordinates) is authoritative and the other side is solved from it. The values it writes to the sliders are
+remembered, their commands (the echoes) are ignored, so the authoritative side is never rewritten by a round trip.
+    Parameters:
+            window (Tk): the tkinter window, its `after` method schedules the solves
+            get_joints/set_joints (function): read/write the servo 1-3 slider values
+            get_coordinates/set_coordinates (function): read/write the x,y,z slider values
+            forward (function): coordinates of servo 1-3 angles
+            inverse (function): servo 1-3 angles reaching the coordinates
+            coordinate_limits (list): (3, 2) range of the x,y,z sliders, the solved coordinates are clipped to it
+            frame_time (float): minimum time (s) between two solves
+
+    Counters:
+            forward_solves/inverse_solves (int): number of forward/inverse kinematics solves
+            coalesced (int): number of changes merged into a pending solve
+            echoes (int): number of slider commands ignored because the values were written by the sync
+'''
+#%%
+import time
+
+# range of the x,y,z sliders (cm)
+coordinate_limits = ((-25, 25), (-25, 25), (-8, 31))
+
+#######################################
+# send scheduler
+#######################################
+class SendScheduler:
+    def __init__(self, window, get_positions, send, max_send_rate=20, keep_alive_time=1.0):
+        self.window = window
+        self.get_positions = get_positions
+        self.send = send
+        self.max_send_rate = max_send_rate
+        self.keep_alive_time = keep_alive_time
+
+        self.frames_sent = 0
+        self.frames_suppressed = 0
+
+        self.running = False
+        self.last_positions = None
+        self.last_send_time = None
+        self.after_id = None
+
+    def start(self):
+        # start the checks, does nothing if they are already running
+        if self.running:
+            return
+        self.running = True
+        self.last_positions = None
+        self.tick()
+
+    def stop(self):
+        self.running = False
+        if self.after_id is not None:
+            self.window.after_cancel(self.after_id)
+            self.after_id = None
+
+    def reset_counters(self):
+        self.frames_sent = 0
+        self.frames_suppressed = 0
+
+    def counters(self):
+        return {'frames_sent': self.frames_sent, 'frames_suppressed': self.frames_suppressed}
+
+    def tick(self):
+        # check whether the positions changed, send them if so
+        # then call itself again (recursive loop) after 1/max_send_rate seconds
+        if not self.running:
+            return
+        positions = list(self.get_positions())
+        now = time.monotonic()
+
+        changed = positions != self.last_positions
+        keep_alive = (self.keep_alive_time is not None and self.last_send_time is not None
+                      and now - self.last_send_time >= self.keep_alive_time)
+
+        if changed or keep_alive:
+            self.send(positions)
+            self.last_positions = positions
+            self.last_send_time = now
+            self.frames_sent += 1
+        else:
+            self.frames_suppressed += 1
+
+        self.after_id = self.window.after(int(1000 / self.max_send_rate), self.tick)
+
+#######################################
+# kinematics sync
+#######################################
+class KinematicsSync:
+    def __init__(self, window, get_joints, set_joints, get_coordinates, set_coordinates, forward, inverse,
+                 coordinate_limits=coordinate_limits, frame_time=1/60, clock=time.monotonic):
+        self.window = window
+        self.get_joints = get_joints
+        self.set_joints = set_joints
+        self.get_coordinates = get_coordinates
+        self.set_coordinates = set_coordinates
+        self.forward = forward
+        self.inverse = inverse
+        self.coordinate_limits = coordinate_limits
+        self.frame_time = frame_time
+        self.clock = clock
+
+        self.forward_solves = 0
+        self.inverse_solves = 0
+        self.coalesced = 0
+        self.echoes = 0
+
+        # 'joints' or 'coordinates', the side changed last
+        self.authority = None
+        self.pending = None
+        self.updating = False
+        self.after_id = None
+        self.last_solve_time = None
+        # the current slider values are consistent, their commands at startup are echoes
+        self.written_joints = self._read(get_joints)
+        self.written_coordinates = self._read(get_coordinates)
+
+    def counters(self):
+        return {'forward_solves': self.forward_solves, 'inverse_solves': self.inverse_solves,
+                'coalesced': self.coalesced, 'echoes': self.echoes}
+
+    #######################################
+    # slider commands
+    #######################################
+    def joints_changed(self, value=None):
+        # command of the servo 1-3 sliders
+        self.changed('joints', self.get_joints, self.written_joints, 0.5)
+
+    def coordinates_changed(self, value=None):
+        # command of the x,y,z sliders
+        self.changed('coordinates', self.get_coordinates, self.written_coordinates, 0.05)
+
+    def changed(self, side, get_values, written, tolerance):
+        # reentrancy guard: commands fired while the sync writes the sliders
+        if self.updating:
+            self.echoes += 1
+            return
+        # commands fired later (tkinter runs them when idle) for the values written by the sync
+        if written is not None and all(abs(a - b) < tolerance for a, b in zip(self._read(get_values), written)):
+            self.echoes += 1
+            return
+        self.authority = side
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = side
+        self.schedule()
+
+    #######################################
+    # solves
+    #######################################
+    def schedule(self):
+        # solve right away, or when `frame_time` has passed since the last solve
+        if self.after_id is not None:
+            return
+        delay = 0.0
+        if self.last_solve_time is not None:
+            delay = max(0.0, self.frame_time - (self.clock() - self.last_solve_time))
+        self.after_id = self.window.after(int(delay * 1000), self.solve)
+
+    def cancel(self):
+        if self.after_id is not None:
+            self.window.after_cancel(self.after_id)
+            self.after_id = None
+        self.pending = None
+
+    def solve(self):
+        # one solve from the authoritative side, the latest values of the sliders
+        self.after_id = None
+        side, self.pending = self.pending, None
+        if side is None:
+            return
+        self.last_solve_time = self.clock()
+        self.updating = True
+        try:
+            if side == 'joints':
+                coordinates = self.forward(self._read(self.get_joints))
+                coordinates = [min(max(float(value), low), high)
+                               for value, (low, high) in zip(coordinates, self.coordinate_limits)]
+                self.written_coordinates = coordinates
+                self.written_joints = None
+                self.set_coordinates(coordinates)
+                self.forward_solves += 1
+            else:
+                joints = [float(value) for value in self.inverse(self._read(self.get_coordinates))]
+                self.written_joints = joints
+                self.written_coordinates = None
+                self.set_joints(joints)
+                self.inverse_solves += 1
+        finally:
+            self.updating = False
+
+    def _read(self, get_values):
+        return [float(value) for value in get_values()]
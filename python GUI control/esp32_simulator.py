@@ -0,0 +1,404 @@
+#%%
+'''
+This module simulates the ESP32 firmware (`robotic_arm_ESP32.ino`) on the host, so replays can be tested without the arm.
+It decodes the same serial protocol (ASCII and binary frames, see `serial_protocol.py`) and reproduces the smoothing filter
+of the firmware, which runs every 5 ms:
+    dataServoN_smooth = dataServoN * (1 - refresh_rate) + dataServoN_smooth_prev * refresh_rate
+Like on the ESP32, the smoothed values start at 0, not at the initial servo positions.
+Uploaded trajectories (queue and control frames, see `upload.py`) are buffered and played on the firmware loops,
+with the same ring buffer size and status lines as the firmware.
+
+The simulator runs on a clock: `VirtualClock` runs faster than real time (sleeping only advances the virtual time),
+time.monotonic runs in real time (e.g. behind a pseudo terminal).
+    Usage:
+            clock = VirtualClock()
+            simulator = ESP32Simulator(clock)
+            arduino = FakeSerial(simulator)   # same interface as serial.Serial
+            ...
+            times, targets, angles = simulator.log()
+
+Command line:
+    python esp32_simulator.py replay heart/heart.txt --period 0.15 -o heart_simulated.csv
+    python esp32_simulator.py upload heart/heart.txt --host-delay 0.1
+    python esp32_simulator.py pty    # prints the port name to connect the GUI to (linux/mac only)
+'''
+#%%
+import collections
+import time
+
+import numpy as np
+
+import serial_protocol
+
+#######################################
+# clocks
+#######################################
+class VirtualClock:
+    '''
+    A clock that only advances when sleeping, so simulations run as fast as possible.
+    '''
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.time += seconds
+
+#######################################
+# firmware simulator
+#######################################
+class ESP32Simulator:
+    '''
+    Simulates the serial decoding and the smoothing filter of the firmware.
+        Parameters:
+                clock (function): returns the current time (s), e.g. `VirtualClock().now` or time.monotonic
+                refresh_rate (float): smoothing factor of the firmware
+                tick (float): time (s) between two firmware loops
+                initial_positions (list): initial servo targets of the firmware
+                initial_smooth (list): initial smoothed values, 0 like on the ESP32
+                log_ticks (bool): keep the smoothed angles of every tick (see `log`)
+                queue_size (int): number of frames of the upload ring buffer
+    '''
+    def __init__(self, clock=time.monotonic, refresh_rate=0.98, tick=0.005,
+                 initial_positions=(90, 60, 110, 90, 90, 90), initial_smooth=None, log_ticks=True, queue_size=512):
+        if isinstance(clock, VirtualClock):
+            clock = clock.now
+        self.clock = clock
+        self.refresh_rate = refresh_rate
+        self.tick = tick
+        self.log_ticks = log_ticks
+
+        self.decoder = serial_protocol.FrameDecoder()
+        self.targets = np.array(initial_positions, dtype=float)
+        self.smooth = np.zeros(6) if initial_smooth is None else np.array(initial_smooth, dtype=float)
+        self.next_tick = self.clock()
+        self.ticks = 0
+
+        # bytes sent back to the host (answers to the negotiation)
+        self.output = bytearray()
+        self.log_blocks = []
+
+        # upload ring buffer of (ticks, position)
+        self.queue_size = queue_size
+        self.queue = collections.deque()
+        self.clear_queue()
+
+    def clear_queue(self):
+        self.queue.clear()
+        self.queue_state = serial_protocol.STATE_IDLE
+        self.queue_ended = False
+        self.queue_starved = False
+        self.ticks_left = 0
+        self.queue_received = 0
+        self.queue_played = 0
+        self.queue_underruns = 0
+
+    def status(self):
+        return {'state': self.queue_state, 'free': self.queue_size - len(self.queue), 'received': self.queue_received,
+                'played': self.queue_played, 'underruns': self.queue_underruns}
+
+    def receive(self, data):
+        # run the loops before the bytes arrived, then decode the bytes like `read_serial()`
+        self.advance_to(self.clock())
+        handshakes = self.decoder.handshakes
+        positions = self.decoder.feed(data)
+        if positions:
+            self.targets = np.array(positions[-1], dtype=float)
+        for i in range(self.decoder.handshakes - handshakes):
+            self.output += serial_protocol.HANDSHAKE_REPLY + b'\n'
+        for message in self.decoder.messages:
+            if message[0] == 'queue':
+                self.receive_queue(*message[1:])
+            else:
+                self.receive_control(message[1])
+        self.decoder.messages.clear()
+
+    def receive_queue(self, seq, ticks, position):
+        # like `handle_queue_frame()`: only in order and if the buffer is not full
+        if seq != self.queue_received & 0xFF or len(self.queue) == self.queue_size:
+            return
+        self.queue.append((ticks, position))
+        self.queue_received += 1
+
+    def receive_control(self, command):
+        # like `handle_control_frame()`
+        if command == serial_protocol.QUEUE_START:
+            self.queue_state = serial_protocol.STATE_PLAYING
+        elif command == serial_protocol.QUEUE_END:
+            self.queue_ended = True
+        elif command == serial_protocol.QUEUE_CLEAR:
+            self.clear_queue()
+        elif command == serial_protocol.QUEUE_PAUSE and self.queue_state == serial_protocol.STATE_PLAYING:
+            self.queue_state = serial_protocol.STATE_PAUSED
+        elif command == serial_protocol.QUEUE_RESUME and self.queue_state == serial_protocol.STATE_PAUSED:
+            self.queue_state = serial_protocol.STATE_PLAYING
+        elif command != serial_protocol.QUEUE_STATUS:
+            return
+        self.output += serial_protocol.encode_status(self.status())
+
+    def play_queue(self):
+        # like `play_queue()`, at the start of a loop where the current frame is finished
+        if self.queue_state != serial_protocol.STATE_PLAYING or self.ticks_left > 0:
+            return
+        if not self.queue:
+            if self.queue_ended:
+                self.queue_state = serial_protocol.STATE_FINISHED
+                self.output += serial_protocol.encode_status(self.status())
+            elif not self.queue_starved:
+                self.queue_starved = True
+                self.queue_underruns += 1
+            return
+        ticks, position = self.queue.popleft()
+        self.targets = np.array(position, dtype=float)
+        self.ticks_left = max(ticks, 1)
+        self.queue_played += 1
+        self.queue_starved = False
+        self.decoder.last_seq = None
+
+    def advance_to(self, now):
+        # run all the firmware loops up to `now`,
+        # split where an uploaded frame starts, the target is constant in between
+        if now < self.next_tick:
+            return
+        n = int((now - self.next_tick) // self.tick) + 1
+        while n > 0:
+            self.play_queue()
+            playing = self.queue_state == serial_protocol.STATE_PLAYING and self.ticks_left > 0
+            ticks = min(n, self.ticks_left) if playing else n
+            self.run_ticks(ticks)
+            if playing:
+                self.ticks_left -= ticks
+            n -= ticks
+
+    def run_ticks(self, n):
+        # run `n` firmware loops at once:
+        # with a constant target, smooth(k) = target + (smooth(0) - target) * refresh_rate**k
+        k = np.arange(1, n + 1).reshape(n, 1)
+        angles = self.targets + (self.smooth - self.targets) * self.refresh_rate ** k
+
+        if self.log_ticks:
+            times = self.next_tick + (k[:, 0] - 1) * self.tick
+            self.log_blocks.append((times, np.broadcast_to(self.targets, angles.shape).copy(), angles))
+        self.smooth = angles[-1]
+        self.next_tick += n * self.tick
+        self.ticks += n
+
+    def servo_angles(self):
+        # the angles written to the servos, `servo.write` truncates the smoothed values to integers
+        return np.trunc(self.smooth).astype(int)
+
+    def log(self):
+        '''
+        Returns:
+                times (array): (T,) time of each firmware loop (s)
+                targets (array): (T, 6) servo targets received from the host
+                angles (array): (T, 6) smoothed servo angles written by the firmware
+        '''
+        if not self.log_blocks:
+            return np.zeros(0), np.zeros((0, 6)), np.zeros((0, 6))
+        times, targets, angles = zip(*self.log_blocks)
+        return np.concatenate(times), np.concatenate(targets), np.concatenate(angles)
+
+#######################################
+# in-process serial port
+#######################################
+class FakeSerial:
+    '''
+    Replaces serial.Serial: the bytes written are delivered to the simulator at the current clock time.
+    With an `error_rate`, one byte of a write is corrupted with this probability, to test the recovery of lost frames.
+    '''
+    def __init__(self, simulator, port='simulated ESP32', baudrate=115200, error_rate=0.0, seed=0):
+        self.simulator = simulator
+        self.port = port
+        self.baudrate = baudrate
+        self.is_open = True
+        self.bytes_written = 0
+        self.error_rate = error_rate
+        self.random = np.random.default_rng(seed)
+
+    def write(self, data):
+        data = bytearray(data)
+        if self.error_rate and len(data) and self.random.random() < self.error_rate:
+            data[self.random.integers(len(data))] ^= 0xFF
+        self.simulator.receive(bytes(data))
+        self.bytes_written += len(data)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.simulator.output)
+
+    def read(self, size=1):
+        data = bytes(self.simulator.output[:size])
+        del self.simulator.output[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self.simulator.output.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+#######################################
+# simulated replay
+#######################################
+def simulate_replay(positions, period=0.15, speed=1.0, binary=True, settle_time=1.0, refresh_rate=0.98):
+    '''
+    Replays `positions` on a simulated ESP32 with a virtual clock (much faster than real time).
+        Parameters:
+                positions (array): (N, 6) servo positions, e.g. a Trajectory
+                period (float): replay period (s), see `replay.py`
+                speed (float): replay speed
+                binary (bool): negotiate the binary serial format, otherwise use ASCII
+                settle_time (float): time (s) simulated after the last frame
+                refresh_rate (float): smoothing factor of the firmware
+
+        Returns:
+                simulator (ESP32Simulator): see `simulator.log()` for the servo angles over time
+                stats (dict): replay statistics, see `ReplayEngine.stats`
+    '''
+    from replay import ReplayEngine
+
+    # the arm is assumed to rest at the first position when the replay starts
+    clock = VirtualClock()
+    simulator = ESP32Simulator(clock, refresh_rate=refresh_rate, initial_positions=positions[0], initial_smooth=positions[0])
+    arduino = FakeSerial(simulator)
+
+    if binary:
+        encoder = _negotiate_now(arduino, positions[0])
+    else:
+        encoder = serial_protocol.AsciiEncoder()
+
+    engine = ReplayEngine(lambda position: arduino.write(encoder.encode(position)), period, speed,
+                          clock=clock.now, sleep=clock.sleep)
+    engine.run(positions)
+    clock.sleep(settle_time)
+    simulator.advance_to(clock.now())
+    return simulator, engine.stats()
+
+def simulate_upload(positions, period=0.15, speed=1.0, settle_time=1.0, refresh_rate=0.98,
+                    host_delay=0.0, error_rate=0.0, seed=0, on_progress=None):
+    '''
+    Uploads `positions` to a simulated ESP32 with a virtual clock, see `upload.py`.
+        Parameters:
+                host_delay (float): every sleep of the host takes up to this much longer (s), to simulate host load
+                error_rate (float): probability of a corrupted byte per write
+                see `simulate_replay` for the other parameters
+
+        Returns:
+                simulator (ESP32Simulator): see `simulator.log()` for the servo angles over time
+                stats (dict): upload statistics, see `Uploader.stats`
+    '''
+    from upload import Uploader
+
+    clock = VirtualClock()
+    simulator = ESP32Simulator(clock, refresh_rate=refresh_rate, initial_positions=positions[0], initial_smooth=positions[0])
+    arduino = FakeSerial(simulator, error_rate=error_rate, seed=seed)
+    random = np.random.default_rng(seed)
+
+    def sleep(seconds):
+        clock.sleep(seconds + host_delay * random.random())
+        simulator.advance_to(clock.now())
+
+    uploader = Uploader(arduino.write, lambda: arduino.read(arduino.in_waiting), period, speed,
+                        on_progress=on_progress, clock=clock.now, sleep=sleep)
+    uploader.run(positions)
+    sleep(settle_time)
+    return simulator, uploader.stats()
+
+def _negotiate_now(arduino, position):
+    # the simulator answers immediately, no need to wait for the real-time timeout of `negotiate`
+    arduino.reset_input_buffer()
+    arduino.write(serial_protocol.encode_handshake(position))
+    if serial_protocol.HANDSHAKE_REPLY in arduino.read(arduino.in_waiting):
+        return serial_protocol.FrameEncoder()
+    return serial_protocol.AsciiEncoder()
+
+#######################################
+# pseudo terminal
+#######################################
+def run_pty(simulator=None, report_time=5.0):
+    '''
+    Runs a simulator in real time behind a pseudo terminal, the GUI can connect to the printed port name.
+    '''
+    import os
+    import select
+
+    simulator = simulator or ESP32Simulator(time.monotonic, log_ticks=False)
+    master, slave = os.openpty()
+    print('simulated ESP32 on port: ' + os.ttyname(slave))
+
+    last_report = time.monotonic()
+    try:
+        while True:
+            readable, _, _ = select.select([master], [], [], simulator.tick)
+            if readable:
+                simulator.receive(os.read(master, 1024))
+                if simulator.output:
+                    os.write(master, bytes(simulator.output))
+                    simulator.output.clear()
+            simulator.advance_to(time.monotonic())
+
+            if time.monotonic() - last_report >= report_time:
+                last_report = time.monotonic()
+                print('servo angles: ' + str(simulator.servo_angles().tolist()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(master)
+        os.close(slave)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simulate the ESP32 firmware of the robotic arm.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    replay_parser = subparsers.add_parser('replay', help='replay a trajectory file with a virtual clock')
+    replay_parser.add_argument('filename')
+    replay_parser.add_argument('--period', type=float, default=0.15, help='replay period (s)')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='replay speed')
+    replay_parser.add_argument('--ascii', action='store_true', help='use the ASCII serial format')
+    replay_parser.add_argument('-o', '--output', help='csv file for the servo angles over time')
+
+    upload_parser = subparsers.add_parser('upload', help='upload a trajectory file to the buffer of the firmware')
+    upload_parser.add_argument('filename')
+    upload_parser.add_argument('--period', type=float, default=0.15, help='replay period (s)')
+    upload_parser.add_argument('--speed', type=float, default=1.0, help='replay speed')
+    upload_parser.add_argument('--host-delay', type=float, default=0.0, help='largest extra delay (s) of the host sleeps')
+    upload_parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a corrupted byte per write')
+
+    subparsers.add_parser('pty', help='run a simulated ESP32 behind a pseudo terminal')
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        from trajectory import Trajectory
+
+        positions = Trajectory.load(args.filename)
+        simulator, stats = simulate_replay(positions, args.period, args.speed, binary=not args.ascii)
+        times, targets, angles = simulator.log()
+
+        print(f'simulated {times[-1] - times[0]:.2f} s ({simulator.ticks} firmware loops), '
+              f'{len(positions)} frames')
+        print(f'largest lag behind the target: {np.abs(targets - angles).max():.1f} degrees')
+        if args.output:
+            header = 'time,' + ','.join(f'target{i}' for i in range(1, 7)) + ',' + ','.join(f'servo{i}' for i in range(1, 7))
+            np.savetxt(args.output, np.column_stack([times, targets, angles]), delimiter=',', header=header, comments='', fmt='%.4f')
+            print('saved: ' + args.output)
+    elif args.command == 'upload':
+        from trajectory import Trajectory
+
+        positions = Trajectory.load(args.filename)
+        simulator, stats = simulate_upload(positions, args.period, args.speed, host_delay=args.host_delay,
+                                           error_rate=args.error_rate)
+        print(stats)
+        print(f'simulated {simulator.ticks * simulator.tick:.2f} s ({simulator.ticks} firmware loops), '
+              f'{stats["frames_played"]}/{len(positions)} frames played, {stats["underruns"]} underruns')
+    else:
+        run_pty()
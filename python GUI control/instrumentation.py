@@ -0,0 +1,215 @@
+#%%
+'''
+This module measures where the time goes while controlling the arm: latency histograms of the calls on the hot path
+(sending frames, kinematics, recording, starting replays), counters (serial bytes and frames written, replay deadline
+misses) and the lateness of the replayed frames. It also holds the log level of the console messages,
+the per-frame messages (e.g. "playing: ...") are only printed with the 'debug' level, printing costs time on the replay path.
+
+Recording a value costs about a microsecond: the histograms have fixed logarithmic bins (20 per decade from 1 us to 100 s),
+so no sample is kept and the percentiles are accurate to ~12%.
+    Usage:
+            from instrumentation import metrics
+            with metrics.timer('send_positions'):
+                ...
+            metrics.count('serial_bytes', len(message))
+            metrics.log('playing: ...', 'debug')
+            metrics.save('stats.json')      # or stats.csv
+
+    Log levels: 'debug', 'info', 'warning', 'quiet'
+'''
+#%%
+import json
+import math
+import threading
+import time
+
+levels = {'debug': 10, 'info': 20, 'warning': 30, 'quiet': 40}
+
+#######################################
+# histogram
+#######################################
+class Histogram:
+    def __init__(self, low=1e-6, high=100.0, bins_per_decade=20):
+        self.low = low
+        self.bins_per_decade = bins_per_decade
+        self.n_bins = int(round(math.log10(high / low) * bins_per_decade))
+        # bin 0: below `low`, bin n_bins + 1: above `high`
+        self.counts = [0] * (self.n_bins + 2)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value < self.low:
+            index = 0
+        else:
+            index = min(int(math.log10(value / self.low) * self.bins_per_decade) + 1, self.n_bins + 1)
+        self.counts[index] += 1
+
+    def edge(self, index):
+        # upper edge of a bin
+        return self.low * 10 ** (index / self.bins_per_decade)
+
+    def percentile(self, q):
+        # upper edge of the bin holding the q-th percentile, within the measured min and max
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return min(max(self.edge(index), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count,
+                'min': self.min,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'max': self.max}
+
+class _Timer:
+    # one timed call, `with metrics.timer(name):`
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.metrics.clock()
+        return self
+
+    def __exit__(self, *exception):
+        self.metrics.record(self.name, self.metrics.clock() - self.start)
+        return False
+
+class _NoTimer:
+    # used when the measurements are disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_no_timer = _NoTimer()
+
+#######################################
+# instrumentation
+#######################################
+class Instrumentation:
+    '''
+    Latency histograms (s) and counters of the controller, and the log level of its messages.
+        Parameters:
+                enabled (bool): record the measurements, the log level works either way
+                level (str): log level, see `levels`
+                clock (function): high resolution clock in seconds
+    '''
+    def __init__(self, enabled=True, level='info', clock=time.perf_counter):
+        self.enabled = enabled
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.set_level(level)
+        self.start_time = time.time()
+
+    #######################################
+    # log level
+    #######################################
+    def set_level(self, level):
+        if level not in levels:
+            raise ValueError(f'log level has to be one of {", ".join(levels)}, got {level!r}')
+        self.level = level
+        self._level = levels[level]
+
+    def logs(self, level):
+        # whether messages of this level are printed, check it before formatting a message on the hot path
+        return levels[level] >= self._level
+
+    def log(self, message, level='info'):
+        if levels[level] >= self._level:
+            print(message)
+
+    #######################################
+    # measurements
+    #######################################
+    def timer(self, name):
+        return _Timer(self, name) if self.enabled else _no_timer
+
+    def record(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.start_time = time.time()
+
+    #######################################
+    # export
+    #######################################
+    def snapshot(self):
+        with self.lock:
+            return {'start_time': self.start_time,
+                    'elapsed': time.time() - self.start_time,
+                    'counters': dict(self.counters),
+                    'latency': {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+    def rows(self):
+        # one row per counter and histogram, for the csv export
+        snapshot = self.snapshot()
+        columns = ['name', 'count', 'total', 'mean', 'min', 'p50', 'p95', 'p99', 'max']
+        rows = [columns]
+        for name, value in sorted(snapshot['counters'].items()):
+            rows.append([name, value] + [''] * (len(columns) - 2))
+        for name, summary in sorted(snapshot['latency'].items()):
+            rows.append([name] + [summary.get(column, '') for column in columns[1:]])
+        return rows
+
+    def save(self, filename):
+        # json, or csv if the file name ends with .csv
+        if filename.endswith('.csv'):
+            with open(filename, 'w') as f:
+                f.write('\n'.join(','.join(str(value) for value in row) for row in self.rows()) + '\n')
+        else:
+            with open(filename, 'w') as f:
+                json.dump(self.snapshot(), f, indent=2)
+
+    def report(self):
+        # printable summary, latencies in ms
+        snapshot = self.snapshot()
+        lines = [f'{name}: {value}' for name, value in sorted(snapshot['counters'].items())]
+        for name, summary in sorted(snapshot['latency'].items()):
+            if summary['count']:
+                lines.append(f"{name}: {summary['count']} calls, mean {summary['mean'] * 1000:.3f} ms, "
+                             f"p95 {summary['p95'] * 1000:.3f} ms, max {summary['max'] * 1000:.3f} ms")
+        return '\n'.join(lines)
+
+# shared by the controller, the replay engines and the GUI
+metrics = Instrumentation()
@@ -0,0 +1,194 @@
+#%%
+'''
+This module interpolates smooth motions through any number of waypoints (servo positions), vectorized with numpy.
+The interpolated angles are rounded to the nearest degree (not truncated like the `ease` stage).
+
+Profiles (s goes from 0 to 1 between two waypoints, u is the fraction of the time between them):
+    minimum_jerk: s = 10u^3 - 15u^4 + 6u^5, the smoothest point-to-point motion, stops at every waypoint
+    cubic: cubic spline through all the waypoints, continuous velocity and acceleration, stops only at the ends
+    sin: s = 0.5 * (1 - cos(pi * u)), the ease-in-out of !interpolation.py
+    linear: s = u
+
+Spaces:
+    joint: the servo angles are interpolated
+    cartesian: the jug position (forward kinematics of servos 1-3) is interpolated, so with the minimum_jerk, sin and
+               linear profiles the jug moves in straight lines; servos 1-3 are solved with batched inverse kinematics,
+               servos 4-6 are interpolated in joint space
+
+Timing:
+Without `times`, the time of each waypoint is spread over `duration` proportionally to the largest servo change
+(joint space) or the distance of the jug (cartesian space), so the motion has about the same speed everywhere.
+
+    Usage:
+            trajectory = interpolate([[90, 60, 110, 90, 90, 90], [120, 80, 100, 150, 90, 90], [90, 60, 110, 180, 90, 90]],
+                                     duration=3, period=0.15, profile='cubic')
+'''
+#%%
+import numpy as np
+
+from trajectory import Trajectory
+
+profiles = ('minimum_jerk', 'cubic', 'sin', 'linear')
+
+#######################################
+# timing
+#######################################
+def waypoint_times(waypoints, duration):
+    '''
+    Time (s) of each waypoint, proportional to the distance from the previous waypoint.
+        Parameters:
+                waypoints (array): (M, D) positions or coordinates
+                duration (float): time (s) from the first to the last waypoint
+
+        Returns:
+                times (array): (M,) from 0 to `duration`
+    '''
+    waypoints = np.asarray(waypoints, dtype=float)
+    if len(waypoints) == 1:
+        return np.zeros(1)
+    distances = np.abs(np.diff(waypoints, axis=0)).max(axis=1, initial=0)
+    if distances.sum() == 0:
+        distances = np.ones(len(distances))
+    return np.concatenate([[0], np.cumsum(distances)]) / distances.sum() * duration
+
+#######################################
+# profiles
+#######################################
+def _segment_profile(u, profile):
+    # fraction of the way between two waypoints
+    if profile == 'minimum_jerk':
+        return u**3 * (10 - 15*u + 6*u**2)
+    if profile == 'sin':
+        return 0.5 * (1 - np.cos(np.pi * u))
+    if profile == 'linear':
+        return u
+    raise ValueError(f'profile has to be one of {profiles}, got {profile!r}')
+
+def _cubic_spline(times, values, t):
+    # clamped cubic spline (zero velocity at both ends) through (times, values), evaluated at t
+    # the second derivatives m of the waypoints are the solution of a tridiagonal system
+    m = len(times)
+    h = np.diff(times)
+    slopes = np.diff(values, axis=0) / h[:, None]
+    system = np.zeros((m, m))
+    rhs = np.zeros((m, values.shape[1]))
+    system[0, :2] = [2 * h[0], h[0]]
+    rhs[0] = 6 * slopes[0]
+    system[-1, -2:] = [h[-1], 2 * h[-1]]
+    rhs[-1] = -6 * slopes[-1]
+    i = np.arange(1, m - 1)
+    system[i, i - 1] = h[:-1]
+    system[i, i] = 2 * (h[:-1] + h[1:])
+    system[i, i + 1] = h[1:]
+    rhs[1:-1] = 6 * (slopes[1:] - slopes[:-1])
+    second = np.linalg.solve(system, rhs)
+
+    segment = np.clip(np.searchsorted(times, t, side='right') - 1, 0, m - 2)
+    a = (times[segment + 1] - t)[:, None]
+    b = (t - times[segment])[:, None]
+    hs = h[segment][:, None]
+    return (second[segment] * a**3 + second[segment + 1] * b**3) / (6 * hs) \
+        + (values[segment] / hs - second[segment] * hs / 6) * a \
+        + (values[segment + 1] / hs - second[segment + 1] * hs / 6) * b
+
+def sample(times, values, t, profile='minimum_jerk'):
+    '''
+    Evaluates the interpolation through the waypoints (times, values) at the times t.
+        Parameters:
+                times (array): (M,) increasing time (s) of each waypoint
+                values (array): (M, D) waypoints
+                t (array): (K,) times (s) to sample
+                profile (str): see the module docstring
+
+        Returns:
+                sampled (array): (K, D) float
+    '''
+    times = np.asarray(times, dtype=float)
+    values = np.asarray(values, dtype=float)
+    t = np.clip(np.asarray(t, dtype=float), times[0], times[-1])
+    if len(times) == 1:
+        return np.repeat(values, len(t), axis=0)
+    if profile == 'cubic':
+        return _cubic_spline(times, values, t)
+    segment = np.clip(np.searchsorted(times, t, side='right') - 1, 0, len(times) - 2)
+    u = (t - times[segment]) / (times[segment + 1] - times[segment])
+    s = _segment_profile(u, profile)[:, None]
+    return values[segment] + s * (values[segment + 1] - values[segment])
+
+#######################################
+# interpolation
+#######################################
+def interpolate(waypoints, duration=None, period=0.15, times=None, profile='minimum_jerk', space='joint'):
+    '''
+    Interpolates a motion through the waypoints.
+        Parameters:
+                waypoints (array): (M, 6) servo positions, e.g. keyframes or the first and last frame of a file
+                duration (float): time (s) of the whole motion, needed without `times`
+                period (float): time (s) between two interpolated frames
+                times (array): (M,) increasing time (s) of each waypoint, optional
+                profile (str): 'minimum_jerk', 'cubic', 'sin' or 'linear'
+                space (str): 'joint' or 'cartesian'
+
+        Returns:
+                trajectory (Trajectory): frames every `period`, from the first to the last waypoint
+    '''
+    waypoints = np.asarray(waypoints, dtype=float).reshape(-1, Trajectory.n_servos)
+    if len(waypoints) == 0:
+        raise ValueError('interpolate needs at least one waypoint')
+    if space not in ('joint', 'cartesian'):
+        raise ValueError(f'space has to be "joint" or "cartesian", got {space!r}')
+
+    if space == 'cartesian':
+        import kinematics
+        coordinates = kinematics.forward_kinematics_batch(waypoints)
+
+    if times is None:
+        if duration is None:
+            raise ValueError('give the duration of the motion or the times of the waypoints')
+        # repeated waypoints would take no time, they are left out
+        moved = np.concatenate([[True], np.any(np.diff(waypoints, axis=0) != 0, axis=1)])
+        if len(waypoints) > 1 and not moved[1:].any():
+            moved[-1] = True
+        waypoints = waypoints[moved]
+        if space == 'cartesian':
+            coordinates = coordinates[moved]
+        distances = np.hstack([coordinates, waypoints[:, 3:]]) if space == 'cartesian' else waypoints
+        times = waypoint_times(distances, duration)
+    times = np.asarray(times, dtype=float)
+    if times.shape != (len(waypoints),) or np.any(np.diff(times) <= 0):
+        raise ValueError('the waypoints need increasing times')
+
+    n = int(round((times[-1] - times[0]) / period)) + 1
+    t = np.linspace(times[0], times[-1], n)
+    positions = sample(times, waypoints, t, profile)
+
+    if space == 'cartesian':
+        # the joint interpolation is the seed, so the inverse kinematics stays on the same branch
+        line = sample(times, coordinates, t, profile)
+        angles, reachable = kinematics.inverse_kinematics_batch(line, seed=positions[:, :3])
+        if not reachable.all():
+            print(f'Warning: {np.count_nonzero(~reachable)} interpolated positions are out of reach.')
+        positions[:, :3] = angles
+
+    return Trajectory(np.rint(positions), period)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Interpolate a smooth motion through the positions of a trajectory file.')
+    parser.add_argument('source', help='trajectory file with the waypoints')
+    parser.add_argument('output')
+    parser.add_argument('--duration', type=float, required=True, help='time (s) of the whole motion')
+    parser.add_argument('--period', type=float, default=0.15, help='time (s) between two frames')
+    parser.add_argument('--profile', choices=profiles, default='minimum_jerk')
+    parser.add_argument('--space', choices=['joint', 'cartesian'], default='joint')
+    parser.add_argument('--ends', action='store_true', help='only use the first and last position as waypoints')
+    args = parser.parse_args()
+
+    waypoints = Trajectory.load(args.source).positions
+    if args.ends:
+        waypoints = waypoints[[0, -1]]
+    trajectory = interpolate(waypoints, args.duration, args.period, profile=args.profile, space=args.space)
+    trajectory.save(args.output)
+    print(f'{len(waypoints)} waypoints -> {len(trajectory)} frames')
+    print('saved: ' + args.output)
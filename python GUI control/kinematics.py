@@ -0,0 +1,174 @@
+#%%
+'''
+This module solves the kinematics of the first 3 joints of the robotic arm in closed form.
+Both forward and inverse kinematics are vectorised, so whole trajectories can be solved in one call.
+The first 3 joints are a yaw joint (servo 1) followed by a planar 2-link arm (servo 2 and servo 3),
+so the inverse kinematics can be solved analytically instead of with an iterative solver.
+
+All angles are given in servo degrees, i.e. the values of the servo sliders.
+(the sign correction [servo1, -servo2, -servo3] of the previous tinyik actuator is handled here)
+
+Geometry (same as the previous tinyik actuator):
+    1R: rotation along z axis, a short link of 1.5 cm in the z direction
+    2R: rotation along x axis, a link of 9.6 cm
+    3R: rotation along x axis, a link of 17.7 cm
+
+In servo degrees, the end effector is at:
+    r = 9.6*cos(servo2) + 17.7*cos(servo2 + servo3)
+    x = r*sin(servo1)
+    y = -r*cos(servo1)
+    z = 1.5 + 9.6*sin(servo2) + 17.7*sin(servo2 + servo3)
+'''
+#%%
+import numpy as np
+
+#######################################
+# robot geometry (cm)
+#######################################
+base_height = 1.5
+link2_length = 9.6
+link3_length = 17.7
+
+# rotation range (degrees) of servo 1/2/3
+servo_limits = np.array([[0., 180.], [0., 180.], [0., 180.]])
+
+# tolerance (degrees) when checking the servo limits, to absorb round-off
+limit_tolerance = 1e-6
+
+#######################################
+# helper functions
+#######################################
+def wrap_angles(angles, limits=servo_limits):
+    '''
+    Wraps angles (degrees) to the 360 degree window centred on the middle of the servo limits.
+    e.g. with limits [0, 180], -180 becomes 180 and 270 becomes -90.
+    '''
+    middle = limits.mean(axis=1)
+    return middle + np.mod(angles - middle + 180., 360.) - 180.
+
+def limit_violation(angles, limits=servo_limits):
+    '''
+    Returns how far (degrees) the angles are outside the servo limits, summed over the joints.
+    '''
+    below = np.clip(limits[:, 0] - angles, 0., None)
+    above = np.clip(angles - limits[:, 1], 0., None)
+    return (below + above).sum(axis=-1)
+
+#######################################
+# forward kinematics
+#######################################
+def forward_kinematics_batch(servo_angles):
+    '''
+    Calculates the end effector coordinates of N servo positions in one vectorised pass.
+        Parameters:
+                servo_angles (array): (N, 6) or (N, 3) servo angles (degrees), e.g. a whole trajectory file
+                                      only servo 1/2/3 are used, servo 4/5/6 are ignored
+
+        Returns:
+                coordinates (array): (N, 3) x,y,z coordinates of the end effector (cm)
+    '''
+    servo_angles = np.asarray(servo_angles, dtype=float)
+    servo_3angles = np.deg2rad(servo_angles.reshape(-1, servo_angles.shape[-1])[:, :3])
+    servo1, servo2, servo3 = servo_3angles[:, 0], servo_3angles[:, 1], servo_3angles[:, 2]
+
+    # planar 2-link arm: horizontal reach and height of the end effector
+    reach = link2_length * np.cos(servo2) + link3_length * np.cos(servo2 + servo3)
+    height = link2_length * np.sin(servo2) + link3_length * np.sin(servo2 + servo3)
+
+    # rotate the reach around the z axis by servo 1
+    return np.stack([reach * np.sin(servo1), -reach * np.cos(servo1), base_height + height], axis=-1)
+
+def forward_kinematics(servo_angles):
+    '''
+    Calculates the end effector coordinates of a single servo position (see `forward_kinematics_batch`).
+        Parameters:
+                servo_angles (array): (6,) or (3,) servo angles (degrees)
+
+        Returns:
+                coordinates (array): (3,) x,y,z coordinates of the end effector (cm)
+    '''
+    return forward_kinematics_batch(np.asarray(servo_angles)[:3])[0]
+
+#######################################
+# inverse kinematics
+#######################################
+def inverse_kinematics_batch(coordinates, elbow='auto', seed=None, limits=servo_limits):
+    '''
+    Solves the servo 1/2/3 angles for N end effector coordinates in one vectorised call.
+    There are up to 4 solutions for each coordinate (2 yaw branches x 2 elbow branches),
+    the solution within the servo limits is chosen; if several are valid, the one closest to `seed` wins.
+        Parameters:
+                coordinates (array): (N, 3) or (3,) x,y,z coordinates of the end effector (cm)
+                elbow (str): 'up' (servo 3 >= 0), 'down' (servo 3 <= 0) or 'auto' (either branch)
+                seed (array): (3,) or (N, 3) current servo 1/2/3 angles, used to pick the closest branch
+                limits (array): (3, 2) min/max angles of servo 1/2/3 (degrees)
+
+        Returns:
+                servo_3angles (array): (N, 3) servo 1/2/3 angles (degrees)
+                reachable (array): (N,) True if the coordinate is reachable within the servo limits
+                                   unreachable coordinates get the closest pose pointing towards the target
+    '''
+    if elbow not in ('auto', 'up', 'down'):
+        raise ValueError(f"elbow has to be 'auto', 'up' or 'down', got {elbow!r}")
+
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    x, y, z = coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]
+
+    # height relative to joint 2, and horizontal distance from the z axis
+    height = z - base_height
+    distance = np.hypot(x, y)
+    yaw = np.rad2deg(np.arctan2(x, -y))
+
+    # cosine of servo 3 from the law of cosines; outside [-1, 1] the target is out of reach
+    cos3 = (distance**2 + height**2 - link2_length**2 - link3_length**2) / (2 * link2_length * link3_length)
+    in_reach = np.abs(cos3) <= 1.
+    angle3 = np.rad2deg(np.arccos(np.clip(cos3, -1., 1.)))
+
+    elbow_signs = {'auto': (1., -1.), 'up': (1.,), 'down': (-1.,)}[elbow]
+
+    # build all candidate solutions, shape (branches, N, 3)
+    candidates = []
+    for yaw_flip in (False, True):
+        # the arm can also reach a target by turning the other way and bending backwards
+        servo1 = yaw + 180. if yaw_flip else yaw
+        reach = -distance if yaw_flip else distance
+        for elbow_sign in elbow_signs:
+            servo3 = elbow_sign * angle3
+            servo3_rad = np.deg2rad(servo3)
+            servo2 = np.rad2deg(np.arctan2(height, reach)
+                                - np.arctan2(link3_length * np.sin(servo3_rad), link2_length + link3_length * np.cos(servo3_rad)))
+            candidates.append(np.stack([servo1, servo2, servo3], axis=-1))
+    candidates = wrap_angles(np.stack(candidates), limits)
+
+    # prefer solutions within the servo limits, then the one closest to the seed
+    violation = limit_violation(candidates, limits)
+    valid = violation <= limit_tolerance
+    cost = np.where(valid, 0., 1e6 + violation)
+    if seed is not None:
+        seed = np.broadcast_to(np.asarray(seed, dtype=float), coordinates.shape)
+        difference = np.mod(candidates - seed + 180., 360.) - 180.
+        cost = cost + np.abs(difference).sum(axis=-1)
+
+    best = np.argmin(cost, axis=0)
+    index = np.arange(len(coordinates))
+    # never return angles the servos cannot reach
+    servo_3angles = np.clip(candidates[best, index], limits[:, 0], limits[:, 1])
+    reachable = in_reach & valid[best, index]
+
+    return servo_3angles, reachable
+
+def inverse_kinematics(coordinate, elbow='auto', seed=None, limits=servo_limits):
+    '''
+    Solves the servo 1/2/3 angles for a single end effector coordinate (see `inverse_kinematics_batch`).
+        Parameters:
+                coordinate (array): (3,) x,y,z coordinates of the end effector (cm)
+                elbow (str): 'up', 'down' or 'auto'
+                seed (array): (3,) current servo 1/2/3 angles, used to pick the closest branch
+                limits (array): (3, 2) min/max angles of servo 1/2/3 (degrees)
+
+        Returns:
+                servo_3angles (array): (3,) servo 1/2/3 angles (degrees)
+                reachable (bool): True if the coordinate is reachable within the servo limits
+    '''
+    servo_3angles, reachable = inverse_kinematics_batch(coordinate, elbow, seed, limits)
+    return servo_3angles[0], bool(reachable[0])
@@ -0,0 +1,277 @@
+#%%
+'''
+This module replays recipes on several arms at the same time, one `ArmController` per serial port.
+Each arm is connected and runs on its own worker thread, so a slow or stalled port only delays its own arm,
+and each arm has its own latency histograms and counters (`Instrumentation`).
+
+Start:
+The arms are released together by a start barrier, at a common start time `start_delay` after the last arm is ready.
+When uploading, an arm is ready once the first frames are in the buffer of its ESP32, so the upload time does not
+shift the start. An arm that fails before it is ready is left out, and after `ready_timeout` the barrier releases
+the arms that are ready without the late ones.
+
+Timeout:
+Each arm may take `timeout` seconds from the common start time, by default twice the duration of its trajectory
+plus `timeout_margin`. Opening the port, negotiating and loading the recipe may take `connect_timeout` seconds.
+An arm still running after its deadline is aborted and reported stalled, the other arms are not waited for.
+
+Results (one dict per arm, see `Orchestrator.run`):
+    status: 'finished', 'failed' (an exception, see 'error'), 'stalled' (still running after its deadline) or 'aborted'
+    start_offset: time (s) between the common start time and the start of the arm
+    duration: time (s) from the start of the arm to the end of its replay
+    expected_duration: duration (s) of the trajectory at the replay speed
+    stats: statistics of the replay or upload (see `ReplayEngine.stats` and `Uploader.stats`)
+    metrics: latency histograms and counters of the arm (see `Instrumentation.snapshot`)
+
+    Usage:
+            orchestrator = Orchestrator.connect({'left': 'COM3', 'right': 'COM4'})
+            results = orchestrator.run('heart/heart.txt')                       # the same recipe on all the arms
+            results = orchestrator.run({'left': 'heart/heart.txt', 'right': 'tulip/tulip.txt'})
+
+Command line:
+    python orchestrator.py heart/heart.txt --port left=COM3 --port right=COM4
+    python orchestrator.py heart/heart.txt tulip/tulip.txt --simulate 2 --speed 10    # simulated ESP32s
+'''
+#%%
+import threading
+import time
+
+from arm_controller import ArmController
+from instrumentation import Instrumentation, metrics as default_metrics
+
+#######################################
+# start barrier
+#######################################
+class StartBarrier:
+    '''
+    Releases the arms together at a common start time, once all the arms are ready or withdrawn,
+    or after `timeout` (s) without the late arms.
+    '''
+    def __init__(self, parties, timeout=10.0, start_delay=0.05, clock=time.monotonic, sleep=time.sleep):
+        self.remaining = parties
+        self.timeout = timeout
+        self.start_delay = start_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.start_time = None
+        self.condition = threading.Condition()
+
+    def release(self):
+        # called with the condition held
+        if self.start_time is None:
+            self.start_time = self.clock() + self.start_delay
+            self.condition.notify_all()
+
+    def wait(self):
+        # waits for the other arms, then until the start time, returns the start time
+        with self.condition:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.release()
+            elif not self.condition.wait_for(lambda: self.start_time is not None, self.timeout):
+                self.release()
+            start_time = self.start_time
+        delay = start_time - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        return start_time
+
+    def withdraw(self):
+        # an arm that will not start, the others do not wait for it
+        with self.condition:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.release()
+
+#######################################
+# orchestrator
+#######################################
+class Orchestrator:
+    def __init__(self, controllers, ports=None, start_delay=0.05, ready_timeout=10.0, connect_timeout=10.0,
+                 timeout_margin=10.0, clock=time.monotonic, sleep=time.sleep):
+        # controllers (dict): name of the arm -> `ArmController`, connected or with its port in `ports`
+        # ports (dict): name of the arm -> port, connected by the worker thread of the arm
+        self.controllers = dict(controllers)
+        self.ports = dict(ports or {})
+        self.start_delay = start_delay
+        self.ready_timeout = ready_timeout
+        self.connect_timeout = connect_timeout
+        self.timeout_margin = timeout_margin
+        self.clock = clock
+        self.sleep = sleep
+        self.results = {}
+
+    @classmethod
+    def connect(cls, ports, **options):
+        '''
+        Creates one controller per port, each with its own `Instrumentation`. The ports are opened and negotiated
+        by the worker threads of `run`, so a port that hangs while opening does not block the other arms.
+            Parameters:
+                    ports (dict): name of the arm -> port name (e.g. 'COM3') or opened port (e.g. `FakeSerial`)
+                    options: `ArmController` parameters, e.g. replay_speed, and `Orchestrator` parameters
+        '''
+        orchestrator_options = {key: options.pop(key) for key in ('start_delay', 'ready_timeout', 'connect_timeout',
+                                                                  'timeout_margin', 'clock', 'sleep')
+                                if key in options}
+        options.pop('metrics', None)
+        controllers = {name: ArmController(**options, metrics=Instrumentation(level=default_metrics.level))
+                       for name in ports}
+        return cls(controllers, ports, **orchestrator_options)
+
+    def close(self):
+        for controller in self.controllers.values():
+            controller.close()
+
+    def abort(self):
+        for controller in self.controllers.values():
+            if controller.running:
+                controller.abort()
+
+    #######################################
+    # replay
+    #######################################
+    def run(self, recipes, timeout=None):
+        '''
+        Replays the recipes on all the arms, starting together, and waits until they are done or past their deadline.
+            Parameters:
+                    recipes: a trajectory (file name, Trajectory or array) for all the arms,
+                             or a dict of arm name -> trajectory (the arms without a recipe do not move)
+                    timeout (float): time (s) each arm may take from the common start time, the arms still running
+                                     are aborted and reported stalled, defaults to twice the duration of the trajectory
+                                     plus `timeout_margin`
+
+            Returns:
+                    results (dict): arm name -> result (see the module docstring)
+        '''
+        if not isinstance(recipes, dict):
+            recipes = {name: recipes for name in self.controllers}
+        unknown = set(recipes) - set(self.controllers)
+        if unknown:
+            raise ValueError(f'unknown arms: {", ".join(sorted(unknown))}')
+
+        self.results = {}
+        names = list(recipes)
+        barrier = StartBarrier(len(names), self.ready_timeout, self.start_delay, self.clock, self.sleep)
+        workers = {}
+        for name in names:
+            # until the worker knows the duration of its trajectory: time to connect, load and start
+            self.results[name] = {'status': 'running', 'error': None,
+                                  'deadline': self.clock() + self.connect_timeout + self.ready_timeout + self.start_delay}
+            workers[name] = threading.Thread(target=self.run_arm, args=(name, recipes[name], barrier, timeout),
+                                             name=f'arm {name}', daemon=True)
+            workers[name].start()
+
+        # a worker blocked on its port never returns, it is reported stalled after its deadline
+        running = dict(workers)
+        while running:
+            for name, worker in list(running.items()):
+                worker.join(0.05 / len(running))
+                if not worker.is_alive():
+                    del running[name]
+                elif self.clock() > self.results[name]['deadline']:
+                    controller = self.controllers[name]
+                    if controller.running:
+                        controller.abort()
+                    self.results[name]['status'] = 'stalled'
+                    del running[name]
+        for result in self.results.values():
+            result.pop('deadline', None)
+        return self.results
+
+    def run_arm(self, name, recipe, barrier, timeout):
+        # worker thread of one arm
+        controller = self.controllers[name]
+        result = self.results[name]
+        ready = []
+        started = threading.Event()
+
+        def on_ready():
+            ready.append(True)
+            result['start_time'] = barrier.wait()
+            result['start_offset'] = self.clock() - result['start_time']
+            started.set()
+
+        try:
+            if name in self.ports and not controller.connected:
+                try:
+                    controller.connect(self.ports[name])
+                except Exception as error:
+                    raise RuntimeError(f'could not connect: {error}') from error
+            if isinstance(recipe, str):
+                recipe = controller.open_file(recipe)
+            positions = controller.play(recipe, on_ready)
+            result['frames'] = len(positions)
+            result['expected_duration'] = positions.duration(controller.replay_period) / controller.replay_speed
+            if timeout is None:
+                timeout = 2 * result['expected_duration'] + self.timeout_margin
+            # the timeout counts from the start, not from the upload of the first frames
+            deadline = self.clock() + self.ready_timeout + self.start_delay
+            result['deadline'] = deadline + timeout + 2.0
+            while not started.is_set() and controller.running and self.clock() < deadline:
+                started.wait(0.05)
+            finished = controller.wait(timeout)
+            if not finished:
+                controller.abort()
+                controller.wait(1.0)
+                result['status'] = 'stalled'
+            elif controller.error is not None:
+                result['status'] = 'failed'
+                result['error'] = str(controller.error)
+            else:
+                result['status'] = 'aborted' if controller.player.aborted else 'finished'
+        except Exception as error:
+            result['status'] = 'failed'
+            result['error'] = str(error)
+        finally:
+            if not ready:
+                barrier.withdraw()
+            if 'start_time' in result:
+                result['duration'] = self.clock() - result['start_time'] - result['start_offset']
+            result['stats'] = controller.stats()
+            result['metrics'] = controller.metrics.snapshot()
+
+def print_results(results):
+    for name, result in results.items():
+        timing = ''
+        if 'duration' in result:
+            timing = (f", start offset {result['start_offset'] * 1000:.1f} ms, "
+                      f"{result['duration']:.2f} s (expected {result['expected_duration']:.2f} s)")
+        error = f", {result['error']}" if result.get('error') else ''
+        print(f"{name}: {result['status']}{timing}{error}")
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replay recipes on several arms at the same time.')
+    parser.add_argument('recipes', nargs='+', help='one recipe for all the arms, or one recipe per arm')
+    parser.add_argument('--port', action='append', default=[], help='NAME=PORT, e.g. left=COM3, once per arm')
+    parser.add_argument('--simulate', type=int, default=0, help='number of simulated ESP32s instead of ports')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed')
+    parser.add_argument('--period', type=float, default=0.15, help='time (s) between two replayed frames')
+    parser.add_argument('--live', action='store_true', help='send the frames live instead of uploading the replays')
+    parser.add_argument('--timeout', type=float,
+                        help='abort the arms still running this many seconds after the start, '
+                             'defaults to twice the duration of the recipe plus 10 s')
+    args = parser.parse_args()
+
+    if args.simulate:
+        from esp32_simulator import ESP32Simulator, FakeSerial
+        ports = {f'arm{i + 1}': FakeSerial(ESP32Simulator(time.monotonic, log_ticks=False), port=f'simulated ESP32 {i + 1}')
+                 for i in range(args.simulate)}
+    else:
+        ports = dict(port.split('=', 1) for port in args.port)
+    if not ports:
+        parser.error('give the --port of each arm or --simulate')
+    if len(args.recipes) not in (1, len(ports)):
+        parser.error(f'give one recipe, or one recipe per arm ({len(ports)})')
+    recipes = args.recipes[0] if len(args.recipes) == 1 else dict(zip(ports, args.recipes))
+
+    orchestrator = Orchestrator.connect(ports, replay_period=args.period, replay_speed=args.speed,
+                                        upload_replay=not args.live)
+    try:
+        results = orchestrator.run(recipes, args.timeout)
+    except KeyboardInterrupt:
+        orchestrator.abort()
+        results = orchestrator.results
+    print_results(results)
+    orchestrator.close()
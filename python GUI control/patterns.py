@@ -0,0 +1,161 @@
+#%%
+'''
+This module generates the motion patterns of the jug (shaking, wiggling, rocking) from a few parameters.
+Each pattern is defined as offsets (cm) of the jug position around a base pose, in the horizontal plane,
+and converted to servo positions with batched inverse kinematics (servos 4-6 are kept from the base pose,
+except for `rock` which moves the wrist). The generated positions are memoized by their parameters,
+so trying variants of a pattern is instant.
+With `spout=True`, the offsets move the spout instead of the end of link 3, at the height and tilt of the base pose
+(servo 4 follows the arm to keep the tilt, see `tool_kinematics.py`), e.g. to draw a pattern while pouring.
+
+Patterns:
+    circle(radius, samples, turns, clockwise): `samples` points per turn, starting at -x like `!shake_jug.py`
+                                               (samples=4 gives the 4 points of the shake)
+    figure_eight(width, height, samples, cycles): figure eight (lemniscate) through the base position
+    spiral(start_radius, end_radius, turns, samples, clockwise): circle with a radius growing from start to end
+    zigzag(amplitude, length, zigs, samples, shape, axis): side to side wiggle while moving `length` cm along `axis`,
+                                                           e.g. the wiggle of a tulip or rosetta
+    rock(start, end, cycles, samples): sinusoidal rocking of the wrist (servo 4) between `start` and `end`
+
+    Usage:
+            trajectory = generate('circle', [90, 60, 110, 180, 90, 90], radius=2.5, samples=16, turns=2)
+            trajectory = generate('zigzag', [98, 68, 106, 99, 180, 106], spout=True, amplitude=1.0, length=3.0)
+
+Command line:
+    python patterns.py 6_pre_shake_easeinout10.txt circle_shake.txt circle radius=2.5 samples=16 turns=5
+'''
+#%%
+import functools
+
+import numpy as np
+
+from trajectory import Trajectory
+
+#######################################
+# patterns, offsets (cm) of the jug position around the base position
+#######################################
+def circle(radius=2.5, samples=16, turns=1, clockwise=True):
+    # clockwise seen from above: -x, +y, +x, -y
+    direction = -1 if clockwise else 1
+    angles = np.pi + direction * 2 * np.pi * np.arange(int(samples * turns)) / samples
+    return np.column_stack([radius * np.cos(angles), radius * np.sin(angles), np.zeros(len(angles))]), None
+
+def figure_eight(width=4.0, height=2.0, samples=32, cycles=1):
+    t = 2 * np.pi * np.arange(int(samples * cycles)) / samples
+    return np.column_stack([width / 2 * np.sin(t), height / 2 * np.sin(2 * t), np.zeros(len(t))]), None
+
+def spiral(start_radius=0.5, end_radius=3.0, turns=3, samples=16, clockwise=True):
+    n = int(samples * turns)
+    direction = -1 if clockwise else 1
+    angles = np.pi + direction * 2 * np.pi * np.arange(n) / samples
+    radius = np.linspace(start_radius, end_radius, n)
+    return np.column_stack([radius * np.cos(angles), radius * np.sin(angles), np.zeros(n)]), None
+
+def zigzag(amplitude=1.0, length=4.0, zigs=6, samples=4, shape='triangle', axis='x'):
+    # `samples` points per zig (one side to side and back), moving along `axis` and wiggling along the other axis
+    n = int(samples * zigs) + 1
+    phase = np.linspace(0, zigs, n)
+    if shape == 'triangle':
+        wiggle = amplitude * (4 * np.abs(phase - np.floor(phase + 0.75) + 0.25) - 1)
+    elif shape == 'sin':
+        wiggle = amplitude * np.sin(2 * np.pi * phase)
+    else:
+        raise ValueError(f'shape has to be "triangle" or "sin", got {shape!r}')
+    advance = np.linspace(0, length, n)
+    if axis == 'x':
+        return np.column_stack([advance, wiggle, np.zeros(n)]), None
+    if axis == 'y':
+        return np.column_stack([wiggle, advance, np.zeros(n)]), None
+    raise ValueError(f'axis has to be "x" or "y", got {axis!r}')
+
+def rock(start=145, end=180, cycles=5, samples=8):
+    # servo 4 starts at `end`, goes to `start` and back `cycles` times
+    t = 2 * np.pi * np.arange(int(samples * cycles) + 1) / samples
+    wrist = (end + start) / 2 + (end - start) / 2 * np.cos(t)
+    return np.zeros((len(t), 3)), wrist
+
+patterns = {'circle': circle, 'figure_eight': figure_eight, 'spiral': spiral, 'zigzag': zigzag, 'rock': rock}
+
+#######################################
+# servo positions
+#######################################
+@functools.lru_cache(maxsize=256)
+def _generate(name, base, parameters, spout=False):
+    import kinematics
+    import tool_kinematics
+
+    offsets, wrist = patterns[name](**dict(parameters))
+    base = np.array(base, dtype=float)
+    if spout and wrist is None:
+        # the spout moves, at the height and tilt of the base pose
+        coordinates, tilt = tool_kinematics.spout_pose(base)
+        targets = coordinates + offsets
+        positions, reachable = tool_kinematics.hold_spout_batch(targets[:, :2], targets[:, 2], tilt, base)
+        if not reachable.all():
+            print(f'Warning: {np.count_nonzero(~reachable)} spout positions of the {name} pattern are out of reach.')
+        positions = np.rint(positions).astype(Trajectory.dtype)
+        positions.flags.writeable = False
+        return positions
+
+    coordinates = kinematics.forward_kinematics(base[:3]) + offsets
+    angles, reachable = kinematics.inverse_kinematics_batch(coordinates, seed=base[:3])
+    if not reachable.all():
+        print(f'Warning: {np.count_nonzero(~reachable)} positions of the {name} pattern are out of reach.')
+
+    positions = np.tile(base, (len(offsets), 1))
+    positions[:, :3] = angles
+    if wrist is not None:
+        positions[:, 3] = wrist
+    positions = np.rint(positions).astype(Trajectory.dtype)
+    positions.flags.writeable = False
+    return positions
+
+def generate(name, base, period=None, spout=False, **parameters):
+    '''
+    Generates the servo positions of a pattern around a base pose.
+        Parameters:
+                name (str): one of `patterns`
+                base (list): 6 servo angles of the base pose, e.g. the last position before shaking
+                period (float): period (s) of the positions, optional
+                spout (bool): move the spout at a constant height and tilt instead of the end of link 3
+                parameters: parameters of the pattern, see the module docstring
+
+        Returns:
+                trajectory (Trajectory): the positions of the pattern
+    '''
+    if name not in patterns:
+        raise ValueError(f'unknown pattern {name!r}, available: {", ".join(patterns)}')
+    base = tuple(int(round(angle)) for angle in base)
+    if len(base) != Trajectory.n_servos:
+        raise ValueError(f'expected {Trajectory.n_servos} servo angles for the base pose, got {len(base)}')
+    positions = _generate(name, base, tuple(sorted(parameters.items())), bool(spout))
+    return Trajectory(positions, period)
+
+def cache_info():
+    return _generate.cache_info()
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Generate a motion pattern around the last position of a trajectory file.')
+    parser.add_argument('source', help='trajectory file, its last position is the base pose')
+    parser.add_argument('output')
+    parser.add_argument('pattern', choices=list(patterns))
+    parser.add_argument('parameters', nargs='*', help='pattern parameters, e.g. radius=2.5 samples=16')
+    args = parser.parse_args()
+
+    parameters = {}
+    for parameter in args.parameters:
+        # numbers and booleans, anything else is a string, e.g. shape=sin
+        key, value = parameter.split('=', 1)
+        try:
+            parameters[key] = json.loads(value.lower() if value in ('True', 'False') else value)
+        except ValueError:
+            parameters[key] = value
+
+    base = Trajectory.load(args.source).last
+    trajectory = generate(args.pattern, base, **parameters)
+    trajectory.save(args.output)
+    print(f'{args.pattern}: {len(trajectory)} positions')
+    print('saved: ' + args.output)
@@ -0,0 +1,480 @@
+#%%
+'''
+This module chains the helper actions (shorten, interpolate, shake, rock, concat) as stages of a pipeline.
+Each stage is a generator taking the frames (servo positions) of the previous stage,
+so a whole recipe is built in memory in one pass without writing intermediate txt files.
+
+Stages:
+    decimate(step): keep one action every `step` actions (was !shorten.py)
+    simplify(tolerance, space): keep the actions needed to stay within a tolerance, holding them (see simplify.py)
+    ease(steps): sin ease-in-out between the first and last action with `steps` actions (was !interpolation.py)
+    interpolate(steps, profile, space): minimum-jerk/cubic spline through the actions with `steps` actions (see interpolation.py)
+    shake(radius, speed_num, num, clockwise): shake the jug around the last action (was !shake_jug.py)
+    rock(start, end, steps, num): rock the wrist (servo 4) at the last action (was !rock_jug.py)
+    pattern(name, repeat, spout, ...): a pattern of patterns.py (circle, figure_eight, spiral, zigzag, rock) at the last action,
+                                       drawn with the spout at a constant height and tilt with "spout": true
+    concat: chain several segments (was !concat.py)
+
+Recipe:
+A recipe is a json file listing the segments of a pour in order, e.g.
+    {
+        "output": "heart.txt",
+        "segments": [
+            {"name": "1_first_turn_step10", "source": "original_actions/1_first_turn.txt", "stages": [{"stage": "decimate", "step": 10}]},
+            {"name": "3_tilt_cup", "source": "3_tilt_cup.txt"},
+            {"name": "7_shake_jug", "from": "6_pre_shake_easeinout10", "stages": [{"stage": "shake", "radius": 2.5}]}
+        ]
+    }
+`source` is a trajectory file (relative to the recipe file), `from` uses the output of an earlier segment.
+Segments with "include": false are only used as input of other segments.
+
+Retiming:
+Segments with "retime": true (e.g. moving the jug between two pours) are retimed with `retime.py`, the other segments
+keep the replay period. The limits are set for the whole recipe, e.g.
+    "period": 0.15,
+    "retime": {"max_lag": 20}    (or "max_velocity", "max_acceleration", "min_duration")
+The timestamps are only saved if the output is a .traj file.
+
+Holds:
+With "collapse_holds": true, repeated positions are saved as one frame with its dwell time (see `Trajectory.collapse_holds`),
+so the replay waits without sending them again. Like the retimed recipes, the output has to be a .traj file.
+After a "simplify" stage, each kept action is then sent once and held as long as the actions it replaced
+(without "collapse_holds" the simplified segment has as many actions as its input, only the holds shrink it).
+
+Preflight:
+The built recipe is checked before it is saved (see `preflight.py`): a recipe with angles outside the servo range or
+frames below the table is not saved, the other issues (e.g. moves cut short by the smoothing of the firmware)
+are printed as warnings.
+The checks can be set for the whole recipe, e.g.
+    "preflight": {"max_lag": 20, "table_height": 0}    (or "max_velocity", "max_acceleration"), or false to skip them
+
+Build cache:
+When building with a cache directory (default: .recipe_cache next to the recipe file),
+the output of each segment is saved under a hash of its inputs: the content of the source file
+(or the hash of the `from` segment), the stage parameters and the code of the stages.
+Only the segments whose recording or parameters changed are recomputed, the others are loaded from the cache.
+
+Command line:
+    python pipeline.py build heart/heart_recipe.json
+    python pipeline.py build heart/heart_recipe.json --no-cache
+    python pipeline.py run original_actions/1_first_turn.txt 1_first_turn_step10.txt --stage decimate step=10
+'''
+#%%
+import functools
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+
+import preflight
+import retime
+import trajectory_io
+from trajectory import Trajectory
+
+#######################################
+# helper functions
+#######################################
+def frames_of(source):
+    '''
+    Yields the frames of a trajectory file (streamed in chunks if it is a txt file), a Trajectory or an array.
+    '''
+    if isinstance(source, str):
+        if trajectory_io.is_binary(source):
+            yield from trajectory_io.read_binary(source)
+        else:
+            for block in trajectory_io.iter_text(source):
+                yield from block
+    else:
+        yield from np.asarray(source)
+
+def collect(frames, period=None, source=None):
+    '''
+    Collects the frames of a stage into a Trajectory.
+    '''
+    trajectory = Trajectory(period=period, source=source)
+    for frame in frames:
+        trajectory.append(frame)
+    return trajectory
+
+def last_frame(frames):
+    # consume the frames and return the last one
+    last = None
+    for last in frames:
+        pass
+    if last is None:
+        raise ValueError('the stage needs at least one action as input')
+    return np.array(last)
+
+#######################################
+# stages
+#######################################
+def decimate(frames, step):
+    '''
+    Keeps one action every `step` actions, starting with the first one.
+    '''
+    return itertools.islice(frames, 0, None, step)
+
+def simplify(frames, tolerance=1.0, space='joint', mode='hold', wrist_tolerance=1.0):
+    '''
+    Keeps the actions needed to stay within `tolerance` (degrees, or cm of the jug in cartesian space)
+    of the input, see `simplify.py`. The stage keeps the timing: each kept action is repeated until the next one,
+    so the output has as many actions as the input. Only with "collapse_holds": true the output shrinks,
+    each kept action is then sent once with its dwell time.
+    The stages pass actions without timestamps, so the 'linear' mode (the replay interpolates between the kept
+    actions) is only available with `python simplify.py`, which saves the kept actions with their timestamps.
+    '''
+    import simplify as simplification
+
+    if mode != 'hold':
+        raise ValueError(f'the simplify stage only supports mode "hold", got {mode!r}, '
+                         'use simplify.py to save a linear simplification with its timestamps')
+    positions = np.array(list(frames)).reshape(-1, Trajectory.n_servos)
+    if len(positions) == 0:
+        return
+    indices = simplification.simplify_indices(positions, tolerance, space, mode, wrist_tolerance)
+    # number of input actions each kept action stands for
+    holds = np.diff(np.append(indices, len(positions)))
+    yield from np.repeat(positions[indices], holds, axis=0)
+
+def ease(frames, steps):
+    '''
+    Interpolates `steps` actions (including the first and last) between the first and last action,
+    with a sin ease-in-out function (see https://easings.net/).
+    '''
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        raise ValueError('ease needs at least one action as input')
+    first = np.array(first, dtype=float)
+    last = last_frame(itertools.chain([first], frames))
+
+    x_values = np.linspace(0, 1, steps).reshape(steps, 1)
+    ease_in_out = 0.5 * (1 - np.cos(x_values * np.pi))
+    interpolated = ease_in_out * (last - first) + first
+    # truncate to integers, same as the original !interpolation.py
+    yield from interpolated.astype(int)
+
+def interpolate(frames, steps, profile='minimum_jerk', space='joint', all_waypoints=False):
+    '''
+    Interpolates `steps` actions (including the first and last) through the first and last action,
+    or through all the actions with `all_waypoints`, see `interpolation.py` for the profiles and spaces.
+    With 1 step, only the last action is kept. Unlike `ease`, the angles are rounded.
+    '''
+    import interpolation
+
+    if steps < 1:
+        raise ValueError(f'interpolate needs at least 1 step, got {steps}')
+    waypoints = np.array(list(frames)).reshape(-1, Trajectory.n_servos)
+    if len(waypoints) == 0:
+        raise ValueError('interpolate needs at least one action as input')
+    if steps == 1:
+        # just the end of the motion
+        yield np.rint(waypoints[-1]).astype(waypoints.dtype)
+        return
+    if not all_waypoints:
+        waypoints = waypoints[[0, -1]]
+    # one action per time unit, so the motion has `steps` actions
+    yield from interpolation.interpolate(waypoints, steps - 1, 1.0, profile=profile, space=space)
+
+def shake(frames, radius=2.5, speed_num=1, num=5, clockwise=True):
+    '''
+    Shakes the jug by quickly stopping by 4 points (±x, ±y) of a circle with `radius` (cm) around the last action.
+    Each point is held for `speed_num` actions, the circle is repeated `num` times.
+    '''
+    import kinematics
+
+    last = last_frame(frames)
+    coordinates = np.round(kinematics.forward_kinematics(last[:3]), decimals = 1)
+
+    minus_x = coordinates - np.array([radius, 0, 0])
+    plus_y = coordinates + np.array([0, radius, 0])
+    plus_x = coordinates + np.array([radius, 0, 0])
+    minus_y = coordinates - np.array([0, radius, 0])
+    if clockwise:
+        new_coordinates = [minus_x, plus_y, plus_x, minus_y]
+    else:
+        new_coordinates = [plus_x, plus_y, minus_x, minus_y]
+
+    new_3angles, reachable = kinematics.inverse_kinematics_batch(new_coordinates, seed=last[:3])
+    if not reachable.all():
+        print(f'Warning: shake radius {radius} cm is out of reach.')
+    new_3angles = np.repeat(np.round(new_3angles), speed_num, axis=0)
+
+    one_shake = np.tile(last, (len(new_3angles), 1))
+    one_shake[:, :3] = new_3angles
+    for i in range(num):
+        yield from one_shake
+
+def rock(frames, start=145, end=180, steps=1, num=5):
+    '''
+    Rocks the jug by rotating the wrist (servo 4) from `end` to `start` and back in `steps` steps, `num` times,
+    at the last action.
+    '''
+    last = last_frame(frames)
+    step_size = int((end - start)/steps)
+    step_index = np.arange(1, steps + 1)
+    one_rock = np.concatenate([[end], end - step_index*step_size, end - steps*step_size + step_index*step_size])
+
+    positions = np.tile(last, (len(one_rock), 1))
+    positions[:, 3] = one_rock
+    for i in range(num):
+        yield from positions
+
+def pattern(frames, name, repeat=1, **parameters):
+    '''
+    Generates the pattern `name` (see `patterns.py`) around the last action, `repeat` times.
+    '''
+    import patterns
+
+    last = last_frame(frames)
+    positions = patterns.generate(name, last, **parameters).positions
+    for i in range(repeat):
+        yield from positions
+
+def concat(*streams):
+    return itertools.chain(*streams)
+
+stages = {'decimate': decimate, 'simplify': simplify, 'ease': ease, 'interpolate': interpolate,
+          'shake': shake, 'rock': rock, 'pattern': pattern}
+
+def apply_stages(frames, stage_specs):
+    '''
+    Chains the stages, e.g. [{"stage": "decimate", "step": 10}, {"stage": "ease", "steps": 20}].
+    '''
+    for spec in stage_specs:
+        parameters = dict(spec)
+        name = parameters.pop('stage')
+        if name not in stages:
+            raise ValueError(f'unknown stage {name!r}, available stages: {", ".join(stages)}')
+        frames = stages[name](frames, **parameters)
+    return frames
+
+#######################################
+# build cache
+#######################################
+default_cache_dir = '.recipe_cache'
+
+def file_hash(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def code_hash():
+    # the stages (and the kinematics and simplification they use) are part of the cache key,
+    # so changing their code invalidates the cache
+    directory = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for name in ('pipeline.py', 'kinematics.py', 'tool_kinematics.py', 'simplify.py', 'interpolation.py', 'patterns.py'):
+        h.update(file_hash(os.path.join(directory, name)).encode())
+    return h.hexdigest()
+
+#######################################
+# recipes
+#######################################
+class Recipe:
+    '''
+    A pour built from the segments of a recipe json file (see the module docstring).
+        Parameters:
+                spec (dict): the recipe
+                directory (str): directory the file names of the recipe are relative to
+                cache_dir (str): directory of the build cache, relative to `directory`, None to disable the cache
+    '''
+    def __init__(self, spec, directory='.', cache_dir=None):
+        self.spec = spec
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.segments = {segment['name']: segment for segment in spec['segments']}
+        if len(self.segments) != len(spec['segments']):
+            raise ValueError('segment names have to be unique')
+        self.outputs = {}
+        self.keys = {}
+
+        # names of the segments loaded from the cache or recomputed during the build
+        self.cached = []
+        self.rebuilt = []
+        # checks of the last build
+        self.preflight_report = None
+
+    @classmethod
+    def load(cls, filename, cache_dir=None):
+        with open(filename) as f:
+            spec = json.load(f)
+        return cls(spec, os.path.dirname(os.path.abspath(filename)), cache_dir)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def input_frames(self, segment):
+        if 'source' in segment:
+            return frames_of(self.path(segment['source']))
+        if 'from' in segment:
+            return iter(self.segment(segment['from']))
+        raise ValueError(f'segment {segment["name"]!r} needs a "source" or "from"')
+
+    def segment_frames(self, name):
+        # stream the frames of one segment
+        segment = self.segments[name]
+        return apply_stages(self.input_frames(segment), segment.get('stages', []))
+
+    def segment_key(self, name):
+        # hash of everything the output of the segment depends on
+        if name not in self.keys:
+            segment = self.segments[name]
+            h = hashlib.sha256()
+            h.update(code_hash().encode())
+            h.update(json.dumps(segment.get('stages', []), sort_keys=True).encode())
+            if 'source' in segment:
+                h.update(file_hash(self.path(segment['source'])).encode())
+            elif 'from' in segment:
+                h.update(self.segment_key(segment['from']).encode())
+            self.keys[name] = h.hexdigest()[:16]
+        return self.keys[name]
+
+    def cache_path(self, name):
+        return os.path.join(self.path(self.cache_dir), f'{name}-{self.segment_key(name)}{trajectory_io.binary_extension}')
+
+    def segment(self, name):
+        # the frames of one segment, kept in memory because other segments use them
+        if name in self.outputs:
+            return self.outputs[name]
+        if self.cache_dir is None:
+            self.outputs[name] = collect(self.segment_frames(name), source=name)
+            return self.outputs[name]
+
+        cache_path = self.cache_path(name)
+        if os.path.exists(cache_path):
+            self.outputs[name] = Trajectory.load(cache_path)
+            self.cached.append(name)
+        else:
+            self.outputs[name] = collect(self.segment_frames(name), source=name)
+            self.rebuilt.append(name)
+            self.save_cache(name, cache_path)
+        return self.outputs[name]
+
+    def save_cache(self, name, cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # remove the outdated outputs of this segment
+        prefix = f'{name}-'
+        for filename in os.listdir(os.path.dirname(cache_path)):
+            stale = filename[len(prefix):-len(trajectory_io.binary_extension)]
+            if filename.startswith(prefix) and len(stale) == 16 and '-' not in stale:
+                os.remove(os.path.join(os.path.dirname(cache_path), filename))
+        # write to a temporary file first, so an interrupted build does not leave a broken cache entry
+        temporary_path = cache_path + '.tmp'
+        trajectory_io.write_binary(temporary_path, self.outputs[name].positions)
+        os.replace(temporary_path, cache_path)
+
+    def frames(self):
+        # stream the frames of all the included segments
+        # with the cache, every segment is loaded from (or saved to) the cache instead
+        streams = []
+        for segment in self.spec['segments']:
+            if not segment.get('include', True):
+                continue
+            if self.cache_dir is not None or segment['name'] in self.referenced():
+                streams.append(iter(self.segment(segment['name'])))
+            else:
+                streams.append(self.segment_frames(segment['name']))
+        return concat(*streams)
+
+    def referenced(self):
+        return {segment['from'] for segment in self.spec['segments'] if 'from' in segment}
+
+    def included(self):
+        return [segment for segment in self.spec['segments'] if segment.get('include', True)]
+
+    def retimed(self):
+        # all the actions, with the segments marked "retime" retimed and the others at the replay period
+        parts = [self.segment(segment['name']) for segment in self.included()]
+        keep = np.concatenate([np.full(len(part), not segment.get('retime', False))
+                               for segment, part in zip(self.included(), parts)])
+        trajectory = Trajectory.concatenate(parts)
+        trajectory.period = self.spec.get('period', 0.15)
+        trajectory.source = self.spec.get('name')
+
+        limits = dict(self.spec.get('retime', {}))
+        velocity, acceleration = retime.calibrate_limits(limits.pop('max_lag', 20.0))
+        limits.setdefault('max_velocity', velocity)
+        limits.setdefault('max_acceleration', acceleration)
+        return retime.retime(trajectory, keep=keep, **limits)
+
+    def check(self, trajectory):
+        # preflight checks of the built actions, before the holds are collapsed, raises ValueError on errors
+        options = self.spec.get('preflight', {})
+        if options is False:
+            return None
+        options = dict(options)
+        if 'table_height' in options:
+            options['keep_out'] = np.array([preflight.below(options.pop('table_height'))])
+        self.preflight_report = preflight.validate(trajectory, self.spec.get('period', 0.15), **options)
+        if not self.preflight_report.ok:
+            raise ValueError(f"recipe {self.spec.get('name', '')} did not pass the preflight checks\n"
+                             + self.preflight_report.summary())
+        return self.preflight_report
+
+    def build(self, output=None):
+        '''
+        Builds the recipe and saves it to `output` (defaults to the "output" of the recipe).
+            Returns:
+                    trajectory (Trajectory): all the actions of the recipe
+        '''
+        if any(segment.get('retime', False) for segment in self.included()):
+            trajectory = self.retimed()
+        else:
+            trajectory = collect(self.frames(), source=self.spec.get('name'))
+        self.check(trajectory)
+        if self.spec.get('collapse_holds', False):
+            trajectory = trajectory.collapse_holds(self.spec.get('period', 0.15))
+        output = output or self.spec.get('output')
+        if output:
+            trajectory.save(self.path(output))
+        return trajectory
+
+#######################################
+# command line
+#######################################
+def parse_stage(text):
+    # 'decimate step=10' -> {'stage': 'decimate', 'step': 10}
+    name, *parameters = text.split()
+    spec = {'stage': name}
+    for parameter in parameters:
+        key, value = parameter.split('=', 1)
+        spec[key] = json.loads(value.lower() if value in ('True', 'False') else value)
+    return spec
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build latte art recipes from recorded actions.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='build a recipe json file')
+    build_parser.add_argument('recipe')
+    build_parser.add_argument('-o', '--output', help='output file, relative to the recipe file')
+    build_parser.add_argument('--cache-dir', default=default_cache_dir, help='build cache directory, relative to the recipe file')
+    build_parser.add_argument('--no-cache', action='store_true', help='recompute all the segments')
+
+    run_parser = subparsers.add_parser('run', help='apply stages to one trajectory file')
+    run_parser.add_argument('source')
+    run_parser.add_argument('output')
+    run_parser.add_argument('--stage', action='append', nargs='+', default=[],
+                            help='stage name and parameters, e.g. --stage ease steps=20')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        recipe = Recipe.load(args.recipe, None if args.no_cache else args.cache_dir)
+        trajectory = recipe.build(args.output)
+        print(f'built {args.recipe}: {len(trajectory)} actions')
+        if recipe.preflight_report is not None and recipe.preflight_report.checks:
+            print(recipe.preflight_report.summary())
+        if not args.no_cache:
+            print(f'segments rebuilt: {len(recipe.rebuilt)}, loaded from cache: {len(recipe.cached)}')
+            for name in recipe.rebuilt:
+                print('rebuilt: ' + name)
+    else:
+        stage_specs = [parse_stage(' '.join(stage)) for stage in args.stage]
+        trajectory = collect(apply_stages(frames_of(args.source), stage_specs))
+        trajectory.save(args.output)
+        print(f'saved {args.output}: {len(trajectory)} actions')
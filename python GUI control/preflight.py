@@ -0,0 +1,279 @@
+#%%
+'''
+This module checks a whole trajectory before it is replayed, so bad frames are found on the desk instead of mid-pour.
+Every check is one vectorised pass over the (N, 6) positions and reports the exact frames with the reason.
+
+Checks:
+    errors (the trajectory is not replayed):
+        width: frames without 6 servo angles
+        finite: angles that are not numbers (nan, inf)
+        joint_limits: angles outside the rotation range of the servos (0-180 degrees)
+        keep_out: the jug (end of servo 1-3, see `kinematics.py`) inside a keep-out zone, by default below the table
+    warnings (reported, the trajectory is replayed):
+        slider_range: angles outside the range of the GUI sliders (servo 6: 60-90 degrees)
+        lag: servos turning back more than `max_lag` degrees before reaching their target: the smoothing filter of the
+             firmware (see `retime.py`) follows the targets with a lag and cuts the motion short,
+             reported at the frame that turns back. A servo lagging behind a target it keeps moving towards,
+             or that is held, catches up and is not reported.
+        velocity, acceleration: only with explicit `max_velocity` / `max_acceleration`, the angle changes between
+                                the frames above the limits, e.g. to check a retimed trajectory against its limits
+        time: timestamps that do not increase
+The lag, velocity and acceleration are only checked if the trajectory has timestamps or a period.
+
+    Usage:
+            report = validate(Trajectory.load('heart/heart.txt'), period=0.15)
+            report.ok                       # no errors
+            report.frames('lag')            # indices of the frames turning back before the servos caught up
+            report.issues()                 # [(frame, check, reason), ...] sorted by frame
+            print(report.summary())
+
+Command line:
+    python preflight.py heart/heart.txt tulip/tulip.txt --period 0.15
+'''
+#%%
+import numpy as np
+
+import kinematics
+import retime
+
+n_servos = 6
+
+# rotation range (degrees) of the servos
+servo_limits = np.array([[0., 180.]] * n_servos)
+# range (degrees) of the GUI sliders, servo 6 only spans 60-90
+slider_limits = np.array([[0., 180.]] * 5 + [[60., 90.]])
+# height (cm) of the table, the jug must stay above it
+table_height = 0.0
+def below(height):
+    # keep-out zone below a height (cm), e.g. the table
+    return np.array([[-np.inf, np.inf], [-np.inf, np.inf], [-np.inf, height]])
+
+# (K, 3, 2) min/max x,y,z (cm) of the keep-out zones
+keep_out_zones = np.array([below(table_height)])
+
+errors = ('width', 'finite', 'joint_limits', 'keep_out')
+
+#######################################
+# report
+#######################################
+class PreflightReport:
+    def __init__(self, n_frames):
+        self.n_frames = n_frames
+        # check name -> (frames, details), one entry per flagged frame
+        self.checks = {}
+
+    def add(self, check, frames, reasons):
+        # `reasons(i)` formats the reason of the i-th flagged frame, only called when the issues are listed
+        if len(frames):
+            self.checks[check] = (np.asarray(frames), reasons)
+
+    @property
+    def ok(self):
+        return not any(check in self.checks for check in errors)
+
+    @property
+    def errors(self):
+        return [check for check in self.checks if check in errors]
+
+    @property
+    def warnings(self):
+        return [check for check in self.checks if check not in errors]
+
+    def frames(self, check=None):
+        # sorted indices of the flagged frames, of one check or of all of them
+        if check is not None:
+            return self.checks[check][0] if check in self.checks else np.zeros(0, dtype=int)
+        if not self.checks:
+            return np.zeros(0, dtype=int)
+        return np.unique(np.concatenate([frames for frames, _ in self.checks.values()]))
+
+    def issues(self, check=None, limit=None):
+        '''
+        The flagged frames with their reasons.
+            Returns:
+                    issues (list): (frame index, check name, reason), sorted by frame
+        '''
+        issues = []
+        for name, (frames, reasons) in self.checks.items():
+            if check is not None and name != check:
+                continue
+            count = len(frames) if limit is None else min(limit, len(frames))
+            issues.extend((int(frames[i]), name, reasons(i)) for i in range(count))
+        return sorted(issues, key=lambda issue: issue[0])
+
+    def summary(self, examples=3):
+        lines = [f'preflight: {self.n_frames} frames, {len(self.errors)} errors, {len(self.warnings)} warnings']
+        for name, (frames, reasons) in self.checks.items():
+            level = 'error' if name in errors else 'warning'
+            shown = ', '.join(str(frame) for frame in frames[:examples]) + (', ...' if len(frames) > examples else '')
+            lines.append(f'    {level} {name}: {len(frames)} frames ({shown}), e.g. frame {frames[0]}: {reasons(0)}')
+        return '\n'.join(lines)
+
+#######################################
+# validation
+#######################################
+def validate(positions, period=None, times=None, max_lag=20.0, max_velocity=None, max_acceleration=None,
+             limits=servo_limits, sliders=slider_limits, keep_out=keep_out_zones):
+    '''
+    Checks a whole trajectory, see the module docstring.
+        Parameters:
+                positions (Trajectory, array or list): (N, 6) servo angles
+                period (float): time (s) between two frames, if the trajectory has no timestamps
+                times (array): (N,) timestamps (s), defaults to the timestamps of the trajectory
+                max_lag (float): largest lag (degrees) of the servos behind a target when they turn back
+                max_velocity (float or array): degrees per second, per servo if an array, None to skip the check
+                max_acceleration (float or array): degrees per second squared, None to skip the check
+                limits (array): (6, 2) rotation range of the servos (degrees)
+                sliders (array): (6, 2) range of the sliders (degrees), None to skip the check
+                keep_out (array): (K, 3, 2) keep-out zones (cm), None to skip the check
+
+        Returns:
+                report (PreflightReport): the flagged frames and their reasons
+    '''
+    if hasattr(positions, 'frame_times'):
+        # a Trajectory, with its timestamps or its period
+        if times is None and (positions.times is not None or (period or positions.period) is not None):
+            times = positions.frame_times(period)
+        positions = positions.positions
+    elif times is None and period is not None:
+        times = np.arange(len(positions)) * float(period)
+
+    # frame width, a ragged list cannot be checked any further (a flat list is a single frame)
+    if not isinstance(positions, np.ndarray) and any(np.ndim(frame) for frame in positions):
+        widths = np.array([np.size(frame) for frame in positions], dtype=int)
+        if np.any(widths != n_servos):
+            report = PreflightReport(len(widths))
+            frames = np.flatnonzero(widths != n_servos)
+            report.add('width', frames, lambda i: f'{widths[frames[i]]} values, expected {n_servos} servo angles')
+            return report
+    positions = np.asarray(positions, dtype=float)
+    if positions.ndim and len(positions) == 0:
+        # no frames (e.g. an empty list), nothing to check
+        return PreflightReport(0)
+    if positions.ndim == 1:
+        # a single frame
+        positions = positions.reshape(1, -1)
+    if positions.ndim != 2 or positions.shape[1] != n_servos:
+        report = PreflightReport(len(positions) if positions.ndim else 0)
+        width = positions.shape[-1] if positions.ndim else 0
+        report.add('width', np.arange(report.n_frames),
+                   lambda i: f'{width} values, expected {n_servos} servo angles')
+        return report
+    report = PreflightReport(len(positions))
+
+    # angles that are not numbers, left out of the other checks
+    finite = np.isfinite(positions)
+    check_range(report, 'finite', ~finite, positions, None,
+                lambda servo, angle, low, high: f'servo {servo} is {angle}')
+    positions = np.where(finite, positions, limits.mean(axis=1))
+
+    outside_limits = (positions < limits[:, 0]) | (positions > limits[:, 1])
+    check_range(report, 'joint_limits', outside_limits, positions, limits,
+                lambda servo, angle, low, high: f'servo {servo} at {angle:g}, outside the servo range {low:g}-{high:g}')
+    if sliders is not None:
+        outside_sliders = ((positions < sliders[:, 0]) | (positions > sliders[:, 1])) & ~outside_limits
+        check_range(report, 'slider_range', outside_sliders, positions, sliders,
+                    lambda servo, angle, low, high: f'servo {servo} at {angle:g}, outside the slider range {low:g}-{high:g}')
+
+    if keep_out is not None and len(keep_out):
+        check_keep_out(report, positions, np.asarray(keep_out, dtype=float))
+
+    if times is not None and len(positions) > 1:
+        check_dynamics(report, positions, np.asarray(times, dtype=float), max_lag, max_velocity, max_acceleration)
+    return report
+
+def check_range(report, check, outside, positions, limits, describe):
+    # one entry per frame with at least one servo outside, the first servo is reported
+    frames = np.flatnonzero(outside.any(axis=1))
+    servos = outside[frames].argmax(axis=1)
+    angles = positions[frames, servos]
+    bounds = limits[servos] if limits is not None else np.zeros((len(frames), 2))
+    report.add(check, frames, lambda i: describe(servos[i] + 1, angles[i], *bounds[i]))
+
+def check_keep_out(report, positions, keep_out):
+    coordinates = kinematics.forward_kinematics_batch(positions)
+    # (N, K): the jug is inside the zone along all 3 axes
+    inside = np.all((coordinates[:, None, :] >= keep_out[None, :, :, 0]) &
+                    (coordinates[:, None, :] <= keep_out[None, :, :, 1]), axis=2)
+    frames = np.flatnonzero(inside.any(axis=1))
+    zones = inside[frames].argmax(axis=1)
+    report.add('keep_out', frames,
+               lambda i: f'jug at ({", ".join(f"{value:.1f}" for value in coordinates[frames[i]])}) cm, '
+                         f'inside keep-out zone {zones[i]}')
+
+def check_dynamics(report, positions, times, max_lag, max_velocity=None, max_acceleration=None):
+    durations = np.diff(times)
+    if np.any(durations <= 0):
+        frames = np.flatnonzero(durations <= 0) + 1
+        report.add('time', frames, lambda i: f'timestamp {times[frames[i]]:g} s does not increase')
+        durations = np.maximum(durations, 1e-9)
+        times = np.concatenate([[times[0]], times[0] + np.cumsum(durations)])
+
+    # lag of the servos behind each target when the next frame arrives, flagged where the next target turns back
+    lags = positions[:-1] - retime.smoothed_positions(positions, times)[1:]
+    steps = np.diff(positions, axis=0)
+    cut = (steps * lags < 0) & (np.abs(lags) > max_lag)
+    frames = np.flatnonzero(cut.any(axis=1))
+    servos = np.where(cut[frames], np.abs(lags[frames]), -1).argmax(axis=1)
+    missed = np.abs(lags[frames, servos])
+    report.add('lag', frames + 1,
+               lambda i: f'servo {servos[i] + 1} turns back {missed[i]:.0f} degrees before reaching the target of '
+                         f'frame {frames[i]}, the smoothing filter of the firmware cuts the motion short')
+
+    # velocity of each servo from a frame to the next one, reported at the frame that is reached
+    if max_velocity is None:
+        velocities = None
+    else:
+        max_velocity = np.broadcast_to(np.asarray(max_velocity, dtype=float), (n_servos,))
+        velocities = steps / durations[:, None]
+        ratio = np.abs(velocities) / max_velocity
+        frames = np.flatnonzero((ratio > 1).any(axis=1))
+        servos = ratio[frames].argmax(axis=1)
+        speeds = np.abs(velocities[frames, servos])
+        report.add('velocity', frames + 1,
+                   lambda i: f'servo {servos[i] + 1} moves {speeds[i]:.0f} deg/s, '
+                             f'the limit is {max_velocity[servos[i]]:.0f} deg/s')
+
+    # velocity change divided by the time between the middles of the frames, like `retime.minimal_durations`
+    if max_acceleration is None or len(steps) < 2:
+        return
+    if velocities is None:
+        velocities = steps / durations[:, None]
+    max_acceleration = np.broadcast_to(np.asarray(max_acceleration, dtype=float), (n_servos,))
+    accelerations = np.diff(velocities, axis=0) / ((durations[:-1] + durations[1:]) / 2)[:, None]
+    ratio = np.abs(accelerations) / max_acceleration
+    frames = np.flatnonzero((ratio > 1).any(axis=1))
+    servos = ratio[frames].argmax(axis=1)
+    values = np.abs(accelerations[frames, servos])
+    report.add('acceleration', frames + 1,
+               lambda i: f'servo {servos[i] + 1} accelerates {values[i]:.0f} deg/s^2, '
+                         f'the limit is {max_acceleration[servos[i]]:.0f} deg/s^2')
+
+if __name__ == '__main__':
+    import argparse
+
+    from trajectory import Trajectory
+
+    parser = argparse.ArgumentParser(description='Check trajectory files before replaying them.')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--period', type=float, default=0.15, help='time (s) between two frames without timestamps')
+    parser.add_argument('--max-lag', type=float, default=20.0,
+                        help='largest lag (degrees) behind a target when the servos turn back')
+    parser.add_argument('--max-velocity', type=float, help='also check the velocity (degrees per second)')
+    parser.add_argument('--max-acceleration', type=float, help='also check the acceleration (degrees per second squared)')
+    parser.add_argument('--table-height', type=float, default=table_height, help='height (cm) of the table')
+    parser.add_argument('--all', action='store_true', help='list every flagged frame')
+    args = parser.parse_args()
+
+    zones = np.array([below(args.table_height)])
+    failed = False
+    for filename in args.files:
+        report = validate(Trajectory.load(filename, period=args.period), max_lag=args.max_lag,
+                          max_velocity=args.max_velocity, max_acceleration=args.max_acceleration, keep_out=zones)
+        print(filename)
+        print(report.summary())
+        if args.all:
+            for frame, check, reason in report.issues():
+                print(f'    {frame}: {check}: {reason}')
+        failed = failed or not report.ok
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,238 @@
+#%%
+'''
+This module records the servo positions when they change, instead of polling the sliders every `save_time`.
+Every change gets a monotonic timestamp, so motions between two polls are not missed and holds cost nothing
+while recording: a position held for 10 s is one entry, the time until the next change is its run length.
+
+Storage:
+The changes are kept in a bounded ring buffer of delta-encoded entries, 8 bytes each (a list of 6 ints is ~200 bytes):
+    ticks (uint16): time since the previous entry, in `resolution` seconds (1 ms by default)
+    deltas (6 x int8): change of each servo angle since the previous entry
+A change of more than 127 degrees or a gap of more than 65 s is split over several entries.
+When the buffer is full, the oldest entry is folded into the base position, so the recording keeps the last
+`capacity` changes (~65 000 changes, 512 kB by default) and memory does not grow during long sessions.
+
+Export:
+    trajectory(): one frame per change with its timestamp (save it as a .traj file to keep the timing)
+    trajectory(period): resampled every `period`, the frames the polling recorder would have saved
+    Parameters:
+            capacity (int): number of entries in the ring buffer
+            resolution (float): time (s) of one tick of the timestamps
+            clock (function): monotonic clock in seconds
+
+    Usage:
+            recorder = Recorder()
+            recorder.start(get_slider_positions())
+            recorder.record(get_slider_positions())   # in the slider callbacks
+            recorder.stop()
+            recorder.trajectory(period=0.1)
+
+Command line (compresses a polled recording):
+    python recorder.py heart/original_actions/1_first_turn.txt 1_first_turn.traj --period 0.1
+'''
+#%%
+import time
+
+import numpy as np
+
+from trajectory import Trajectory
+
+#######################################
+# recorder
+#######################################
+class Recorder:
+    max_ticks = np.iinfo(np.uint16).max
+    max_delta = np.iinfo(np.int8).max
+
+    def __init__(self, capacity=65536, resolution=0.001, clock=time.monotonic):
+        if capacity < 1:
+            raise ValueError(f'capacity has to be positive, got {capacity}')
+        self.capacity = capacity
+        self.resolution = resolution
+        self.clock = clock
+
+        self._ticks = np.zeros(capacity, dtype=np.uint16)
+        self._deltas = np.zeros((capacity, Trajectory.n_servos), dtype=np.int8)
+        self.recording = False
+        self.clear()
+
+    def clear(self):
+        # position and tick before the oldest entry of the ring buffer
+        self._base_position = None
+        self._base_tick = 0
+        self._head = 0
+        self._count = 0
+        # last recorded position and its tick, the next delta starts from here
+        self._last_position = None
+        self._last_tick = 0
+        self._start_time = None
+        self._stop_tick = None
+
+        self.changes = 0
+        self.unchanged = 0
+        self.dropped = 0
+
+    #######################################
+    # recording
+    #######################################
+    def start(self, position, time=None):
+        # starts a new recording from `position`, the previous recording is cleared
+        self.clear()
+        self._start_time = self.clock() if time is None else time
+        self._base_position = self._check(position)
+        self._last_position = self._base_position.copy()
+        self.recording = True
+
+    def record(self, position, time=None):
+        # records `position` if it changed, returns whether it was recorded
+        if not self.recording:
+            return False
+        position = self._check(position)
+        if np.array_equal(position, self._last_position):
+            self.unchanged += 1
+            return False
+        tick = self._tick(time)
+        delta = position.astype(int) - self._last_position
+        gap = tick - self._last_tick
+
+        # gaps longer than a uint16 are held with entries that do not move
+        while gap > self.max_ticks:
+            self._push(self.max_ticks, np.zeros(Trajectory.n_servos, dtype=int))
+            gap -= self.max_ticks
+        # changes larger than an int8 are split over entries at the same time
+        steps = max(1, int(np.ceil(np.abs(delta).max() / self.max_delta)))
+        for step in range(steps):
+            part = delta * (step + 1) // steps - delta * step // steps
+            self._push(gap if step == 0 else 0, part)
+
+        self._last_position = position
+        self._last_tick = tick
+        self.changes += 1
+        return True
+
+    def stop(self, time=None):
+        # stops the recording, the last position is held until now
+        if not self.recording:
+            return
+        self._stop_tick = max(self._tick(time), self._last_tick)
+        self.recording = False
+
+    def _check(self, position):
+        position = np.rint(np.asarray(position, dtype=float)).astype(int)
+        if position.shape != (Trajectory.n_servos,):
+            raise ValueError(f'expected {Trajectory.n_servos} servo angles, got shape {position.shape}')
+        return position
+
+    def _tick(self, time):
+        # ticks since the start, rounded from the start so the rounding does not add up
+        time = self.clock() if time is None else time
+        return max(int(round((time - self._start_time) / self.resolution)), self._last_tick)
+
+    def _push(self, ticks, delta):
+        if self._count == self.capacity:
+            # fold the oldest entry into the base position
+            self._base_position += self._deltas[self._head]
+            self._base_tick += int(self._ticks[self._head])
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+            self.dropped += 1
+        index = (self._head + self._count) % self.capacity
+        self._ticks[index] = ticks
+        self._deltas[index] = delta
+        self._count += 1
+
+    #######################################
+    # decoding and export
+    #######################################
+    def __len__(self):
+        # number of entries in the ring buffer
+        return self._count
+
+    def _entries(self):
+        # entries in recording order
+        order = (self._head + np.arange(self._count)) % self.capacity
+        return self._ticks[order], self._deltas[order]
+
+    def decode(self):
+        '''
+        Decodes the ring buffer.
+            Returns:
+                    positions (array): (M, 6) int, the first position and every change
+                    times (array): (M,) time (s) of each position since the start of the recording
+        '''
+        if self._base_position is None:
+            return np.zeros((0, Trajectory.n_servos), dtype=int), np.zeros(0)
+        ticks, deltas = self._entries()
+        positions = self._base_position + np.concatenate([np.zeros((1, Trajectory.n_servos), dtype=int),
+                                                          np.cumsum(deltas, axis=0, dtype=int)])
+        ticks = self._base_tick + np.concatenate([[0], np.cumsum(ticks, dtype=np.int64)])
+
+        # entries at the same tick (split changes) keep the last one, entries that do not move (long holds) are left out
+        last = np.append(ticks[1:] != ticks[:-1], True)
+        positions, ticks = positions[last], ticks[last]
+        moved = np.concatenate([[True], np.any(positions[1:] != positions[:-1], axis=1)])
+        return positions[moved], ticks[moved] * self.resolution
+
+    @property
+    def duration(self):
+        # time (s) from the start of the recording to the stop, or to the last change while recording
+        if self._base_position is None:
+            return 0.0
+        tick = self._last_tick if self._stop_tick is None else self._stop_tick
+        return (tick - self._base_tick) * self.resolution
+
+    def trajectory(self, period=None):
+        '''
+        Exports the recording.
+            Parameters:
+                    period (float): resample the recording every `period` seconds, optional
+
+            Returns:
+                    trajectory (Trajectory): without `period`, one frame per change with its timestamp
+                                             (the last position is repeated at the stop of the recording);
+                                             with `period`, the position held at every multiple of `period`
+        '''
+        positions, times = self.decode()
+        if len(positions) == 0:
+            return Trajectory(period=period)
+        times = times - times[0]
+        end = max(self.duration, times[-1])
+        if end > times[-1]:
+            positions = np.vstack([positions, positions[-1]])
+            times = np.append(times, end)
+        trajectory = Trajectory(positions, source='recording', times=times)
+
+        # the polling recorder saved the position held at 0, period, 2 period, ...
+        return trajectory if period is None else trajectory.resample(period)
+
+    def stats(self):
+        return {'changes': self.changes,
+                'unchanged': self.unchanged,
+                'entries': self._count,
+                'dropped': self.dropped,
+                'bytes': self._count * (self._ticks.itemsize + self._deltas.itemsize * Trajectory.n_servos),
+                'duration': self.duration}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compress a polled recording to its changes with timestamps.')
+    parser.add_argument('source')
+    parser.add_argument('output', help='.traj file to keep the timestamps, or a txt file resampled with --resample')
+    parser.add_argument('--period', type=float, default=0.1, help='polling period (s) of the recording, e.g. save_time')
+    parser.add_argument('--resample', type=float, help='resample the changes every RESAMPLE seconds')
+    args = parser.parse_args()
+
+    trajectory = Trajectory.load(args.source, period=args.period)
+    times = trajectory.frame_times()
+    recorder = Recorder(capacity=max(1, 2 * len(trajectory)))
+    recorder.start(trajectory[0], time=times[0])
+    for position, stamp in zip(trajectory.positions[1:], times[1:]):
+        recorder.record(position, stamp)
+    recorder.stop(time=times[-1])
+
+    recorded = recorder.trajectory(args.resample)
+    recorded.save(args.output)
+    stats = recorder.stats()
+    print(f"{len(trajectory)} frames -> {stats['changes']} changes, {stats['bytes']} bytes in the ring buffer")
+    print('saved: ' + args.output)
@@ -0,0 +1,197 @@
+#%%
+'''
+This module replays a list of servo positions on its own thread, so the GUI does not freeze during the replay.
+Every frame has an absolute deadline on the monotonic clock: deadline(k+1) = deadline(k) + period/speed.
+The deadlines do not depend on when the previous frame was actually sent, so time spent on serial communication
+or printing does not add up over long replays.
+If the positions have timestamps (e.g. a Trajectory retimed with `retime.py`), the time between two frames is taken
+from the timestamps instead of `period`: deadline(k+1) = deadline(k) + (times[k+1] - times[k])/speed.
+    Parameters:
+            send (function): sends one list of servo positions to arduino
+            period (float): time (s) between two frames at speed 1
+            speed (float): replay speed, e.g. 2 replays twice as fast
+            on_frame (function): called with (index, position) after each frame is sent, optional
+            max_lateness (float): if a frame is later than this (s), the following deadlines are moved
+                                  instead of sending the late frames in a burst, defaults to one period
+            clock (function): monotonic clock in seconds
+            sleep (function): replaces the interruptible wait with e.g. a virtual clock, optional
+            metrics (Instrumentation): records the lateness and deadline misses, optional (see `instrumentation.py`)
+
+    Controls:
+            start(positions, times=None), pause(), resume(), abort(), set_speed(speed), wait()
+
+    Statistics (see `stats()`):
+            lateness of every frame, i.e. the time between its deadline and when it was sent
+'''
+#%%
+import threading
+import time
+
+import numpy as np
+
+#######################################
+# replay engine
+#######################################
+class ReplayEngine:
+    def __init__(self, send, period=0.15, speed=1.0, on_frame=None, max_lateness=None,
+                 clock=time.monotonic, sleep=None, metrics=None):
+        self.send = send
+        self.period = period
+        self.speed = speed
+        self.on_frame = on_frame
+        self.max_lateness = period if max_lateness is None else max_lateness
+        self.clock = clock
+        self.sleep = sleep
+        self.metrics = metrics
+
+        self.thread = None
+        self.wake = threading.Event()
+        self.paused = False
+        self.aborted = False
+        self.finished = threading.Event()
+        self.finished.set()
+
+        self.lateness = []
+        self.deadline_misses = 0
+        self.last_position = None
+        self.frames_total = 0
+        self.error = None
+
+    #######################################
+    # controls
+    #######################################
+    def start(self, positions, times=None):
+        # replay `positions` on a new thread
+        if self.running:
+            raise RuntimeError('a replay is already running')
+        # check the timestamps before starting the thread
+        self.intervals(positions, times)
+        self.prepare(positions)
+        self.thread = threading.Thread(target=self.run, args=(positions, times), daemon=True)
+        self.thread.start()
+
+    @property
+    def running(self):
+        return not self.finished.is_set()
+
+    def pause(self):
+        self.paused = True
+        self.wake.set()
+
+    def resume(self):
+        self.paused = False
+        self.wake.set()
+
+    def abort(self):
+        self.aborted = True
+        self.paused = False
+        self.wake.set()
+
+    def set_speed(self, speed):
+        if speed <= 0:
+            raise ValueError(f'speed has to be positive, got {speed}')
+        self.speed = speed
+        self.wake.set()
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    #######################################
+    # replay loop
+    #######################################
+    def prepare(self, positions):
+        self.finished.clear()
+        self.paused = False
+        self.aborted = False
+        self.lateness = []
+        self.deadline_misses = 0
+        self.frames_total = len(positions)
+        self.error = None
+
+    def intervals(self, positions, times=None):
+        # time (s) between each frame and the next one at speed 1, from the timestamps of the positions if any
+        if times is None:
+            times = getattr(positions, 'times', None)
+        if times is None:
+            return np.full(len(positions), float(self.period))
+        times = np.asarray(times, dtype=float)
+        if len(times) != len(positions):
+            raise ValueError(f'expected {len(positions)} timestamps, got {len(times)}')
+        if np.any(np.diff(times) < 0):
+            raise ValueError('the timestamps have to be increasing')
+        return np.append(np.diff(times), self.period)
+
+    def run(self, positions, times=None):
+        # replay `positions` on the calling thread, returns when done or aborted
+        if not self.running:
+            self.prepare(positions)
+        try:
+            intervals = self.intervals(positions, times)
+            deadline = self.clock()
+            for index, position in enumerate(positions):
+                deadline = self.wait_until(deadline)
+                if self.aborted:
+                    break
+
+                lateness = self.clock() - deadline
+                self.send(position)
+                self.lateness.append(lateness)
+                self.last_position = position
+
+                if lateness > self.max_lateness:
+                    # too late to catch up, continue from now instead of sending frames in a burst
+                    self.deadline_misses += 1
+                    deadline += lateness
+                if self.metrics is not None:
+                    self.metrics.record('replay_lateness', lateness)
+                    if lateness > self.max_lateness:
+                        self.metrics.count('replay_deadline_misses')
+
+                if self.on_frame is not None:
+                    self.on_frame(index, position)
+
+                deadline += intervals[index] / self.speed
+        except Exception as error:
+            # kept for the caller of `start`, e.g. the port was closed during the replay
+            self.error = error
+            raise
+        finally:
+            self.finished.set()
+
+    def wait_until(self, deadline):
+        # wait until the deadline, returns the deadline shifted by the time spent paused
+        while not self.aborted:
+            if self.paused:
+                pause_start = self.clock()
+                while self.paused and not self.aborted:
+                    self.wake.wait(0.1)
+                    self.wake.clear()
+                deadline += self.clock() - pause_start
+                continue
+
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                break
+            if self.sleep is not None:
+                self.sleep(remaining)
+            else:
+                self.wake.wait(remaining)
+                self.wake.clear()
+        return deadline
+
+    #######################################
+    # statistics
+    #######################################
+    def stats(self):
+        '''
+        Returns the lateness statistics (s) of the frames sent so far.
+        '''
+        lateness = np.array(self.lateness)
+        if len(lateness) == 0:
+            return {'frames_sent': 0, 'frames_total': self.frames_total, 'deadline_misses': 0}
+        return {'frames_sent': len(lateness),
+                'frames_total': self.frames_total,
+                'deadline_misses': self.deadline_misses,
+                'lateness_mean': float(lateness.mean()),
+                'lateness_p95': float(np.percentile(lateness, 95)),
+                'lateness_max': float(lateness.max())}
@@ -0,0 +1,197 @@
+#%%
+'''
+This module retimes a trajectory: instead of sending every frame after the same period, each frame gets the shortest
+duration allowed by per-servo velocity and acceleration limits, and the trajectory gets per-frame timestamps
+(see `Trajectory.times`) that the replay follows.
+
+Durations:
+    1. velocity: the frame lasts at least max(|angle change| / max_velocity) over the servos, and at least `min_duration`
+    2. acceleration: the velocity change between two frames (the arm starts and ends at rest) is divided by the time
+       between the middles of the frames; where it is above max_acceleration, the durations of both frames are
+       stretched by sqrt(acceleration / max_acceleration) until all the frames are within the limits
+Frames that do not move (holds, e.g. while pouring) keep their original duration by default, they are deliberate.
+
+Calibration against the firmware:
+The ESP32 smooths the targets every 5 ms (smooth = target * (1 - refresh_rate) + smooth_prev * refresh_rate),
+a first order filter with the time constant tau = -tick / ln(refresh_rate) (~0.25 s).
+Following a target that moves at a constant velocity v, the servo lags v * tau behind, so the velocity limit for a
+lag of `max_lag` degrees is max_lag / tau, and the acceleration limit is the one reaching this velocity within tau.
+
+Command line:
+    python retime.py heart/heart.txt heart/heart_retimed.traj --max-lag 20
+'''
+#%%
+import numpy as np
+
+from trajectory import Trajectory
+
+#######################################
+# calibration
+#######################################
+def filter_time_constant(refresh_rate=0.98, tick=0.005):
+    # time constant (s) of the smoothing filter of the firmware
+    return -tick / np.log(refresh_rate)
+
+def calibrate_limits(max_lag=20.0, refresh_rate=0.98, tick=0.005):
+    '''
+    Velocity and acceleration limits the smoothing filter of the firmware can follow.
+        Parameters:
+                max_lag (float or array): largest lag (degrees) of the servos behind the targets, per servo if an array
+                refresh_rate (float): smoothing factor of the firmware
+                tick (float): time (s) between two firmware loops
+
+        Returns:
+                max_velocity (array): (6,) degrees per second
+                max_acceleration (array): (6,) degrees per second squared
+    '''
+    tau = filter_time_constant(refresh_rate, tick)
+    max_velocity = np.broadcast_to(np.asarray(max_lag, dtype=float) / tau, (Trajectory.n_servos,)).copy()
+    return max_velocity, max_velocity / tau
+
+def smoothed_positions(positions, times, refresh_rate=0.98, tick=0.005):
+    '''
+    Angles of the servos following the smoothing filter of the firmware, each target held until the next frame.
+        Parameters:
+                positions (array): (N, 6) servo angles, the targets
+                times (array): (N,) timestamps (s) of the frames
+                refresh_rate (float): smoothing factor of the firmware
+                tick (float): time (s) between two firmware loops
+
+        Returns:
+                smoothed (array): (N, 6) angles of the servos when each frame arrives, starting at the first frame
+    '''
+    positions = np.asarray(positions, dtype=float)
+    smoothed = np.empty_like(positions)
+    if len(positions) == 0:
+        return smoothed
+    smoothed[0] = positions[0]
+    # smooth(k+1) = target(k) + (smooth(k) - target(k)) * decay(k): solved with cumulative sums,
+    # in blocks short enough for exp(elapsed / tau) to stay finite
+    elapsed = np.cumsum(np.maximum(np.diff(np.asarray(times, dtype=float)), 0.) / filter_time_constant(refresh_rate, tick))
+    start = 0
+    while start < len(positions) - 1:
+        origin = elapsed[start - 1] if start else 0.
+        end = max(int(np.searchsorted(elapsed, origin + 500., side='right')), start + 1)
+        growth = np.exp(elapsed[start:end] - origin)
+        previous = np.concatenate([[1.], growth[:-1]])
+        # contribution of each held target, weighted back to the start of the block
+        steps = (growth - previous)[:, None] * positions[start:end]
+        smoothed[start + 1:end + 1] = (smoothed[start] + np.cumsum(steps, axis=0)) / growth[:, None]
+        start = end
+    return smoothed
+
+#######################################
+# retiming
+#######################################
+def minimal_durations(positions, max_velocity, max_acceleration=None, min_duration=0.02,
+                      fixed_durations=None, iterations=100):
+    '''
+    Shortest duration of each frame (time until the next frame) within the limits.
+        Parameters:
+                positions (array): (N, 6) servo angles
+                max_velocity (float or array): degrees per second, per servo if an array
+                max_acceleration (float or array): degrees per second squared, None for no limit
+                min_duration (float): shortest duration (s) of a frame
+                fixed_durations (array): (N-1,) durations to keep (s), nan for the durations to compute, optional
+                iterations (int): largest number of stretching passes for the acceleration limit
+
+        Returns:
+                durations (array): (N-1,) time (s) from each frame to the next one
+    '''
+    positions = np.asarray(positions, dtype=float)
+    deltas = np.diff(positions, axis=0)
+    max_velocity = np.broadcast_to(np.asarray(max_velocity, dtype=float), (positions.shape[1],))
+    durations = np.maximum((np.abs(deltas) / max_velocity).max(axis=1, initial=0), min_duration)
+
+    free = np.ones(len(durations), dtype=bool)
+    if fixed_durations is not None:
+        fixed_durations = np.asarray(fixed_durations, dtype=float)
+        free = np.isnan(fixed_durations)
+        durations[~free] = fixed_durations[~free]
+    if max_acceleration is None or len(durations) == 0:
+        return durations
+
+    max_acceleration = np.broadcast_to(np.asarray(max_acceleration, dtype=float), (positions.shape[1],))
+    rest = np.zeros((1, positions.shape[1]))
+    for i in range(iterations):
+        # velocities of the frames, the arm is at rest before the first and after the last frame
+        velocities = np.concatenate([rest, deltas / durations[:, None], rest])
+        padded = np.concatenate([[0], durations, [0]])
+        # acceleration at the junction of frames k-1 and k, over the time between their middles
+        accelerations = np.abs(np.diff(velocities, axis=0)) / ((padded[:-1] + padded[1:]) / 2)[:, None]
+        ratios = (accelerations / max_acceleration).max(axis=1)
+        if ratios.max() <= 1 + 1e-9:
+            break
+        # stretching a frame by s divides the accelerations around it by about s**2
+        stretch = np.sqrt(np.maximum(ratios, 1))
+        factors = np.maximum(stretch[:-1], stretch[1:])
+        durations[free] *= factors[free]
+    return durations
+
+def retime(trajectory, max_velocity=None, max_acceleration=None, min_duration=0.02, keep_holds=True,
+           keep=None, period=None):
+    '''
+    Retimes a trajectory with the velocity and acceleration limits.
+        Parameters:
+                trajectory (Trajectory or array): (N, 6) servo positions
+                max_velocity (float or array): degrees per second, defaults to `calibrate_limits()`
+                max_acceleration (float or array): degrees per second squared, defaults to `calibrate_limits()`
+                min_duration (float): shortest duration (s) of a frame
+                keep_holds (bool): frames that do not move keep their original duration
+                keep (array): (N,) bool, frames that keep their original duration, e.g. a pour, optional
+                period (float): original period (s) if the trajectory has no timestamps, defaults to its period
+
+        Returns:
+                trajectory (Trajectory): the same positions with the new timestamps
+    '''
+    if not isinstance(trajectory, Trajectory):
+        trajectory = Trajectory(trajectory, period)
+    period = trajectory.period if period is None else period
+    if max_velocity is None or max_acceleration is None:
+        velocity, acceleration = calibrate_limits()
+        max_velocity = velocity if max_velocity is None else max_velocity
+        max_acceleration = acceleration if max_acceleration is None else max_acceleration
+
+    retimed = trajectory.copy()
+    if len(trajectory) == 0:
+        retimed.times = np.zeros(0)
+        return retimed
+
+    positions = trajectory.positions
+    original = np.diff(trajectory.frame_times(period))
+    fixed = np.full(len(original), np.nan)
+    if keep_holds:
+        holds = ~np.diff(positions, axis=0).any(axis=1)
+        fixed[holds] = original[holds]
+    if keep is not None:
+        keep = np.asarray(keep, dtype=bool)[:-1]
+        fixed[keep] = original[keep]
+
+    durations = minimal_durations(positions, max_velocity, max_acceleration, min_duration, fixed)
+    retimed.times = np.concatenate([[0], np.cumsum(durations)])
+    return retimed
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Retime a trajectory with velocity and acceleration limits.')
+    parser.add_argument('source')
+    parser.add_argument('output', help='.traj file, the txt format has no timestamps')
+    parser.add_argument('--period', type=float, default=0.15, help='original replay period (s)')
+    parser.add_argument('--max-lag', type=float, default=20.0,
+                        help='largest lag (degrees) of the firmware filter, sets the velocity and acceleration limits')
+    parser.add_argument('--max-velocity', type=float, help='degrees per second, overrides --max-lag')
+    parser.add_argument('--max-acceleration', type=float, help='degrees per second squared, overrides --max-lag')
+    parser.add_argument('--min-duration', type=float, default=0.02, help='shortest duration of a frame (s)')
+    parser.add_argument('--retime-holds', action='store_true', help='also shorten the frames that do not move')
+    args = parser.parse_args()
+
+    velocity, acceleration = calibrate_limits(args.max_lag)
+    max_velocity = velocity if args.max_velocity is None else args.max_velocity
+    max_acceleration = acceleration if args.max_acceleration is None else args.max_acceleration
+
+    trajectory = Trajectory.load(args.source, period=args.period)
+    retimed = retime(trajectory, max_velocity, max_acceleration, args.min_duration, keep_holds=not args.retime_holds)
+    retimed.save(args.output)
+    print(f'{len(trajectory)} frames: {trajectory.duration():.2f} s -> {retimed.duration():.2f} s')
+    print('saved: ' + args.output)
@@ -2,6 +2,7 @@
 '''
 This function communicates with arduino and serves the tkinter GUI to control the robot via forward/inverse kinematics.
 It can also record and replay actions.
+The GUI is a client of `ArmController` (see `arm_controller.py`), which can also control the arm without a display.
 Instructions:
     1. Setting the COM port of arduino:
     The active port (e.g. COM3) can be found in the Device Manager.
@@ -14,36 +15,52 @@ Instructions:
     The servo angles and x,y,z coordinates are continuously updated.
     You can change the slider values by dragging the sliders, or by using the specified keys on the keyboard.
     (see which keys control which sliders in the code)
+    The side moved last (servo angles or coordinates) is kept as it is, the other side follows it.
+    Coordinates out of reach move the servos to the nearest reachable pose (see `workspace.py`),
+    once the workspace grid is built with `python workspace.py build`; without it they are rejected.
 
     3. Saving actions:
-    By clicking `Start saving`, you will start recording the servo angles every 0.1 seconds (the time interval can be changed).
-    The servo angles will be saved to the list `saved_positions`.
+    By clicking `Start saving`, you will start recording the servo angles whenever they change.
     To stop the recording, `Change save state` to False.
+    The recording will then be added to the list `saved_positions`, sampled every 0.1 seconds (the time interval can be changed),
+    or with the time of every change with `save_timestamps` (save it as a .traj file to keep the timing).
     If you decide to save the recorded actions as a txt file, you can go to `File` -> `Save File`.
 
     To record the next series of actions, you need to first `Change save state` to True.
     Then simply `Start saving` again.
     Prior to the next save, you might also want to `Clear All Positions` to remove the actions in the temporary list of `saved_positions`.
     `Clear All Positions` will only clear the temporary list `saved_positions`, and will not affect your saved txt files.
+    Instead of recording, you can add the slider positions as waypoints with `Edit` -> `Add waypoint`;
+    `Edit` -> `Interpolate positions` then replaces `saved_positions` with a smooth motion through them (see `interpolation.py`).
 
     4. Replaying actions:
     `Replay Positions` will replay the positions in the `saved_positions` list.
     By default, `saved_positions` is an empty list.
     You will first have to record some actions in the list before replaying them.
     Alternatively, you can load the saved actions from a txt file to the `saved_positions` list, which can be done by going to `File` -> `Open File`.
+    The replay runs in the background, it can be paused/resumed with `Pause/Resume` and stopped with `Abort Replay`.
+    Trajectories retimed with `retime.py` (.traj files with timestamps) are replayed with their own timing.
+    Repeated positions are sent once and held for their whole duration (`collapse_holds`).
+    The opened files and the replays are checked first (see `preflight.py`): angles outside the servo range or frames
+    below the table stop the replay, angles outside the slider range and moves cut short by the smoothing of
+    the firmware are printed as warnings.
+    With `upload_replay`, the whole replay is uploaded to the ESP32, which plays it on its own timer (see `upload.py`).
 
     5. Resetting servos:
     `Reset servos` will reset the servos to the initial positions, which might be helpful before recording another set of actions.
+
+    6. Statistics:
+    The latency of sending frames, kinematics, recording and replaying, the serial bytes/frames written and the
+    replay deadline misses are measured, `File` -> `Save Statistics` saves them as a json or csv file.
+    The replayed frames are only printed with `log_level = 'debug'`.
 '''
 #%%
 #######################################
 # import libraries
 #######################################
-import serial
-import time
-
-import numpy as np
-import tinyik
+from arm_controller import ArmController
+from control_loop import KinematicsSync, SendScheduler
+from instrumentation import metrics
 
 from tkinter import *
 from tkinter import filedialog
@@ -69,30 +86,55 @@ servo6 = 90
 # wait time (s)
 # increase sleep time to prevent communication error
 wait_time = 0.05
-# save interval (s)
+# save interval (s), the recording is resampled every `save_time`
 save_time = 0.1
+# keep the time of every change in the recording instead of resampling it every `save_time`
+save_timestamps = False
 # play interval (s)
 play_time = 0.1
+# time (s) between two replayed frames, same as the previous `send_positions` sleep + `play_time`
+replay_period = wait_time + play_time
+# replay speed, e.g. 2 replays twice as fast
+replay_speed = 1.0
+# send repeated positions once and hold them, instead of sending every repeated frame
+collapse_holds = True
+# minimum time (s) between two forward/inverse kinematics solves while moving the sliders
+kinematics_frame_time = 1/60
+# maximum number of frames sent to arduino per second when controlling the sliders
+max_send_rate = 1/wait_time
+# resend the last frame after this many seconds without any slider changes
+keep_alive_time = 1.0
+# try to use the compact binary serial format, falls back to ASCII if the firmware does not answer
+binary_protocol = True
+# upload the replays to the buffer of the ESP32 instead of sending every frame live (needs the binary format)
+upload_replay = True
+# move the servos to the nearest reachable pose when the x,y,z coordinates are out of reach (see `workspace.py`)
+# the grid is loaded in the background at start-up, build it once with `python workspace.py build`
+clamp_unreachable = True
+# profile and speed (degrees per second) of "Interpolate positions", see `interpolation.py`
+interpolation_profile = 'minimum_jerk'
+interpolation_speed = 30.0
+# console messages, 'debug' also prints every replayed frame (printing costs time during the replay)
+log_level = 'info'
+metrics.set_level(log_level)
 
 #%%
 #######################################
-# define robot geometry for forward and inverse kinematics
-# have to be careful how you define your axes in the first place
+# the controller keeps the connection, the servo positions, the recording and `saved_positions`
+# robot geometry for forward and inverse kinematics is defined in `kinematics.py`
+# only the first 3 joints are used for both forward and inverse kinematics
 #######################################
+def print_replayed(index, position):
+    # per-frame message, only formatted with the 'debug' log level
+    if metrics.logs('debug'):
+        print("playing: "+str(position.tolist()))
 
-# joint angles are zero by default, define actuator rotation axes and length accordingly
-# 1R: rotation along z axis, a short link of 1.5 cm in the z direction
-# 2R: rotation along x axis, a link of -9.6 cm in the y direction
-# 3R: rotation along x axis, a link of -17.7 cm in the y direction
-robot = tinyik.Actuator(['z', [0., 0., 1.5], 'x', [0., -9.6, 0.], 'x', [0., -17.7, 0.]])
-
-# initialise angles of the first 3 joints
-# because here we only use the first 3 joints for both forward and inverse kinematics
-servo_3angles = [servo1, -servo2, -servo3]  # negative servo2 and servo3 correcting for rotation orientation
-robot.angles = np.deg2rad(servo_3angles)
+controller = ArmController([servo1, servo2, servo3, servo4, servo5, servo6], save_time, save_timestamps,
+                           replay_period, replay_speed, binary_protocol, upload_replay, collapse_holds,
+                           clamp_unreachable, on_frame=print_replayed)
 
-# use inverse kinematics to get the initial coordiantes
-coordinates = np.round(robot.ee, decimals = 1)
+# use forward kinematics to get the initial coordiantes
+coordinates = controller.coordinates
 
 #%%
 #######################################
@@ -103,24 +145,24 @@ coordinates = np.round(robot.ee, decimals = 1)
 # set USB port of arduino
 #######################################
 def set_port():
-    global port_opened,arduino
+    global port_opened
     com_port= port_input.get()
-    arduino=serial.Serial(com_port,115200)
+    controller.positions = get_slider_positions()
+    # ask the firmware whether it understands the binary format and choose the replay mode
+    controller.connect(com_port)
     port_opened=True
     print ("COM port set to: "+com_port)
+    print("serial format: "+type(controller.encoder).__name__)
+    print("replay mode: "+type(controller.player).__name__)
+
+    # start sending the slider values to arduino
+    scheduler.start()
 
 #######################################
-# send servo positions to arduino
+# get the current servo positions from the sliders
 #######################################
-def send_positions(position):
-    # the rotation degree is denoted by 3 numbers
-    # e.g. '090' for 90 degrees
-    # 6 servos in total, so a total of 18 numbers
-    message = "{0:0=3d}".format(position[0])+"{0:0=3d}".format(position[1])+"{0:0=3d}".format(position[2])+"{0:0=3d}".format(position[3])+"{0:0=3d}".format(position[4])+"{0:0=3d}".format(position[5])+"\n"
-    arduino.write(str.encode(message))
-    #print(message, end='')
-    # increase sleep time to prevent communication error
-    time.sleep(wait_time)
+def get_slider_positions():
+    return [servo1_slider.get(), servo2_slider.get(), servo3_slider.get(), servo4_slider.get(), servo5_slider.get(), servo6_slider.get()]
 
 #######################################
 # reset servo positions to default values
@@ -130,7 +172,7 @@ def reset_servos():
     default_positions = [servo1, servo2, servo3, servo4, servo5, servo6]
 
     # update the servo sliders with the new positions
-    # the new slider values will be sent to arduino automatically in the `while True:` loop 
+    # the new slider values will be sent to arduino automatically by the `scheduler`
     servo1_slider.set(default_positions[0])
     servo2_slider.set(default_positions[1])
     servo3_slider.set(default_positions[2])
@@ -141,41 +183,47 @@ def reset_servos():
 #######################################
 # forward kinematics
 # every time when servo1/2/3 move, trigger forward kinematics to calculate the new coordinates
+# the changes are merged by `kinematics_sync`, which solves at most once per `kinematics_frame_time`
 #######################################
 def forward_kinematics(angle):
-    # negative servo2 and servo3 correcting for rotation orientation
-    servo_3angles = [servo1_slider.get(), -servo2_slider.get(), -servo3_slider.get()]
-
-    # set new robot angles
-    robot.angles = np.deg2rad(servo_3angles)
+    record_positions(angle)
+    kinematics_sync.joints_changed()
 
-    # use forward kinematics to get the new coordiantes
-    coordinates = np.round(robot.ee, decimals = 1)
-
-    # set these new coordinates to the x,y,z sliders
-    x_slider.set(coordinates[0])
-    y_slider.set(coordinates[1])
-    z_slider.set(coordinates[2])
+def solve_forward(servo_3angles):
+    # use forward kinematics to get the new coordiantes, `kinematics_sync` sets them to the x,y,z sliders
+    return controller.forward_kinematics(servo_3angles)
 
 #######################################
 # inverse kinematcs
 # every time x/y/z coordinates change, trigger inverse kinematics to calculate the new servo positions
 #######################################
 def inverse_kinematics(coor):
-    # get new coordinates
-    coordinates = [x_slider.get(), y_slider.get(), z_slider.get()]
+    kinematics_sync.coordinates_changed()
 
-    # set new coordinates
-    robot.ee = coordinates
+def solve_inverse(coordinates):
+    # use inverse kinematics to get new servo positions, `kinematics_sync` sets them to the servo sliders
+    # the current servo positions are used to pick the closest of the possible solutions
+    controller.positions = get_slider_positions()
+    servo_3angles, reachable = controller.inverse_kinematics(coordinates)
+    if not reachable:
+        print("coordinates out of reach: "+str(coordinates)+(", nearest reachable pose: "+str(servo_3angles.tolist()) if clamp_unreachable and controller.workspace is not None else ""))
+    return servo_3angles
 
-    # use inverse kinematics to get new servo positions
-    servo_3angles = np.round(np.rad2deg(robot.angles))
+def get_coordinates():
+    return [x_slider.get(), y_slider.get(), z_slider.get()]
 
-    # set the new positions to the servo sliders
-    # negative servo2 and servo3 correcting for rotation orientation
+def set_coordinates(coordinates):
+    x_slider.set(coordinates[0])
+    y_slider.set(coordinates[1])
+    z_slider.set(coordinates[2])
+
+def get_servo_3angles():
+    return [servo1_slider.get(), servo2_slider.get(), servo3_slider.get()]
+
+def set_servo_3angles(servo_3angles):
     servo1_slider.set(servo_3angles[0])
-    servo2_slider.set(-servo_3angles[1])
-    servo3_slider.set(-servo_3angles[2])
+    servo2_slider.set(servo_3angles[1])
+    servo3_slider.set(servo_3angles[2])
 
 #######################################
 # directly set servo positions by inputting a number
@@ -217,8 +265,6 @@ def servo6_set():
 # saving state, default True
 # change this flag to False when stop recording
 saving = True
-# store saved positions in a list
-saved_positions = []
 
 # control save_state by a button
 def save_state():
@@ -227,6 +273,7 @@ def save_state():
     if saving == True:
         saving = False
         print(f'Save state: {saving}.')
+        stop_recording()
     
     elif saving == False:
         saving = True
@@ -234,68 +281,158 @@ def save_state():
 
 def save_positions():
     # `saving` is either True or False, controlled by the save_state button
-    if saving:
-        saved_positions.append([servo1_slider.get(), servo2_slider.get(), servo3_slider.get(), servo4_slider.get(), servo5_slider.get(), servo6_slider.get()]);
-        print("last saved positions: "+str(saved_positions[-1]))
-        
-        # call itself again (recursive loop) after sleeping for `save_time`
-        window.after(int(save_time*1000), save_positions)
+    # the recorder keeps the slider changes with their time, and is added to `saved_positions` when the recording stops
+    if saving and not controller.recording:
+        controller.positions = get_slider_positions()
+        controller.start_recording()
+        print("recording started: "+str(controller.positions))
+
+def record_positions(value):
+    # called every time a slider moves, the recorder only keeps the positions that changed
+    controller.set_positions(get_slider_positions())
+
+def stop_recording():
+    recording = controller.stop_recording()
+    if recording is None:
+        return
+    stats = controller.recorder.stats()
+    print(f"recorded {stats['changes']} changes in {stats['duration']:.1f} s, {len(recording)} positions saved")
+    print("last saved positions: "+str(controller.saved_positions.last.tolist()))
 
 #######################################
 # play positions
 #######################################
 def play_positions():
-    for position in saved_positions:
-        # replay actions
-        print("playing: "+str(position))
-        send_positions(position)
-
-        # sleep for `play_time` before playing the next action
-        time.sleep(play_time)
+    # the replay runs on its own thread, so the GUI keeps responding
+    if not port_opened:
+        print("set the port first")
+        return
+    if controller.running:
+        print("already replaying")
+        return
+    if len(controller.saved_positions) == 0:
+        print("no positions to replay")
+        return
+
+    # stop sending the slider values during the replay
+    scheduler.stop()
+    # with `collapse_holds`, the repeated positions become one frame with the time until the next change
+    try:
+        positions = controller.play()
+    except ValueError as error:
+        print("could not replay: "+str(error))
+        scheduler.start()
+        return
+    print(f"replaying {len(positions)} frames, {len(controller.saved_positions) - len(positions)} repeated frames held")
+    window.after(100, check_replay)
+
+def check_replay():
+    # check every 100 ms whether the replay is finished
+    if controller.running:
+        window.after(100, check_replay)
+        return
 
     # update slider values to stop at the last played position, otherwise it will revert to the position before replaying
-    servo1_slider.set(position[0])
-    servo2_slider.set(position[1])
-    servo3_slider.set(position[2])
-    servo4_slider.set(position[3])
-    servo5_slider.set(position[4])
-    servo6_slider.set(position[5])
+    position = controller.player.last_position
+    if position is not None:
+        position = position.tolist()
+        servo1_slider.set(position[0])
+        servo2_slider.set(position[1])
+        servo3_slider.set(position[2])
+        servo4_slider.set(position[3])
+        servo5_slider.set(position[4])
+        servo6_slider.set(position[5])
+    print("replay finished: "+str(controller.stats()))
+
+    # continue sending the slider values
+    if port_opened:
+        scheduler.start()
+
+def pause_replay():
+    if not controller.running:
+        return
+    if controller.paused:
+        controller.resume()
+        print("replay resumed")
+    else:
+        controller.pause()
+        print("replay paused")
+
+def abort_replay():
+    if not controller.running:
+        return
+    controller.abort()
+    print("replay aborted")
 
 #######################################
 # clear positions in `saved_positions`
 #######################################
 def clear_all_positions():
-    global saved_positions
-    saved_positions = []
+    controller.clear_positions()
     print("cleared all positions")
 
 def clear_last_positions():
-    global saved_positions
-    removed = saved_positions.pop()
-    print("removed: "+str(removed))
-    print("saved positions: "+str(saved_positions))
+    removed = controller.clear_last_position()
+    if removed is None:
+        print("no positions to remove")
+        return
+    print("removed: "+str(removed.tolist()))
+    print("saved positions: "+str(controller.saved_positions.tolist()))
 
 #######################################
-# open a txt file and load the positions to `saved_positions`
+# smooth motion through waypoints: add the slider positions to `saved_positions`, then interpolate through them
+#######################################
+def add_waypoint():
+    controller.positions = get_slider_positions()
+    waypoint = controller.add_waypoint()
+    print(f"waypoint {len(controller.saved_positions)}: "+str(waypoint.tolist()))
+
+def interpolate_positions():
+    if controller.running:
+        print("wait for the replay to finish")
+        return
+    try:
+        positions = controller.interpolate_positions(profile=interpolation_profile, speed=interpolation_speed)
+    except ValueError as error:
+        print("could not interpolate: "+str(error))
+        return
+    print(f"interpolated {len(positions)} positions ({interpolation_profile}, {positions.duration():.1f} s)")
+
+#######################################
+# open a txt/traj file and load the positions to `saved_positions`
 #######################################
 def open_file():
-    global saved_positions
-    filename = filedialog.askopenfilename(initialdir = path, title = "Select a File", filetypes = (("Text files","*.txt*"),("all files","*.*")))
-    file = open(filename, "r")
-    data=file.read()
-    saved_positions=eval(data)
-    file.close()
+    filename = filedialog.askopenfilename(initialdir = path, title = "Select a File", filetypes = (("Text files","*.txt*"),("Trajectory files","*.traj"),("all files","*.*")))
+    if not filename:
+        return
+    try:
+        controller.open_file(filename)
+    except ValueError as error:
+        print("could not open file: "+str(error))
+        return
     print("opened: "+filename)
 
 #######################################
-# save `saved_positions` to a txt file
+# save `saved_positions` to a txt/traj file
 #######################################
 def save_file():
-    save_file = filedialog.asksaveasfile(mode='w', defaultextension=".txt")
-    save_file.write(str(saved_positions))
-    save_file.close()
+    filename = filedialog.asksaveasfilename(defaultextension=".txt", filetypes = (("Text files","*.txt*"),("Trajectory files","*.traj")))
+    if not filename:
+        return
+    controller.save_file(filename)
     print("saved file")
 
+#######################################
+# save the latency histograms and counters (see `instrumentation.py`) to a json/csv file
+#######################################
+def save_statistics():
+    filename = filedialog.asksaveasfilename(defaultextension=".json", filetypes = (("JSON files","*.json"),("CSV files","*.csv")))
+    if not filename:
+        return
+    metrics.save(filename)
+    print(metrics.report())
+    print("saved statistics: "+filename)
+
 #######################################
 # instructions on how to use the GUI
 #######################################
@@ -312,26 +449,44 @@ def instructions():
     The servo angles and x,y,z coordinates are continuously updated.
     You can change the slider values by dragging the sliders, or by using the specified keys on the keyboard.
     (see which keys control which sliders in the code)
+    The side moved last (servo angles or coordinates) is kept as it is, the other side follows it.
+    Coordinates out of reach move the servos to the nearest reachable pose (see `workspace.py`),
+    once the workspace grid is built with `python workspace.py build`; without it they are rejected.
 
     3. Saving actions:
-    By clicking `Start saving`, you will start recording the servo angles every 0.1 seconds (the time interval can be changed).
-    The servo angles will be saved to the list `saved_positions`.
+    By clicking `Start saving`, you will start recording the servo angles whenever they change.
     To stop the recording, `Change save state` to False.
+    The recording will then be added to the list `saved_positions`, sampled every 0.1 seconds (the time interval can be changed),
+    or with the time of every change with `save_timestamps` (save it as a .traj file to keep the timing).
     If you decide to save the recorded actions as a txt file, you can go to `File` -> `Save File`.
 
     To record the next series of actions, you need to first `Change save state` to True.
     Then simply `Start saving` again.
     Prior to the next save, you might also want to `Clear All Positions` to remove the actions in the temporary list of `saved_positions`.
     `Clear All Positions` will only clear the temporary list `saved_positions`, and will not affect your saved txt files.
+    Instead of recording, you can add the slider positions as waypoints with `Edit` -> `Add waypoint`;
+    `Edit` -> `Interpolate positions` then replaces `saved_positions` with a smooth motion through them (see `interpolation.py`).
 
     4. Replaying actions:
     `Replay Positions` will replay the positions in the `saved_positions` list.
     By default, `saved_positions` is an empty list.
     You will first have to record some actions in the list before replaying them.
     Alternatively, you can load the saved actions from a txt file to the `saved_positions` list, which can be done by going to `File` -> `Open File`.
+    The replay runs in the background, it can be paused/resumed with `Pause/Resume` and stopped with `Abort Replay`.
+    Trajectories retimed with `retime.py` (.traj files with timestamps) are replayed with their own timing.
+    Repeated positions are sent once and held for their whole duration (`collapse_holds`).
+    The opened files and the replays are checked first (see `preflight.py`): angles outside the servo range or frames
+    below the table stop the replay, angles outside the slider range and moves cut short by the smoothing of
+    the firmware are printed as warnings.
+    With `upload_replay`, the whole replay is uploaded to the ESP32, which plays it on its own timer (see `upload.py`).
 
     5. Resetting servos:
     `Reset servos` will reset the servos to the initial positions, which might be helpful before recording another set of actions.
+
+    6. Statistics:
+    The latency of sending frames, kinematics, recording and replaying, the serial bytes/frames written and the
+    replay deadline misses are measured, `File` -> `Save Statistics` saves them as a json or csv file.
+    The replayed frames are only printed with `log_level = 'debug'`.
     ''')
 
 #%%
@@ -385,7 +540,7 @@ window.bind("<c>", lambda e: servo3_slider.set(servo3_slider.get()-slider_step))
 servo3_label=Label(window,text="Servo 3")
 servo3_label.place(x=150, y=80)
 
-servo4_slider = Scale(window, from_=180, to=0)
+servo4_slider = Scale(window, from_=180, to=0, command = record_positions)
 servo4_slider.place(x=210, y=100)
 servo4_slider.set(servo4)
 window.bind("<f>", lambda e: servo4_slider.set(servo4_slider.get()+slider_step))
@@ -394,7 +549,7 @@ window.bind("<v>", lambda e: servo4_slider.set(servo4_slider.get()-slider_step))
 servo4_label=Label(window,text="Servo 4")
 servo4_label.place(x=220, y=80)
 
-servo5_slider = Scale(window, from_=180, to=0)
+servo5_slider = Scale(window, from_=180, to=0, command = record_positions)
 servo5_slider.place(x=280, y=100)
 servo5_slider.set(servo5)
 window.bind("<g>", lambda e: servo5_slider.set(servo5_slider.get()+slider_step))
@@ -403,7 +558,7 @@ window.bind("<b>", lambda e: servo5_slider.set(servo5_slider.get()-slider_step))
 servo5_label=Label(window,text="Servo 5")
 servo5_label.place(x=290, y=80)
 
-servo6_slider = Scale(window, from_=90, to=60)
+servo6_slider = Scale(window, from_=90, to=60, command = record_positions)
 servo6_slider.place(x=350, y=100)
 servo6_slider.set(servo6)
 window.bind("<h>", lambda e: servo6_slider.set(servo6_slider.get()+slider_step))
@@ -502,6 +657,12 @@ clear_button.place(x=120,y=295)
 play_button=Button(window, text="Replay Positions", command=play_positions)
 play_button.place(x=250,y=260)
 
+# Pause/resume and abort the replay
+pause_button=Button(window, text="Pause/Resume", command=pause_replay)
+pause_button.place(x=250,y=295)
+abort_button=Button(window, text="Abort Replay", command=abort_replay)
+abort_button.place(x=360,y=295)
+
 #%%
 #######################################
 # Menu bar
@@ -510,11 +671,15 @@ menubar = Menu(window)
 filemenu = Menu(menubar, tearoff=0)
 filemenu.add_command(label="Open File", command=open_file)
 filemenu.add_command(label="Save File", command=save_file)
+filemenu.add_command(label="Save Statistics", command=save_statistics)
 menubar.add_cascade(label="File", menu=filemenu)
 
 editmenu = Menu(menubar, tearoff=0)
 editmenu.add_command(label="Clear last position", command=clear_last_positions)
 editmenu.add_command(label="Clear all positions", command=clear_all_positions)
+editmenu.add_separator()
+editmenu.add_command(label="Add waypoint", command=add_waypoint)
+editmenu.add_command(label="Interpolate positions", command=interpolate_positions)
 menubar.add_cascade(label="Edit", menu=editmenu)
 
 helpmenu = Menu(menubar, tearoff=0)
@@ -525,11 +690,28 @@ window.config(menu=menubar)
 
 #%%
 #######################################
-# while True loop
+# kinematics sync, merges the slider changes into at most one forward or inverse kinematics solve
+# per `kinematics_frame_time` and ignores the slider commands fired by its own updates
+# the counters of solves and ignored commands are available with `kinematics_sync.counters()`
+#######################################
+kinematics_sync = KinematicsSync(window, get_servo_3angles, set_servo_3angles, get_coordinates, set_coordinates,
+                                 solve_forward, solve_inverse, frame_time=kinematics_frame_time)
+
+#######################################
+# send scheduler, started once the port is set
 # 1. read the servo positions from the slider values
-# 2. send the servo positions to arduino
+# 2. send the servo positions to arduino only when they change (at most `max_send_rate` times per second)
+#    and resend the last positions every `keep_alive_time` seconds
+# the counters of sent/suppressed frames are available with `scheduler.counters()`
+#######################################
+scheduler = SendScheduler(window, get_slider_positions, controller.send_positions, max_send_rate, keep_alive_time)
+
+#######################################
+# replays, see `ArmController.play`
+# the replay engine replays `saved_positions` on its own thread every `replay_period` seconds,
+# the uploader uploads them to the buffer of the ESP32 which plays them on its own timer (chosen when the port is set)
+# the statistics of the replay are printed with `controller.stats()` when the replay is finished
 #######################################
-while True:
-    window.update()
-    if(port_opened):
-        send_positions([servo1_slider.get(), servo2_slider.get(), servo3_slider.get(), servo4_slider.get(), servo5_slider.get(), servo6_slider.get()])
+
+window.mainloop()
+
@@ -0,0 +1,358 @@
+#%%
+'''
+This module encodes and decodes the servo positions sent to arduino over serial communication.
+Two formats are supported, the firmware accepts both at any time:
+
+    1. ASCII (original format):
+    The rotation degree of each servo is denoted by 3 numbers, e.g. '090' for 90 degrees.
+    6 servos in total, so a total of 18 numbers, followed by '\\n' (19 bytes).
+
+    2. Binary:
+    Absolute frame (10 bytes): [SYNC, FRAME_ABSOLUTE, seq, servo1, ..., servo6, crc]
+    Delta frame (7 bytes):     [SYNC, FRAME_DELTA, seq, d1|d2, d3|d4, d5|d6, crc]
+    `seq` is a sequence number (0-255) increased by 1 for every frame.
+    In a delta frame, each servo changes by a signed 4-bit value (-8 ~ 7 degrees) relative to the previous frame,
+    so it is only applied by the firmware if the previous frame was received (seq is consecutive).
+    `crc` is a CRC-8 (polynomial 0x07) of all bytes between SYNC and crc.
+
+    3. Upload (binary, see `upload.py`):
+    Queue frame (12 bytes):    [SYNC, FRAME_QUEUE, seq, ticks_low, ticks_high, servo1, ..., servo6, crc]
+    Control frame (5 bytes):   [SYNC, FRAME_CONTROL, seq, command, crc]
+    A queue frame is added to the ring buffer of the firmware and played for `ticks` loops (5 ms each).
+    Its seq is the number of queue frames received so far (0-255), frames out of order are ignored.
+    The firmware answers the control commands with a status line:
+        'Q state free received played underruns\\n'
+
+Negotiation:
+    The host sends the current positions as an ASCII frame with an extra 'B' before '\\n'.
+    Firmware supporting the binary format answers with 'BIN1\\n'; the old firmware ignores the extra 'B'.
+    The request is repeated every 250 ms, opening the port resets the ESP32 and the first requests are lost while it boots.
+    If no answer arrives in time, the host keeps using the ASCII format and says so.
+
+The round trips, the recovery of lost frames and a loopback over a pseudo terminal are tested in `tests/test_serial_protocol.py`.
+'''
+#%%
+import time
+
+#######################################
+# protocol constants
+#######################################
+SYNC = 0xA5
+FRAME_ABSOLUTE = 0x01
+FRAME_DELTA = 0x02
+
+FRAME_QUEUE = 0x03
+FRAME_CONTROL = 0x04
+
+ABSOLUTE_LENGTH = 10
+DELTA_LENGTH = 7
+QUEUE_LENGTH = 12
+CONTROL_LENGTH = 5
+
+frame_lengths = {FRAME_ABSOLUTE: ABSOLUTE_LENGTH, FRAME_DELTA: DELTA_LENGTH,
+                 FRAME_QUEUE: QUEUE_LENGTH, FRAME_CONTROL: CONTROL_LENGTH}
+
+# control commands of the upload
+QUEUE_START = 1
+QUEUE_END = 2
+QUEUE_CLEAR = 3
+QUEUE_STATUS = 4
+QUEUE_PAUSE = 5
+QUEUE_RESUME = 6
+
+# states in the status line
+STATE_IDLE = 0
+STATE_PLAYING = 1
+STATE_PAUSED = 2
+STATE_FINISHED = 3
+
+STATUS_PREFIX = b'Q '
+
+HANDSHAKE_SUFFIX = b'B\n'
+HANDSHAKE_REPLY = b'BIN1'
+
+# smallest and largest servo change of a delta frame
+delta_min = -8
+delta_max = 7
+
+#######################################
+# CRC-8, polynomial 0x07
+#######################################
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+crc8_table = _crc8_table()
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = crc8_table[crc ^ byte]
+    return crc
+
+#######################################
+# encoding
+#######################################
+def encode_ascii(position):
+    '''
+    Encodes 6 servo angles in the original ASCII format, e.g. b'090060110090090090\\n'.
+    '''
+    return b'%03d%03d%03d%03d%03d%03d\n' % tuple(int(angle) for angle in position)
+
+def encode_handshake(position):
+    '''
+    Encodes the negotiation frame: an ASCII frame with 'B' before '\\n'.
+    '''
+    return encode_ascii(position)[:-1] + HANDSHAKE_SUFFIX
+
+def encode_absolute(position, seq):
+    body = bytes([FRAME_ABSOLUTE, seq & 0xFF]) + bytes(int(angle) for angle in position)
+    return bytes([SYNC]) + body + bytes([crc8(body)])
+
+def encode_delta(deltas, seq):
+    # pack two signed 4-bit deltas into one byte
+    packed = bytes(((deltas[i] & 0x0F) << 4) | (deltas[i+1] & 0x0F) for i in range(0, 6, 2))
+    body = bytes([FRAME_DELTA, seq & 0xFF]) + packed
+    return bytes([SYNC]) + body + bytes([crc8(body)])
+
+def encode_queue(position, ticks, seq):
+    ticks = int(ticks)
+    if not 0 < ticks <= 0xFFFF:
+        raise ValueError(f'expected 1 ~ 65535 ticks, got {ticks}')
+    body = bytes([FRAME_QUEUE, seq & 0xFF, ticks & 0xFF, ticks >> 8]) + bytes(int(angle) for angle in position)
+    return bytes([SYNC]) + body + bytes([crc8(body)])
+
+def encode_control(command, seq=0):
+    body = bytes([FRAME_CONTROL, seq & 0xFF, command])
+    return bytes([SYNC]) + body + bytes([crc8(body)])
+
+def parse_status(line):
+    '''
+    Parses a status line of the firmware, e.g. b'Q 1 480 64 32 0'.
+        Returns:
+                status (dict): state, free, received, played, underruns; None if the line is not a status line
+    '''
+    line = line.strip()
+    if not line.startswith(STATUS_PREFIX):
+        return None
+    values = line[len(STATUS_PREFIX):].split()
+    if len(values) != 5 or not all(value.isdigit() for value in values):
+        return None
+    return dict(zip(('state', 'free', 'received', 'played', 'underruns'), (int(value) for value in values)))
+
+def encode_status(status):
+    return b'Q %d %d %d %d %d\n' % (status['state'], status['free'], status['received'], status['played'], status['underruns'])
+
+class FrameEncoder:
+    '''
+    Encodes a stream of servo positions as binary frames.
+    Delta frames are used when all servos move by -8 ~ 7 degrees,
+    an absolute frame is sent otherwise, and at least every `keyframe_interval` frames to recover from lost frames.
+        Parameters:
+                use_delta (bool): allow delta frames, False only sends absolute frames
+                keyframe_interval (int): maximum number of frames between two absolute frames
+    '''
+    def __init__(self, use_delta=True, keyframe_interval=20):
+        self.use_delta = use_delta
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.last_position = None
+        self.frames_since_keyframe = 0
+
+    def encode(self, position):
+        position = [int(angle) for angle in position]
+        if len(position) != 6 or min(position) < 0 or max(position) > 255:
+            raise ValueError(f'expected 6 servo angles between 0 and 255, got {position}')
+
+        frame = None
+        if self.use_delta and self.last_position is not None and self.frames_since_keyframe < self.keyframe_interval:
+            deltas = [new - old for new, old in zip(position, self.last_position)]
+            if delta_min <= min(deltas) and max(deltas) <= delta_max:
+                frame = encode_delta(deltas, self.seq)
+                self.frames_since_keyframe += 1
+        if frame is None:
+            frame = encode_absolute(position, self.seq)
+            self.frames_since_keyframe = 0
+
+        self.seq = (self.seq + 1) & 0xFF
+        self.last_position = position
+        return frame
+
+    def reset(self):
+        # the next frame is an absolute frame, e.g. after an upload: the firmware restarts the sequence
+        self.last_position = None
+        self.frames_since_keyframe = 0
+
+class AsciiEncoder:
+    '''
+    Encodes a stream of servo positions in the original ASCII format, same interface as `FrameEncoder`.
+    '''
+    def encode(self, position):
+        return encode_ascii(position)
+
+    def reset(self):
+        pass
+
+#######################################
+# decoding (same state machine as the firmware)
+#######################################
+class FrameDecoder:
+    '''
+    Decodes a byte stream containing ASCII and/or binary frames, same as the firmware does.
+    Bytes can be fed in chunks of any size; `feed` returns the list of complete positions decoded so far.
+    Queue and control frames are not positions, they are added to `messages` in order:
+            ('queue', seq, ticks, position) and ('control', command)
+    Counters:
+            frames_ok (int): number of frames decoded
+            frames_dropped (int): number of frames with a wrong CRC, or delta frames after a lost frame
+            handshakes (int): number of negotiation frames received
+    '''
+    def __init__(self):
+        self.ascii_buffer = bytearray()
+        self.binary_buffer = bytearray()
+        self.binary_expected = 0
+        self.position = None
+        self.last_seq = None
+
+        self.frames_ok = 0
+        self.frames_dropped = 0
+        self.handshakes = 0
+        self.messages = []
+
+    def feed(self, data):
+        positions = []
+        for byte in data:
+            position = self.feed_byte(byte)
+            if position is not None:
+                positions.append(position)
+        return positions
+
+    def feed_byte(self, byte):
+        # in the middle of a binary frame
+        if self.binary_buffer:
+            self.binary_buffer.append(byte)
+            if len(self.binary_buffer) == 2:
+                self.binary_expected = frame_lengths.get(byte)
+                if self.binary_expected is None:
+                    self.binary_buffer.clear()
+                    self.frames_dropped += 1
+            elif len(self.binary_buffer) == self.binary_expected:
+                frame = bytes(self.binary_buffer)
+                self.binary_buffer.clear()
+                return self.decode_binary(frame)
+            return None
+
+        # start of a binary frame
+        if byte == SYNC:
+            self.ascii_buffer.clear()
+            self.binary_buffer.append(byte)
+            return None
+
+        # ASCII line
+        if byte == ord('\n'):
+            line = bytes(self.ascii_buffer)
+            self.ascii_buffer.clear()
+            return self.decode_ascii(line)
+        if len(self.ascii_buffer) < 24:
+            self.ascii_buffer.append(byte)
+        return None
+
+    def decode_ascii(self, line):
+        line = line.rstrip(b'\r')
+        handshake = line.endswith(b'B')
+        if handshake:
+            line = line[:-1]
+        if len(line) != 18 or not line.isdigit():
+            self.frames_dropped += 1
+            return None
+        if handshake:
+            self.handshakes += 1
+        self.position = [int(line[i:i+3]) for i in range(0, 18, 3)]
+        # an ASCII frame is absolute, but the binary sequence has to restart with an absolute frame
+        self.last_seq = None
+        self.frames_ok += 1
+        return list(self.position)
+
+    def decode_binary(self, frame):
+        if crc8(frame[1:-1]) != frame[-1]:
+            self.last_seq = None
+            self.frames_dropped += 1
+            return None
+        frame_type, seq = frame[1], frame[2]
+
+        if frame_type == FRAME_QUEUE:
+            self.messages.append(('queue', seq, frame[3] | (frame[4] << 8), list(frame[5:11])))
+            return None
+        if frame_type == FRAME_CONTROL:
+            self.messages.append(('control', frame[3]))
+            return None
+
+        if frame_type == FRAME_ABSOLUTE:
+            self.position = list(frame[3:9])
+        else:
+            # a delta frame is only valid right after the previous frame
+            if self.position is None or self.last_seq is None or seq != (self.last_seq + 1) & 0xFF:
+                self.last_seq = None
+                self.frames_dropped += 1
+                return None
+            deltas = []
+            for packed in frame[3:6]:
+                for nibble in (packed >> 4, packed & 0x0F):
+                    deltas.append(nibble - 16 if nibble > 7 else nibble)
+            self.position = [angle + delta for angle, delta in zip(self.position, deltas)]
+
+        self.last_seq = seq
+        self.frames_ok += 1
+        return list(self.position)
+
+#######################################
+# negotiation
+#######################################
+def negotiate(port, position, timeout=3.0, interval=0.25, log=print):
+    '''
+    Asks the firmware whether it supports the binary format.
+    Opening the port resets most ESP32 boards (DTR/RTS), a request sent while the board boots is lost,
+    so the request is sent again every `interval` seconds until the firmware answers or `timeout` runs out.
+    The boot messages of the board are read and dropped.
+        Parameters:
+                port (serial.Serial): the opened serial port of arduino
+                position (list): the current 6 servo angles, sent along with the request
+                timeout (float): time (s) to wait for the answer of the firmware, including its boot
+                interval (float): time (s) between two requests
+                log (function): called with a message when the host falls back to the ASCII format, optional
+
+        Returns:
+                encoder: `FrameEncoder` if the firmware answered, `AsciiEncoder` otherwise
+    '''
+    port.reset_input_buffer()
+    request = encode_handshake(position)
+
+    start = time.monotonic()
+    deadline = start + timeout
+    next_request = start
+    received = b''
+    dropped = 0
+    while time.monotonic() < deadline:
+        if time.monotonic() >= next_request:
+            port.write(request)
+            next_request += interval
+        waiting = port.in_waiting
+        if waiting:
+            received += port.read(waiting)
+            if HANDSHAKE_REPLY in received:
+                return FrameEncoder()
+            # drop the boot messages, only keep what may be the start of a reply
+            keep = len(HANDSHAKE_REPLY) - 1
+            dropped += max(len(received) - keep, 0)
+            received = received[-keep:]
+        else:
+            time.sleep(0.01)
+    if log is not None:
+        log(f'no answer to the binary format request in {timeout:g} s ({dropped + len(received)} bytes received), '
+            f'falling back to the ASCII format (no binary frames, no upload replays)')
+    return AsciiEncoder()
@@ -0,0 +1,165 @@
+#%%
+'''
+This module simplifies a trajectory: it removes the frames that can be left out without moving the arm more than
+a tolerance away from the recording, and keeps the timestamps of the other frames, so the replay keeps its timing.
+Unlike keeping every n-th frame (`!shorten.py`), static sections shrink to a few frames and fast moves keep their detail.
+
+Tolerance:
+    joint space: largest change (degrees) of any servo
+    cartesian space: distance (cm) of the jug position (forward kinematics of servos 1-3),
+                     servos 4-6 (wrist and gripper) are still checked in degrees with `wrist_tolerance`
+
+Modes:
+    hold: the replay holds each frame until the next one, so a frame is left out if it is within the tolerance
+          of the last kept frame (optimal for held frames, one pass over the frames)
+    linear: Ramer-Douglas-Peucker, a frame is left out if it is within the tolerance of the line between the kept
+            frames around it at the same time, for a replay that interpolates between the frames
+
+Command line:
+    python simplify.py heart/original_actions/1_first_turn.txt 1_first_turn_simplified.traj --tolerance 1
+    python simplify.py heart/original_actions/1_first_turn.txt 1_first_turn_simplified.traj --tolerance 0.2 --space cartesian
+'''
+#%%
+import numpy as np
+
+from trajectory import Trajectory
+
+#######################################
+# errors
+#######################################
+def _scaled_values(positions, space, tolerance, wrist_tolerance):
+    # values whose error is compared to 1: the servo angles (or jug coordinates) divided by their tolerance
+    positions = np.asarray(positions, dtype=float)
+    if space == 'joint':
+        return positions / tolerance, 0
+    if space == 'cartesian':
+        import kinematics
+
+        coordinates = kinematics.forward_kinematics_batch(positions) / tolerance
+        wrist = positions[:, 3:] / wrist_tolerance
+        return np.hstack([coordinates, wrist]), 3
+    raise ValueError(f'space has to be "joint" or "cartesian", got {space!r}')
+
+def _errors(values, reference, split):
+    # largest error of each frame: Euclidean distance for the coordinates (the first `split` columns),
+    # largest change for the angles
+    distance = np.linalg.norm(values[:, :split] - reference[..., :split], axis=-1) if split else 0
+    change = np.abs(values[:, split:] - reference[..., split:]).max(axis=-1, initial=0)
+    return np.maximum(distance, change)
+
+#######################################
+# simplification
+#######################################
+def hold_indices(values, split=0):
+    '''
+    Indices of the frames to keep for a replay holding each frame: a frame is kept when it moved
+    more than 1 (the values are divided by the tolerance) from the last kept frame.
+    '''
+    n = len(values)
+    if n <= 2:
+        return np.arange(n)
+    keep = [0]
+    start = 1
+    window = 64
+    while start < n:
+        # search the next frame outside the tolerance in growing windows, long static sections take few steps
+        end = min(n, start + window)
+        moved = np.flatnonzero(_errors(values[start:end], values[keep[-1]], split) > 1)
+        if len(moved):
+            keep.append(start + moved[0])
+            start = keep[-1] + 1
+            window = 64
+        else:
+            start = end
+            window *= 2
+    if keep[-1] != n - 1:
+        keep.append(n - 1)
+    return np.array(keep)
+
+def rdp_indices(values, times, split=0):
+    '''
+    Indices of the frames to keep with Ramer-Douglas-Peucker: a frame is left out if it is within 1
+    (the values are divided by the tolerance) of the line between the kept frames around it, at the same time.
+    '''
+    n = len(values)
+    if n <= 2:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        duration = times[last] - times[first]
+        weights = (times[first + 1:last] - times[first]) / duration if duration > 0 else np.zeros(last - first - 1)
+        reference = values[first] + weights[:, None] * (values[last] - values[first])
+        errors = _errors(values[first + 1:last], reference, split)
+        worst = np.argmax(errors)
+        if errors[worst] > 1:
+            middle = first + 1 + worst
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return np.flatnonzero(keep)
+
+def simplify_indices(positions, tolerance=1.0, space='joint', mode='hold', wrist_tolerance=1.0, times=None):
+    '''
+    Indices of the frames kept by the simplification.
+        Parameters:
+                positions (array): (N, 6) servo angles
+                tolerance (float): degrees in joint space, cm in cartesian space
+                space (str): 'joint' or 'cartesian'
+                mode (str): 'hold' or 'linear' (see the module docstring)
+                wrist_tolerance (float): degrees of servos 4-6 in cartesian space
+                times (array): (N,) timestamps (s) for the linear mode, evenly spaced by default
+
+        Returns:
+                indices (array): increasing indices, always with the first and last frame
+    '''
+    if tolerance <= 0 or wrist_tolerance <= 0:
+        raise ValueError('the tolerances have to be positive')
+    values, split = _scaled_values(positions, space, tolerance, wrist_tolerance)
+    if mode == 'hold':
+        return hold_indices(values, split)
+    if mode == 'linear':
+        times = np.arange(len(values), dtype=float) if times is None else np.asarray(times, dtype=float)
+        return rdp_indices(values, times, split)
+    raise ValueError(f'mode has to be "hold" or "linear", got {mode!r}')
+
+def simplify(trajectory, tolerance=1.0, space='joint', mode='hold', wrist_tolerance=1.0, period=None):
+    '''
+    Simplifies a trajectory, the kept frames keep their timestamps.
+        Parameters:
+                trajectory (Trajectory or array): (N, 6) servo positions
+                period (float): period (s) of the positions if the trajectory has no timestamps, defaults to its period
+                see `simplify_indices` for the other parameters
+
+        Returns:
+                trajectory (Trajectory): the kept positions, with their timestamps
+    '''
+    if not isinstance(trajectory, Trajectory):
+        trajectory = Trajectory(trajectory, period)
+    times = trajectory.frame_times(period)
+    indices = simplify_indices(trajectory.positions, tolerance, space, mode, wrist_tolerance, times)
+    return Trajectory(trajectory.positions[indices], trajectory.period if period is None else period,
+                      trajectory.source, times[indices])
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simplify a trajectory within a tolerance, keeping its timing.')
+    parser.add_argument('source')
+    parser.add_argument('output', help='.traj file, the txt format has no timestamps')
+    parser.add_argument('--period', type=float, default=0.1, help='period (s) of the recording, e.g. save_time')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='degrees (joint space) or cm (cartesian space)')
+    parser.add_argument('--space', choices=['joint', 'cartesian'], default='joint')
+    parser.add_argument('--mode', choices=['hold', 'linear'], default='hold')
+    parser.add_argument('--wrist-tolerance', type=float, default=1.0, help='degrees of servos 4-6 in cartesian space')
+    args = parser.parse_args()
+
+    trajectory = Trajectory.load(args.source, period=args.period)
+    simplified = simplify(trajectory, args.tolerance, args.space, args.mode, args.wrist_tolerance)
+    simplified.save(args.output)
+    print(f'{len(trajectory)} frames -> {len(simplified)} frames, {trajectory.duration():.2f} s')
+    print('saved: ' + args.output)
@@ -0,0 +1,55 @@
+import threading
+import time
+
+import numpy as np
+
+from esp32_simulator import ESP32Simulator, FakeSerial
+from orchestrator import Orchestrator
+
+
+class BlockedSerial(FakeSerial):
+    # a port that stopped answering: every write blocks until the test ends
+    def __init__(self, simulator, released):
+        super().__init__(simulator, port='blocked ESP32')
+        self.released = released
+
+    def write(self, data):
+        self.released.wait()
+        return super().write(data)
+
+
+def test_a_blocked_arm_does_not_hold_up_the_others():
+    positions = np.linspace([90, 60, 110, 90, 90, 90], [120, 70, 100, 90, 90, 60], 30).round()
+    simulators = {name: ESP32Simulator(time.monotonic, log_ticks=False) for name in ('left', 'right', 'blocked')}
+    released = threading.Event()
+    ports = {'left': FakeSerial(simulators['left']), 'right': FakeSerial(simulators['right']),
+             'blocked': BlockedSerial(simulators['blocked'], released)}
+    orchestrator = Orchestrator.connect(ports, replay_period=0.02, preflight=False, clamp_unreachable=False,
+                                        connect_timeout=0.5, ready_timeout=0.5, timeout_margin=2.0)
+    try:
+        start = time.monotonic()
+        results = orchestrator.run(positions)
+        elapsed = time.monotonic() - start
+        blocked_frames = simulators['blocked'].decoder.frames_ok
+    finally:
+        released.set()
+        orchestrator.close()
+
+    assert results['left']['status'] == 'finished'
+    assert results['right']['status'] == 'finished'
+    assert results['blocked']['status'] == 'stalled'
+
+    # the arms that connected start together and play the whole trajectory, on their own ESP32
+    assert results['left']['start_time'] == results['right']['start_time']
+    for name in ('left', 'right'):
+        assert results[name]['stats']['frames_played'] == len(positions)
+        np.testing.assert_array_equal(simulators[name].targets, positions[-1])
+    assert 'start_time' not in results['blocked']
+    assert blocked_frames == 0
+    # each arm counts its own serial traffic
+    metrics = [controller.metrics for controller in orchestrator.controllers.values()]
+    assert len({id(arm_metrics) for arm_metrics in metrics}) == 3
+    assert results['left']['metrics']['counters']['serial_bytes'] > 0
+
+    # the stalled arm is given up at its deadline (connect, ready and start), not waited for
+    assert elapsed < 5.0
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import pipeline
+from trajectory import Trajectory
+
+
+def test_simplify_keeps_the_timing():
+    positions = np.repeat([[90, 60, 110, 90, 90, 90], [95, 60, 110, 90, 90, 90]], [30, 20], axis=0)
+    # jitter within the tolerance is held at the kept action
+    positions[5:25:2, 0] += 1
+    simplified = np.array(list(pipeline.simplify(positions, tolerance=1.0)))
+    assert simplified.shape == positions.shape
+    assert np.abs(simplified - positions).max() <= 1
+
+    # only the holds shrink the output: the two kept actions and the last action
+    collapsed = pipeline.collect(simplified, period=0.15).collapse_holds(0.15)
+    assert len(collapsed) == 3
+    assert collapsed.duration(0.15) == pytest.approx(0.15 * (len(positions) - 1))
+
+
+def test_simplify_rejects_the_linear_mode():
+    positions = np.zeros((5, Trajectory.n_servos))
+    with pytest.raises(ValueError, match='simplify.py'):
+        list(pipeline.simplify(positions, mode='linear'))
@@ -0,0 +1,28 @@
+import numpy as np
+
+import preflight
+from trajectory import Trajectory
+
+
+def test_empty_input_is_ok():
+    for positions in ([], np.zeros((0, 6)), Trajectory(period=0.15)):
+        report = preflight.validate(positions, 0.15)
+        assert report.ok
+        assert report.n_frames == 0
+        assert not report.checks
+
+
+def test_single_frame():
+    report = preflight.validate([90, 60, 110, 90, 90, 90])
+    assert report.n_frames == 1
+    assert report.ok
+
+
+def test_width_and_limits():
+    report = preflight.validate([[90, 60, 110, 90, 90, 90], [90, 60, 110]])
+    assert report.errors == ['width']
+    np.testing.assert_array_equal(report.frames('width'), [1])
+
+    report = preflight.validate([[90, 60, 110, 90, 90, 90], [300, 60, 110, 90, 90, 90]])
+    assert not report.ok
+    assert 'joint_limits' in report.errors
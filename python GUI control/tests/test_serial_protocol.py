@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+
+import pytest
+
+import serial_protocol
+from serial_protocol import AsciiEncoder, FrameDecoder, FrameEncoder
+
+# smooth motion (mostly delta frames) followed by jumps (absolute frames)
+positions = [[90, 60, 110, 90 + i % 8, 90, 90 - i % 5] for i in range(200)]
+positions += [[(37 * i) % 181, 60, 110, 180, 90, 60] for i in range(50)]
+
+
+class SilentPort:
+    # an old firmware: ignores the binary format request, prints a boot message
+    def __init__(self):
+        self.output = bytearray(b'ets Jun  8 2016 00:22:57\r\nrst:0x1 (POWERON_RESET)\r\n')
+        self.written = bytearray()
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self.output)
+
+    def read(self, size=1):
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        return data
+
+    def reset_input_buffer(self):
+        pass
+
+
+def test_absolute_round_trip():
+    decoder = FrameDecoder()
+    frame = serial_protocol.encode_absolute([0, 60, 110, 180, 255, 90], 7)
+    assert len(frame) == serial_protocol.ABSOLUTE_LENGTH
+    assert decoder.feed(frame) == [[0, 60, 110, 180, 255, 90]]
+    assert decoder.last_seq == 7
+
+
+def test_delta_round_trip():
+    encoder = FrameEncoder()
+    decoder = FrameDecoder()
+    frames = [encoder.encode(position) for position in ([90, 60, 110, 90, 90, 90], [97, 52, 110, 91, 89, 90])]
+    assert [len(frame) for frame in frames] == [serial_protocol.ABSOLUTE_LENGTH, serial_protocol.DELTA_LENGTH]
+    assert decoder.feed(b''.join(frames)) == [[90, 60, 110, 90, 90, 90], [97, 52, 110, 91, 89, 90]]
+    assert decoder.frames_dropped == 0
+
+
+def test_queue_round_trip():
+    decoder = FrameDecoder()
+    frame = serial_protocol.encode_queue([90, 60, 110, 90, 90, 90], 1000, 258)
+    assert len(frame) == serial_protocol.QUEUE_LENGTH
+    assert decoder.feed(frame) == []
+    assert decoder.messages == [('queue', 2, 1000, [90, 60, 110, 90, 90, 90])]
+    with pytest.raises(ValueError):
+        serial_protocol.encode_queue([90, 60, 110, 90, 90, 90], 0, 0)
+
+
+def test_stream_round_trip_in_chunks():
+    encoder = FrameEncoder()
+    data = b''.join(encoder.encode(position) for position in positions)
+    decoder = FrameDecoder()
+    decoded = []
+    for start in range(0, len(data), 13):
+        decoded += decoder.feed(data[start:start + 13])
+    assert decoded == positions
+    assert decoder.frames_dropped == 0
+
+
+def test_wrong_crc_is_dropped():
+    decoder = FrameDecoder()
+    frame = bytearray(serial_protocol.encode_absolute([90, 60, 110, 90, 90, 90], 0))
+    frame[5] ^= 0x01
+    assert decoder.feed(bytes(frame)) == []
+    assert decoder.frames_dropped == 1
+    assert decoder.frames_ok == 0
+
+
+def test_seq_gap_recovers_at_the_keyframe():
+    encoder = FrameEncoder(keyframe_interval=5)
+    frames = [encoder.encode([90 + i, 60, 110, 90, 90, 90]) for i in range(12)]
+    assert [len(frame) for frame in frames].count(serial_protocol.ABSOLUTE_LENGTH) == 2
+
+    # frame 2 is lost: the deltas after it are dropped until the next absolute frame (frame 6)
+    decoder = FrameDecoder()
+    decoded = decoder.feed(b''.join(frames[:2] + frames[3:]))
+    assert decoded == [[90 + i, 60, 110, 90, 90, 90] for i in (0, 1, 6, 7, 8, 9, 10, 11)]
+    assert decoder.frames_dropped == 3
+
+
+def test_reset_restarts_with_an_absolute_frame():
+    encoder = FrameEncoder()
+    encoder.encode([90, 60, 110, 90, 90, 90])
+    encoder.reset()
+    assert len(encoder.encode([91, 60, 110, 90, 90, 90])) == serial_protocol.ABSOLUTE_LENGTH
+
+
+def test_handshake():
+    decoder = FrameDecoder()
+    assert decoder.feed(serial_protocol.encode_handshake([90, 60, 110, 90, 90, 90])) == [[90, 60, 110, 90, 90, 90]]
+    assert decoder.handshakes == 1
+
+
+def test_ascii_fallback_without_answer():
+    port = SilentPort()
+    messages = []
+    encoder = serial_protocol.negotiate(port, [90, 60, 110, 90, 90, 90], timeout=0.3, interval=0.1,
+                                        log=messages.append)
+    assert isinstance(encoder, AsciiEncoder)
+    assert port.written.count(b'B\n') >= 2
+    assert len(messages) == 1 and 'ASCII' in messages[0]
+    assert encoder.encode([90, 60, 110, 90, 90, 90]) == b'090060110090090090\n'
+
+
+@pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pseudo terminal (linux/mac)')
+def test_loopback_over_a_pseudo_terminal():
+    serial = pytest.importorskip('serial')
+
+    master, slave = os.openpty()
+    port = serial.Serial(os.ttyname(slave), 115200, timeout=0)
+    decoder = FrameDecoder()
+    decoded = []
+    stop = threading.Event()
+
+    def firmware():
+        # reply to the handshake, decode everything else
+        while not stop.is_set():
+            try:
+                data = os.read(master, 256)
+            except OSError:
+                break
+            handshakes = decoder.handshakes
+            decoded.extend(decoder.feed(data))
+            if decoder.handshakes != handshakes:
+                os.write(master, serial_protocol.HANDSHAKE_REPLY + b'\n')
+
+    thread = threading.Thread(target=firmware, daemon=True)
+    thread.start()
+    try:
+        encoder = serial_protocol.negotiate(port, positions[0], timeout=2.0)
+        assert isinstance(encoder, FrameEncoder)
+        decoded.clear()
+        for position in positions:
+            port.write(encoder.encode(position))
+        port.flush()
+
+        deadline = time.monotonic() + 2.0
+        while len(decoded) < len(positions) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        port.close()
+        os.close(slave)
+        thread.join(2.0)
+        os.close(master)
+
+    assert decoded == positions
+    assert decoder.frames_dropped == 0
@@ -0,0 +1,118 @@
+import numpy as np
+
+import serial_protocol
+from arm_controller import ArmController
+from esp32_simulator import ESP32Simulator, FakeSerial, VirtualClock, simulate_upload
+from upload import Uploader
+
+
+def make_positions(n):
+    # a slow sweep of every servo, no two neighbouring frames alike
+    steps = np.arange(n)
+    return np.column_stack([90 + 30 * np.sin(steps / 40 + servo) for servo in range(6)]).round()
+
+
+def make_uploader(positions, on_progress=None, queue_size=512):
+    clock = VirtualClock()
+    simulator = ESP32Simulator(clock, initial_positions=positions[0], initial_smooth=positions[0],
+                               log_ticks=False, queue_size=queue_size)
+    arduino = FakeSerial(simulator)
+
+    def sleep(seconds):
+        clock.sleep(seconds)
+        simulator.advance_to(clock.now())
+
+    uploader = Uploader(arduino.write, lambda: arduino.read(arduino.in_waiting), period=0.02,
+                        on_progress=on_progress, clock=clock.now, sleep=sleep)
+    return simulator, uploader
+
+
+def test_upload_refills_the_buffer():
+    positions = make_positions(300)
+    simulator, uploader = make_uploader(positions, queue_size=64)
+    uploader.run(positions)
+
+    stats = uploader.stats()
+    assert stats['frames_played'] == len(positions)
+    assert stats['frames_uploaded'] == len(positions)
+    assert stats['frames_resent'] == 0
+    assert simulator.queue_played == len(positions)
+    assert simulator.queue_state == serial_protocol.STATE_FINISHED
+    np.testing.assert_array_equal(simulator.targets, positions[-1])
+
+
+def test_upload_resends_lost_frames():
+    positions = make_positions(600)
+    simulator, stats = simulate_upload(positions, period=0.02, error_rate=0.05, seed=1)
+
+    assert stats['frames_resent'] > 0
+    assert stats['frames_played'] == len(positions)
+    assert simulator.queue_played == len(positions)
+    np.testing.assert_array_equal(simulator.targets, positions[-1])
+
+
+def test_upload_pause_and_resume():
+    positions = make_positions(300)
+    played = []
+
+    def on_progress(progress):
+        played.append(progress['frames_played'])
+        if len(played) == 20:
+            uploader.pause()
+        elif len(played) == 60:
+            uploader.resume()
+
+    simulator, uploader = make_uploader(positions, on_progress)
+    uploader.run(positions)
+
+    # the firmware stops playing while paused, then plays the rest
+    paused = played[25:60]
+    assert paused[0] == paused[-1] < len(positions)
+    assert uploader.stats()['frames_played'] == len(positions)
+    assert simulator.queue_played == len(positions)
+
+
+def test_upload_abort():
+    positions = make_positions(300)
+    finished = []
+
+    def on_progress(progress):
+        if progress['frames_played'] >= 50:
+            uploader.abort()
+
+    simulator, uploader = make_uploader(positions, on_progress)
+    uploader.on_finish = lambda: finished.append(True)
+    uploader.run(positions)
+
+    # the buffer of the firmware is cleared, nothing is played after the abort
+    assert finished == [True]
+    assert simulator.queue_state == serial_protocol.STATE_IDLE
+    assert len(simulator.queue) == 0
+    assert uploader.finished.is_set()
+
+
+def test_live_frames_after_upload():
+    # the firmware restarts the binary sequence after an upload, the first live frame has to be absolute
+    simulator = ESP32Simulator(log_ticks=False)
+    controller = ArmController(replay_period=0.02, preflight=False, clamp_unreachable=False, collapse_holds=False)
+    encoder = controller.connect(FakeSerial(simulator))
+    assert isinstance(encoder, serial_protocol.FrameEncoder)
+    assert controller.player is controller.uploader
+
+    controller.set_positions([91, 60, 110, 90, 90, 90])
+    controller.send()
+    np.testing.assert_array_equal(simulator.targets, [91, 60, 110, 90, 90, 90])
+
+    positions = np.linspace([91, 60, 110, 90, 90, 90], [93, 60, 110, 90, 90, 90], 10).round()
+    controller.play(positions)
+    controller.wait(10.0)
+    assert not controller.running
+    np.testing.assert_array_equal(simulator.targets, [93, 60, 110, 90, 90, 90])
+
+    dropped = simulator.decoder.frames_dropped
+    for position in ([94, 60, 110, 90, 90, 90], [95, 60, 110, 90, 90, 90], [96, 61, 110, 90, 90, 90]):
+        controller.set_positions(position)
+        controller.send()
+        np.testing.assert_array_equal(simulator.targets, position)
+    assert simulator.decoder.frames_dropped == dropped
+    controller.close()
@@ -0,0 +1,229 @@
+#%%
+'''
+This module extends the kinematics of servos 1-3 (see `kinematics.py`) with the wrist (servo 4 and 5) and the jug,
+so the position of the spout and the tilt of the jug are known for every frame of a trajectory.
+Both directions are vectorised: a whole trajectory is solved in one call.
+
+Geometry (angles in servo degrees, lengths in cm):
+    servo 4 (wrist pitch) turns the wrist in the plane of the arm, like servos 2 and 3 its angle adds up along the arm:
+        the wrist axis is at the angle q = servo2 + servo3 + (servo4 - wrist_zero) in that plane
+        (q = servo2 + servo3 is the direction of link 3, the angle `kinematics.py` uses for the height)
+    servo 5 (wrist roll) rolls the gripper around the wrist axis by servo5 - roll_zero
+    the jug is held at `jug_angle` from the normal of the wrist axis, its frame is:
+        up: the axis of the jug, vertical when the jug is upright
+        forward: perpendicular to `up` in the plane of the arm, the direction the jug tips when it tilts
+        side: completes the right-handed frame
+    the spout is at `spout_offset` (forward, side, up) in the frame of the jug, from the end of link 3
+    the tilt is the angle (degrees) between the axis of the jug and the vertical, 0 when upright
+
+Calibration:
+`jug_angle` is computed so the jug is upright in `carry_pose`, the last position of heart/original_actions/2_lift_jug.txt,
+and `spout_offset` is an estimate of the jug; measure it on your jug and change it here.
+With these values, the pours tilt the jug by 48-78 degrees (11_heart_1, 12_heart_2, 11_tulip_1, 12_tulip_2)
+up to 90 degrees at the end of 13_tulip_3, and the rocking (9_rock_jug) tilts it by up to 35 degrees.
+`python tool_kinematics.py` checks that the carry pose is upright.
+
+    Usage:
+            spout, tilt = spout_pose_batch(Trajectory.load('heart/heart.txt'))
+            positions, reachable = hold_spout_batch(spout_xy, height=20, tilt=30, base=[90, 60, 110, 180, 180, 90])
+
+Command line:
+    python tool_kinematics.py heart/heart.txt -o heart_spout.csv
+'''
+#%%
+import numpy as np
+
+import kinematics
+
+#######################################
+# wrist and jug geometry
+#######################################
+# servo 4 angle (degrees) of a straight wrist, the wrist axis continues link 3
+wrist_zero = 90.
+# servo 5 angle (degrees) without roll
+roll_zero = 180.
+# servo angles (degrees) carrying the upright jug, the last position of heart/original_actions/2_lift_jug.txt
+carry_pose = np.array([177., 67., 84., 180., 180., 90.])
+# angle (degrees) of the axis of the jug from the normal of the wrist axis, in the plane of the arm:
+# the wrist angle q of the carry pose, so the axis of the jug is vertical there
+jug_angle = float(np.mod(carry_pose[1] + carry_pose[2] + (carry_pose[3] - wrist_zero) + 180., 360.) - 180.)
+# (forward, side, up) position of the spout in the frame of the jug, from the end of link 3 (cm)
+spout_offset = np.array([6.0, 0.0, 4.0])
+
+#######################################
+# forward kinematics
+#######################################
+def wrist_angles(servo_angles):
+    # angle q of the wrist axis in the plane of the arm and roll r around it (radians), (N,) each
+    servo_angles = np.deg2rad(np.asarray(servo_angles, dtype=float).reshape(-1, 6))
+    q = servo_angles[:, 1] + servo_angles[:, 2] + (servo_angles[:, 3] - np.deg2rad(wrist_zero))
+    return q, servo_angles[:, 4] - np.deg2rad(roll_zero)
+
+def arm_plane(servo1):
+    # unit vectors of the plane of the arm: reach direction u (horizontal), z, and the side s = u x z, (N, 3) each
+    servo1 = np.deg2rad(np.asarray(servo1, dtype=float))
+    u = np.stack([np.sin(servo1), -np.cos(servo1), np.zeros_like(servo1)], axis=-1)
+    z = np.broadcast_to([0., 0., 1.], u.shape)
+    return u, z, np.cross(u, z)
+
+def jug_axes(q, roll, u, z, s, jug_angle=jug_angle):
+    # forward, side and up axes of the jug, (N, 3) each, from the wrist angle q and roll (radians, (N,))
+    # and the plane of the arm (see `arm_plane`)
+    q, roll = q[:, None], roll[:, None]
+    # wrist axis w and its normal g in the plane of the arm, rolled around w
+    w = np.cos(q) * u + np.sin(q) * z
+    g = -np.sin(q) * u + np.cos(q) * z
+    g, s = np.cos(roll) * g + np.sin(roll) * s, -np.sin(roll) * g + np.cos(roll) * s
+
+    # the jug is `jug_angle` further than the normal of the wrist axis
+    j = np.deg2rad(jug_angle)
+    up = np.sin(j) * w + np.cos(j) * g
+    forward = np.cos(j) * w - np.sin(j) * g
+    return forward, np.cross(up, forward), up
+
+def jug_frames_batch(servo_angles, jug_angle=jug_angle):
+    '''
+    Orientation of the jug for N servo positions.
+        Parameters:
+                servo_angles (array): (N, 6) servo angles (degrees), e.g. a whole trajectory file
+                jug_angle (float): angle (degrees) of the axis of the jug from the normal of the wrist axis
+
+        Returns:
+                frames (array): (N, 3, 3) the columns are the forward, side and up axes of the jug
+    '''
+    servo_angles = np.asarray(servo_angles, dtype=float).reshape(-1, 6)
+    q, roll = wrist_angles(servo_angles)
+    return np.stack(jug_axes(q, roll, *arm_plane(servo_angles[:, 0]), jug_angle), axis=-1)
+
+def spout_pose_batch(servo_angles, spout_offset=spout_offset, jug_angle=jug_angle):
+    '''
+    Position of the spout and tilt of the jug for N servo positions in one vectorised pass.
+        Parameters:
+                servo_angles (array): (N, 6) servo angles (degrees), e.g. a whole trajectory file
+                spout_offset (array): (3,) (forward, side, up) position of the spout in the frame of the jug (cm)
+                jug_angle (float): angle (degrees) of the axis of the jug from the normal of the wrist axis
+
+        Returns:
+                spout (array): (N, 3) x,y,z coordinates of the spout (cm)
+                tilt (array): (N,) angle (degrees) between the axis of the jug and the vertical
+    '''
+    servo_angles = np.asarray(servo_angles, dtype=float).reshape(-1, 6)
+    frames = jug_frames_batch(servo_angles, jug_angle)
+    spout = kinematics.forward_kinematics_batch(servo_angles) + frames @ np.asarray(spout_offset, dtype=float)
+    tilt = np.rad2deg(np.arccos(np.clip(frames[:, 2, 2], -1., 1.)))
+    return spout, tilt
+
+def spout_pose(servo_angles, spout_offset=spout_offset, jug_angle=jug_angle):
+    '''
+    Position of the spout and tilt of the jug of a single servo position (see `spout_pose_batch`).
+        Returns:
+                spout (array): (3,) x,y,z coordinates of the spout (cm)
+                tilt (float): angle (degrees) between the axis of the jug and the vertical
+    '''
+    spout, tilt = spout_pose_batch(servo_angles, spout_offset, jug_angle)
+    return spout[0], float(tilt[0])
+
+#######################################
+# inverse kinematics holding the spout height and the tilt
+#######################################
+def hold_spout_batch(spout_xy, height, tilt, base, spout_offset=spout_offset, jug_angle=jug_angle):
+    '''
+    Servo positions moving the spout through N horizontal positions at a constant height and tilt,
+    e.g. to draw a pattern with the spout while pouring. Servo 5 (roll) and 6 are kept from `base`.
+    The wrist angle holding the tilt has two solutions (tipping forward or backward), and the arm has up to 4;
+    the ones closest to `base` are chosen.
+        Parameters:
+                spout_xy (array): (N, 2) x,y coordinates of the spout (cm)
+                height (float or array): z coordinate of the spout (cm), per position if an array
+                tilt (float or array): tilt of the jug (degrees), per position if an array
+                base (array): (6,) servo angles of the current position, e.g. the last position before the pour
+                spout_offset (array): (3,) (forward, side, up) position of the spout in the frame of the jug (cm)
+                jug_angle (float): angle (degrees) of the axis of the jug from the normal of the wrist axis
+
+        Returns:
+                positions (array): (N, 6) servo angles (degrees)
+                reachable (array): (N,) True if the spout position and tilt are reachable within the servo limits
+    '''
+    spout_xy = np.asarray(spout_xy, dtype=float).reshape(-1, 2)
+    spout_offset = np.asarray(spout_offset, dtype=float)
+    n = len(spout_xy)
+    height = np.broadcast_to(np.asarray(height, dtype=float), (n,))
+    tilt = np.deg2rad(np.broadcast_to(np.asarray(tilt, dtype=float), (n,)))
+    base = np.asarray(base, dtype=float)
+    base_q, roll = wrist_angles(base)
+    roll = roll[0]
+
+    # wrist angle q giving the tilt: the vertical component of `up` is sin(j) sin(q) + cos(j) cos(roll) cos(q)
+    j = np.deg2rad(jug_angle)
+    a, b = np.sin(j), np.cos(j) * np.cos(roll)
+    amplitude, phase = np.hypot(a, b), np.arctan2(b, a)
+    ratio = np.cos(tilt) / amplitude
+    reachable = np.abs(ratio) <= 1.
+    angle = np.arcsin(np.clip(ratio, -1., 1.))
+    candidates = np.stack([angle - phase, np.pi - angle - phase])
+    # the solution closest to the wrist angle of the base position
+    difference = np.abs(np.mod(candidates - base_q[0] + np.pi, 2 * np.pi) - np.pi)
+    q = candidates[np.argmin(difference, axis=0), np.arange(n)]
+
+    # offset of the spout from the end of link 3 in the plane of the arm: along u (rho), z (zeta) and the side (tau),
+    # the same for every yaw, so it is computed with servo 1 at 0
+    forward, side, up = jug_axes(q, np.full(n, roll), *arm_plane(np.zeros(n)), jug_angle)
+    offset = spout_offset[0] * forward + spout_offset[1] * side + spout_offset[2] * up
+    rho, tau, zeta = -offset[:, 1], -offset[:, 0], offset[:, 2]
+
+    # yaw of servo 1: the spout is at (r + rho) u + tau s, with r the reach of link 3 (negative behind the base);
+    # reaching forward or backward, the yaw closest to the base position is chosen
+    distance = np.hypot(spout_xy[:, 0], spout_xy[:, 1])
+    reachable &= distance >= np.abs(tau)
+    reach = np.sqrt(np.clip(distance**2 - tau**2, 0., None))
+    reach = np.stack([reach, -reach])
+    yaw = np.rad2deg(np.arctan2(spout_xy[:, 0], -spout_xy[:, 1]) + np.arctan2(tau, reach))
+    yaw = kinematics.wrap_angles(yaw[..., None], kinematics.servo_limits[:1])[..., 0]
+    branch = np.argmin(np.abs(np.mod(yaw - base[0] + 180., 360.) - 180.), axis=0)
+    servo1, reach = yaw[branch, np.arange(n)], reach[branch, np.arange(n)]
+    u, _, _ = arm_plane(servo1)
+
+    # end of link 3, solved with the closed form inverse kinematics of servos 1-3
+    end = (reach - rho)[:, None] * u
+    end[:, 2] = height - zeta
+    seed = np.column_stack([servo1, np.broadcast_to(base[1:3], (n, 2))])
+    servo_3angles, arm_reachable = kinematics.inverse_kinematics_batch(end, seed=seed)
+    # the other yaw branch points the jug the other way
+    same_yaw = np.abs(np.mod(servo_3angles[:, 0] - servo1 + 180., 360.) - 180.) < 1e-6
+    reachable &= arm_reachable & same_yaw
+
+    # servo 4 from the wrist angle, within its rotation range
+    servo4 = np.rad2deg(q) - servo_3angles[:, 1] - servo_3angles[:, 2] + wrist_zero
+    servo4 = kinematics.wrap_angles(servo4[:, None], np.array([[0., 180.]]))[:, 0]
+    reachable &= (servo4 >= -kinematics.limit_tolerance) & (servo4 <= 180. + kinematics.limit_tolerance)
+
+    positions = np.tile(base, (n, 1))
+    positions[:, :3] = servo_3angles
+    positions[:, 3] = np.clip(servo4, 0., 180.)
+    return positions, reachable
+
+if __name__ == '__main__':
+    import argparse
+
+    from trajectory import Trajectory
+
+    parser = argparse.ArgumentParser(description='Position of the spout and tilt of the jug of a trajectory file.')
+    parser.add_argument('filename', nargs='?', help='trajectory file, without it only the calibration is checked')
+    parser.add_argument('-o', '--output', help='csv file with the spout position and tilt of every frame')
+    args = parser.parse_args()
+
+    _, carry_tilt = spout_pose(carry_pose)
+    assert carry_tilt < 1., f'the jug is not upright in the carry pose, it tilts by {carry_tilt:.1f} degrees'
+    print(f'carry pose: tilt {carry_tilt:.1f} degrees')
+    if args.filename is None:
+        raise SystemExit(0)
+
+    positions = Trajectory.load(args.filename).positions
+    spout, tilt = spout_pose_batch(positions)
+    print(f'{len(positions)} frames')
+    print(f'spout height: {spout[:, 2].min():.1f} to {spout[:, 2].max():.1f} cm')
+    print(f'tilt: {tilt.min():.1f} to {tilt.max():.1f} degrees')
+    if args.output:
+        np.savetxt(args.output, np.column_stack([np.arange(len(positions)), spout, tilt]), delimiter=',',
+                   fmt=['%d', '%.2f', '%.2f', '%.2f', '%.2f'], header='frame,x,y,z,tilt', comments='')
+        print('saved: ' + args.output)
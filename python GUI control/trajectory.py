@@ -0,0 +1,285 @@
+#%%
+'''
+This module defines `Trajectory`, a list of servo positions stored in one contiguous (N, 6) numpy array.
+Appending positions grows the array by doubling its capacity, so recording does not create a python list per frame.
+    Parameters:
+            positions (array): (N, 6) servo angles, optional
+            period (float): sample period (s) of the positions, e.g. `save_time` of the recording, optional
+            source (str): the file the positions were loaded from, optional
+            times (array): (N,) time (s) each position is sent, e.g. after `retime.retime`, optional
+                           without timestamps the positions are sent every `period`
+
+    Usage:
+            trajectory = Trajectory.load('heart/heart.txt')
+            trajectory[0]                  # first position, (6,) array
+            trajectory[::10]               # every 10th position, a new Trajectory
+            trajectory.servo(3)            # angles of servo 4, (N,) view
+            trajectory + other             # concatenation, a new Trajectory
+            trajectory.append([90, 60, 110, 90, 90, 90])
+            trajectory.collapse_holds(0.15)  # repeated positions as one frame with its dwell time
+            trajectory.save('heart.traj')
+'''
+#%%
+import numpy as np
+
+import trajectory_io
+
+#######################################
+# trajectory
+#######################################
+class Trajectory:
+    dtype = np.int16
+    n_servos = trajectory_io.n_servos
+
+    def __init__(self, positions=None, period=None, source=None, times=None):
+        if positions is None:
+            positions = np.zeros((0, self.n_servos), dtype=self.dtype)
+        positions = np.asarray(positions)
+        if positions.ndim == 1 and len(positions) == 0:
+            positions = positions.reshape(0, self.n_servos)
+        if positions.ndim != 2 or positions.shape[1] != self.n_servos:
+            raise ValueError(f'expected positions with {self.n_servos} servo angles each, got shape {positions.shape}')
+
+        self._data = np.array(np.rint(positions) if positions.dtype.kind == 'f' else positions, dtype=self.dtype)
+        self._length = len(self._data)
+        self.period = period
+        self.source = source
+
+        self._times = None
+        if times is not None:
+            times = np.array(times, dtype=float)
+            if times.shape != (self._length,):
+                raise ValueError(f'expected {self._length} timestamps, got shape {times.shape}')
+            self._times = times
+
+    #######################################
+    # loading and saving
+    #######################################
+    @classmethod
+    def load(cls, filename, period=None):
+        return cls(trajectory_io.load(filename), period=period, source=filename, times=trajectory_io.load_times(filename))
+
+    def save(self, filename):
+        trajectory_io.save(filename, self.positions, self.times, self.period)
+
+    #######################################
+    # array access
+    #######################################
+    @property
+    def positions(self):
+        # (N, 6) view of the stored positions
+        return self._data[:self._length]
+
+    def __array__(self, dtype=None, copy=None):
+        positions = self.positions
+        if dtype is not None:
+            return positions.astype(dtype)
+        return positions.copy() if copy else positions
+
+    @property
+    def times(self):
+        # (N,) view of the timestamps, None if the positions are sent every `period`
+        if self._times is None:
+            return None
+        return self._times[:self._length]
+
+    @times.setter
+    def times(self, times):
+        if times is None:
+            self._times = None
+            return
+        times = np.array(times, dtype=float)
+        if times.shape != (self._length,):
+            raise ValueError(f'expected {self._length} timestamps, got shape {times.shape}')
+        self._times = times
+
+    def frame_times(self, period=None):
+        '''
+        Returns the timestamps (s) of the positions, `period` (or `self.period`) apart if the trajectory has none.
+        '''
+        if self._times is not None:
+            return self.times
+        period = self.period if period is None else period
+        if period is None:
+            raise ValueError('the trajectory has no timestamps and no period')
+        return np.arange(self._length) * float(period)
+
+    def duration(self, period=None):
+        # time (s) from the first to the last position
+        if self._length == 0:
+            return 0.0
+        times = self.frame_times(period)
+        return float(times[-1] - times[0])
+
+    def collapse_holds(self, period=None):
+        '''
+        Collapses repeated positions into one frame held until the next change. The timestamps keep the dwell time,
+        so the replay waits instead of sending the same position again. The last frame is kept, so the duration is the same.
+            Parameters:
+                    period (float): time (s) between two positions if the trajectory has no timestamps, defaults to `self.period`
+
+            Returns:
+                    trajectory (Trajectory): the positions that changed, with their timestamps
+        '''
+        times = self.frame_times(period)
+        period = self.period if period is None else period
+        keep = np.ones(self._length, dtype=bool)
+        if self._length > 2:
+            keep[1:-1] = np.any(self.positions[1:-1] != self.positions[:-2], axis=1)
+        return Trajectory(self.positions[keep], period, self.source, times[keep])
+
+    def resample(self, period=None):
+        '''
+        Positions held at every `period` from the first timestamp, e.g. to save a collapsed or recorded trajectory
+        as txt, or to expand the holds again.
+            Returns:
+                    trajectory (Trajectory): without timestamps, `period` apart
+        '''
+        period = self.period if period is None else period
+        if period is None:
+            raise ValueError('give the period to resample the trajectory')
+        if self._length == 0:
+            return Trajectory(period=period, source=self.source)
+        times = self.frame_times(period)
+        samples = times[0] + np.arange(int(np.floor((times[-1] - times[0]) / period + 1e-9)) + 1) * period
+        indices = np.searchsorted(times, samples + 1e-9, side='right') - 1
+        return Trajectory(self.positions[indices], period, self.source)
+
+    def servo(self, index):
+        # (N,) view of the angles of one servo, index 0 is servo 1
+        return self.positions[:, index]
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            times = None if self._times is None else self.times[key]
+            return Trajectory(self.positions[key], self.period, self.source, times)
+        return self.positions[key]
+
+    def __setitem__(self, key, value):
+        self.positions[key] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, Trajectory):
+            return NotImplemented
+        return np.array_equal(self.positions, other.positions)
+
+    def __repr__(self):
+        timed = ', timed' if self._times is not None else ''
+        return f'Trajectory({self._length} positions, period={self.period}, source={self.source!r}{timed})'
+
+    @property
+    def last(self):
+        return self.positions[-1] if self._length else None
+
+    def tolist(self):
+        return self.positions.tolist()
+
+    def copy(self):
+        return Trajectory(self.positions, self.period, self.source, self.times)
+
+    #######################################
+    # growing and shrinking
+    #######################################
+    def _reserve(self, length):
+        # double the capacity until `length` positions fit
+        if length <= len(self._data):
+            return
+        capacity = max(16, len(self._data))
+        while capacity < length:
+            capacity *= 2
+        data = np.empty((capacity, self.n_servos), dtype=self.dtype)
+        data[:self._length] = self.positions
+        self._data = data
+        if self._times is not None:
+            times = np.empty(capacity)
+            times[:self._length] = self.times
+            self._times = times
+
+    def _next_times(self, n, times):
+        # timestamps of `n` new positions: given, or `period` after the last one
+        if times is None:
+            if self.period is None:
+                raise ValueError('the trajectory has timestamps, give the times of the new positions')
+            last = self._times[self._length - 1] if self._length else -self.period
+            return last + self.period * np.arange(1, n + 1)
+        times = np.asarray(times, dtype=float).reshape(-1)
+        if len(times) != n:
+            raise ValueError(f'expected {n} timestamps, got {len(times)}')
+        return times
+
+    def append(self, position, time=None):
+        # `time` is only used (and then required without a period) if the trajectory has timestamps,
+        # an empty trajectory gets timestamps from the first position appended with a time
+        if time is not None and self._times is None and self._length == 0:
+            self._times = np.zeros(len(self._data))
+        if self._times is not None:
+            time = self._next_times(1, time)[0]
+        self._reserve(self._length + 1)
+        self._data[self._length] = position
+        if self._times is not None:
+            self._times[self._length] = time
+        self._length += 1
+
+    def extend(self, positions, times=None):
+        positions = np.asarray(positions).reshape(-1, self.n_servos)
+        if times is not None and self._times is None and self._length == 0:
+            self._times = np.zeros(len(self._data))
+        if self._times is not None:
+            times = self._next_times(len(positions), times)
+        self._reserve(self._length + len(positions))
+        self._data[self._length:self._length + len(positions)] = positions
+        if self._times is not None:
+            self._times[self._length:self._length + len(positions)] = times
+        self._length += len(positions)
+
+    def pop(self):
+        if self._length == 0:
+            raise IndexError('pop from empty trajectory')
+        self._length -= 1
+        return self._data[self._length].copy()
+
+    def clear(self):
+        self._length = 0
+        self._times = None
+
+    #######################################
+    # concatenation
+    #######################################
+    def __add__(self, other):
+        return Trajectory.concatenate([self, other])
+
+    @classmethod
+    def concatenate(cls, trajectories):
+        # the metadata is taken from the first trajectory
+        trajectories = list(trajectories)
+        if len(trajectories) == 0:
+            return cls()
+        positions = np.concatenate([np.asarray(trajectory).reshape(-1, cls.n_servos) for trajectory in trajectories])
+        first = trajectories[0]
+        if isinstance(first, Trajectory):
+            return cls(positions, first.period, first.source, cls._concatenate_times(trajectories))
+        return cls(positions)
+
+    @staticmethod
+    def _concatenate_times(trajectories):
+        # timestamps are kept if any trajectory has them, each part starts one period after the end of the previous one
+        if not any(isinstance(trajectory, Trajectory) and trajectory.times is not None for trajectory in trajectories):
+            return None
+        blocks = []
+        start = 0.0
+        for trajectory in trajectories:
+            if not isinstance(trajectory, Trajectory) or (trajectory.times is None and trajectory.period is None):
+                return None
+            times = trajectory.frame_times()
+            if len(times) == 0:
+                continue
+            blocks.append(times - times[0] + start)
+            gap = trajectory.period if trajectory.period is not None else np.diff(times[-2:]).sum()
+            start = blocks[-1][-1] + gap
+        return np.concatenate(blocks) if blocks else None
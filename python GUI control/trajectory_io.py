@@ -0,0 +1,318 @@
+#%%
+'''
+This module reads and writes trajectory files (lists of servo positions) without `eval`.
+Two formats are supported:
+
+    1. Text (.txt, original format):
+    A list of lists with 6 integer servo angles each, e.g. [[90, 60, 110, 90, 90, 90], [90, 60, 110, 117, 90, 90]]
+    The file is parsed in chunks by a strict parser, anything else than integers, brackets, commas and whitespace
+    (e.g. python code) is rejected.
+
+    2. Binary (.traj):
+    A 16 byte header followed by the (N, 6) servo angles as a C-ordered array.
+    header: magic b'LATR', version (uint8), dtype code (uint8, 1: uint8, 2: int16), columns (uint16), frames (uint32),
+            flags (uint8, bit 0: timestamps, bit 1: hold counts), 3 reserved bytes
+    If the timestamps flag is set, the angles are followed by N float64 timestamps (s), the time each frame is sent.
+    If the hold counts flag is set instead, the angles are followed by the hold period (float64, s) and N uint16 counts,
+    the number of periods each frame is held (run-length encoded repeated frames, see `Trajectory.collapse_holds`).
+    The angles are memory-mapped when loading, so large recordings load instantly.
+    The text format has no timestamps, they are only kept in the binary format.
+
+Converting the existing txt files to the binary format:
+    python trajectory_io.py convert heart tulip
+'''
+#%%
+import os
+import re
+import struct
+
+import numpy as np
+
+#######################################
+# format constants
+#######################################
+magic = b'LATR'
+version = 1
+header_format = '<4sBBHIB3x'
+flag_times = 0x01
+flag_holds = 0x02
+times_dtype = np.dtype('<f8')
+holds_dtype = np.dtype('<u2')
+header_size = struct.calcsize(header_format)
+dtype_codes = {1: np.dtype(np.uint8), 2: np.dtype('<i2')}
+
+binary_extension = '.traj'
+text_extension = '.txt'
+
+# number of servos per frame
+n_servos = 6
+
+# one frame, e.g. '[90, 60, 110, 90, 90, 90]'
+_frame = rb'\s*\[\s*-?\d+(?:\s*,\s*-?\d+){5}\s*\]'
+# complete frames, each followed by a comma
+_frames_pattern = re.compile(rb'(?:' + _frame + rb'\s*,)*')
+# end of the list: optionally the last frame without comma, then the closing bracket
+_end_pattern = re.compile(rb'(' + _frame + rb')?\s*\]\s*')
+# longest unparsed text allowed while reading, a frame is much shorter than this
+_max_pending = 1024
+_separators = bytes.maketrans(b'[],', b'   ')
+
+#######################################
+# text format
+#######################################
+def _parse_frames(text):
+    # the text has been validated, so only numbers and separators are left
+    values = np.fromstring(text.translate(_separators).decode('ascii'), sep=' ', dtype=np.int64)
+    return values.reshape(-1, n_servos)
+
+def iter_text(filename, chunk_size=1 << 16):
+    '''
+    Reads a text trajectory file in chunks.
+        Parameters:
+                filename (str): the txt file to be read
+                chunk_size (int): number of bytes read at once
+
+        Returns:
+                generator of (k, 6) int64 arrays, the frames parsed from each chunk
+    '''
+    with open(filename, 'rb') as file:
+        buffer = file.read(chunk_size).lstrip()
+        offset = 0
+        if not buffer.startswith(b'['):
+            raise ValueError(f'{filename}: not a trajectory file, expected "[" at the start')
+        buffer = buffer[1:]
+        offset += 1
+
+        while True:
+            chunk = file.read(chunk_size)
+            buffer += chunk
+
+            # parse all the complete frames followed by a comma
+            end = _frames_pattern.match(buffer).end()
+            if end > 0:
+                yield _parse_frames(buffer[:end])
+                buffer = buffer[end:]
+                offset += end
+
+            if not chunk:
+                break
+            # stop early instead of reading the whole file if the text is not a frame
+            if len(buffer) > _max_pending:
+                raise ValueError(f'{filename}: invalid trajectory text near byte {offset}: {buffer[:40]!r}')
+
+        # the rest has to be the last frame and the closing bracket
+        end = _end_pattern.fullmatch(buffer)
+        if end is None:
+            raise ValueError(f'{filename}: invalid trajectory text near byte {offset}: {buffer[:40]!r}')
+        if end.group(1) is not None:
+            yield _parse_frames(end.group(1))
+
+def read_text(filename):
+    '''
+    Reads a text trajectory file.
+        Returns:
+                positions (array): (N, 6) int16 array of servo angles
+    '''
+    blocks = list(iter_text(filename))
+    if len(blocks) == 0:
+        return np.zeros((0, n_servos), dtype=np.int16)
+    return np.concatenate(blocks).astype(np.int16)
+
+def format_text(positions):
+    '''
+    Formats the positions the same way as `str(list)`, e.g. '[[90, 60, 110, 90, 90, 90], ...]'.
+    '''
+    rows = ('[' + ', '.join(str(int(angle)) for angle in position) + ']' for position in positions)
+    return '[' + ', '.join(rows) + ']'
+
+def write_text(filename, positions):
+    with open(filename, 'w') as f:
+        f.write(format_text(positions))
+
+#######################################
+# binary format
+#######################################
+def read_header(filename):
+    '''
+    Reads and checks the header of a binary trajectory file.
+        Returns:
+                dtype (dtype): dtype of the servo angles
+                columns (int): number of servos
+                frames (int): number of frames
+                flags (int): format flags, `flag_times` or `flag_holds`
+    '''
+    with open(filename, 'rb') as file:
+        header = file.read(header_size)
+    if len(header) != header_size or header[:4] != magic:
+        raise ValueError(f'{filename}: not a binary trajectory file')
+    _, file_version, dtype_code, columns, frames, flags = struct.unpack(header_format, header)
+    if file_version != version or dtype_code not in dtype_codes:
+        raise ValueError(f'{filename}: unsupported trajectory file version {file_version}, dtype code {dtype_code}')
+
+    dtype = dtype_codes[dtype_code]
+    expected = header_size + frames * columns * dtype.itemsize
+    if flags & flag_times:
+        expected += frames * times_dtype.itemsize
+    elif flags & flag_holds:
+        expected += times_dtype.itemsize + frames * holds_dtype.itemsize
+    if os.path.getsize(filename) != expected:
+        raise ValueError(f'{filename}: truncated trajectory file, expected {expected} bytes')
+    return dtype, columns, frames, flags
+
+def read_binary(filename, mmap=True):
+    '''
+    Reads a binary trajectory file.
+        Parameters:
+                filename (str): the .traj file to be read
+                mmap (bool): memory-map the file instead of reading it
+
+        Returns:
+                positions (array): (N, 6) uint8 or int16 array of servo angles (read-only if memory-mapped)
+    '''
+    dtype, columns, frames, flags = read_header(filename)
+    if frames == 0:
+        return np.zeros((0, columns), dtype=dtype)
+    if mmap:
+        return np.memmap(filename, dtype=dtype, mode='r', offset=header_size, shape=(frames, columns))
+    return np.fromfile(filename, dtype=dtype, count=frames * columns, offset=header_size).reshape(frames, columns)
+
+def read_binary_times(filename):
+    '''
+    Reads the timestamps of a binary trajectory file.
+        Returns:
+                times (array): (N,) time (s) each frame is sent, None if the file has no timestamps
+    '''
+    dtype, columns, frames, flags = read_header(filename)
+    offset = header_size + frames * columns * dtype.itemsize
+    if flags & flag_times:
+        return np.fromfile(filename, dtype=times_dtype, count=frames, offset=offset)
+    if flags & flag_holds:
+        period = np.fromfile(filename, dtype=times_dtype, count=1, offset=offset)[0]
+        counts = np.fromfile(filename, dtype=holds_dtype, count=frames, offset=offset + times_dtype.itemsize)
+        return np.concatenate([[0], np.cumsum(counts[:-1], dtype=np.int64)]) * period
+    return None
+
+def hold_counts(times, period):
+    '''
+    Number of periods each frame is held, if the timestamps start at 0 and are multiples of `period`.
+        Returns:
+                counts (array): (N,) uint16, the last frame is held one period, None if the timestamps do not fit
+    '''
+    if period is None or period <= 0 or len(times) == 0 or times[0] != 0:
+        return None
+    steps = np.asarray(times, dtype=float) / period
+    if not np.allclose(steps, np.rint(steps), rtol=0, atol=1e-6):
+        return None
+    counts = np.append(np.diff(np.rint(steps).astype(np.int64)), 1)
+    if counts.min() < 1 or counts.max() > np.iinfo(holds_dtype).max:
+        return None
+    return counts.astype(holds_dtype)
+
+def write_binary(filename, positions, times=None, period=None):
+    '''
+    Writes a binary trajectory file, as uint8 if all the angles are between 0 and 255, otherwise as int16.
+    The timestamps (s) of the frames are saved too if `times` is given, as hold counts (2 bytes per frame)
+    if they are multiples of `period`, otherwise as float64.
+    Raises ValueError if an angle is not a number or does not fit in int16, instead of wrapping it around.
+    '''
+    positions = np.asarray(positions).reshape(-1, n_servos)
+    if len(positions) == 0 or (positions.min() >= 0 and positions.max() <= 255):
+        dtype_code = 1
+    else:
+        dtype_code = 2
+        limits = np.iinfo(dtype_codes[dtype_code])
+        if not np.all(np.isfinite(positions)) or positions.min() < limits.min or positions.max() > limits.max:
+            raise ValueError(f'{filename}: angles have to be numbers between {limits.min} and {limits.max}, '
+                             f'got {positions.min()} to {positions.max()}')
+    data = np.ascontiguousarray(positions, dtype=dtype_codes[dtype_code])
+
+    flags = 0
+    counts = None
+    if times is not None:
+        times = np.ascontiguousarray(times, dtype=times_dtype)
+        if times.shape != (len(data),):
+            raise ValueError(f'expected {len(data)} timestamps, got {times.shape}')
+        counts = hold_counts(times, period)
+        flags |= flag_times if counts is None else flag_holds
+
+    with open(filename, 'wb') as f:
+        f.write(struct.pack(header_format, magic, version, dtype_code, n_servos, len(data), flags))
+        f.write(data.tobytes())
+        if counts is not None:
+            f.write(np.array([period], dtype=times_dtype).tobytes())
+            f.write(counts.tobytes())
+        elif times is not None:
+            f.write(times.tobytes())
+
+#######################################
+# any format
+#######################################
+def is_binary(filename):
+    with open(filename, 'rb') as file:
+        return file.read(4) == magic
+
+def load(filename):
+    '''
+    Reads a trajectory file in the text or binary format (detected from the file content).
+        Returns:
+                positions (array): (N, 6) array of servo angles
+    '''
+    if is_binary(filename):
+        return read_binary(filename)
+    return read_text(filename)
+
+def load_times(filename):
+    '''
+    Reads the timestamps of a trajectory file, None if it has no timestamps (e.g. a txt file).
+    '''
+    if is_binary(filename):
+        return read_binary_times(filename)
+    return None
+
+def save(filename, positions, times=None, period=None):
+    '''
+    Writes a trajectory file, in the binary format if the file name ends with .traj, otherwise as text.
+    The timestamps are only saved in the binary format (as hold counts if they are multiples of `period`).
+    '''
+    if filename.endswith(binary_extension):
+        write_binary(filename, positions, times, period)
+    else:
+        if times is not None:
+            print(f'Warning: timestamps are not saved in the text format, save as {binary_extension} to keep them.')
+        write_text(filename, positions)
+
+def convert_tree(directory):
+    '''
+    Converts all the txt trajectory files in `directory` (and its subdirectories) to the binary format.
+    The .traj files are saved next to the txt files.
+        Returns:
+                converted (list): the names of the .traj files written
+    '''
+    converted = []
+    for root, dirs, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.endswith(text_extension):
+                continue
+            filename = os.path.join(root, name)
+            try:
+                positions = read_text(filename)
+            except ValueError as error:
+                print(f'skipped: {error}')
+                continue
+            traj_filename = filename[:-len(text_extension)] + binary_extension
+            write_binary(traj_filename, positions)
+            converted.append(traj_filename)
+    return converted
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert txt trajectory files to the binary .traj format.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help='convert all txt files in the directories')
+    convert_parser.add_argument('directories', nargs='+')
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        for traj_filename in convert_tree(directory):
+            print('converted: ' + traj_filename)
@@ -0,0 +1,316 @@
+#%%
+'''
+This module uploads a whole trajectory to the ESP32, which plays it on its own loop timer (5 ms ticks),
+instead of sending every frame live from the host. Serial latency and host hiccups (GC, Tk redraw, other processes)
+then only delay the upload, not the frames played by the servos.
+
+Upload:
+    1. the ring buffer of the firmware is cleared (the status line shows whether the firmware supports uploads)
+    2. queue frames (see `serial_protocol.py`) are written in chunks, as long as there is free space in the buffer
+    3. playback starts once `prefill` frames are uploaded, the buffer is refilled while the firmware plays it
+    4. after the last frame, the firmware plays the rest of the buffer and reports that it is finished
+Flow control: after each chunk the host asks for the status line (free space, frames received and played),
+and only writes as many frames as there is free space. A queue frame is only accepted in order,
+so if a frame was lost (wrong CRC), the host resends from the first frame the firmware did not receive.
+
+The duration of each frame is the time to the next frame (timestamps of a retimed Trajectory, or `period`),
+rounded to firmware loops from the start of the trajectory, so rounding does not add up.
+    Parameters:
+            write (function): writes bytes to the serial port
+            read (function): returns the bytes received from the serial port, without waiting
+            period (float): time (s) between two frames at speed 1, if the positions have no timestamps
+            speed (float): replay speed, applied when the upload starts
+            on_frame (function): called with (index, position) for the frames played, optional
+            on_progress (function): called with the progress (dict) after every status line, optional
+            on_ready (function): called when the first frames are uploaded, just before the playback starts,
+                                 e.g. to wait for other arms (see `orchestrator.py`), optional
+            on_finish (function): called when the upload finished, was aborted or failed, before `wait` returns,
+                                  e.g. to restart the live frames with an absolute frame, optional
+            chunk_size (int): largest number of frames written at once, less than 256 so a seq is never ambiguous
+            prefill (int): number of frames uploaded before the playback starts
+            tick (float): time (s) of one firmware loop
+            poll_interval (float): time (s) between two status requests while the buffer is full
+            timeout (float): time (s) to wait for a status line
+            retries (int): number of times a control command is sent again without a status line
+            clock (function): monotonic clock in seconds
+            sleep (function): sleeps for a number of seconds
+            metrics (Instrumentation): records the status round trips, resent frames and underruns, optional
+
+    Controls (same as `ReplayEngine`):
+            start(positions, times=None), pause(), resume(), abort(), set_speed(speed), wait()
+
+    Usage:
+            uploader = Uploader(arduino.write, lambda: arduino.read(arduino.in_waiting))
+            uploader.run(Trajectory.load('heart/heart.traj', period=0.15))
+'''
+#%%
+import threading
+import time
+
+import numpy as np
+
+import serial_protocol
+
+#######################################
+# uploader
+#######################################
+class Uploader:
+    def __init__(self, write, read, period=0.15, speed=1.0, on_frame=None, on_progress=None, on_ready=None,
+                 on_finish=None, chunk_size=32, prefill=128, tick=0.005, poll_interval=0.05, timeout=0.5, retries=3,
+                 clock=time.monotonic, sleep=time.sleep, metrics=None):
+        self.write = write
+        self.read = read
+        self.period = period
+        self.speed = speed
+        self.on_frame = on_frame
+        self.on_progress = on_progress
+        self.on_ready = on_ready
+        self.on_finish = on_finish
+        self.chunk_size = chunk_size
+        self.prefill = prefill
+        self.tick = tick
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.clock = clock
+        self.sleep = sleep
+        self.metrics = metrics
+        if not 0 < chunk_size < 256:
+            raise ValueError(f'chunk_size has to be 1 ~ 255, got {chunk_size}')
+
+        self.thread = None
+        self.paused = False
+        self.aborted = False
+        self.finished = threading.Event()
+        self.finished.set()
+
+        self.received = b''
+        self.status = None
+        self.last_position = None
+        self.frames_total = 0
+        self.frames_resent = 0
+        self.status_requests = 0
+        self.bytes_written = 0
+        self.upload_time = 0.0
+        self.error = None
+
+    #######################################
+    # controls
+    #######################################
+    def start(self, positions, times=None):
+        # upload and play `positions` on a new thread
+        if self.running:
+            raise RuntimeError('a replay is already running')
+        self.frame_ticks(positions, times)
+        self.prepare(positions)
+        self.thread = threading.Thread(target=self.run, args=(positions, times), daemon=True)
+        self.thread.start()
+
+    @property
+    def running(self):
+        return not self.finished.is_set()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def abort(self):
+        self.aborted = True
+
+    def set_speed(self, speed):
+        # the durations are computed when the upload starts, so the speed applies to the next upload
+        if speed <= 0:
+            raise ValueError(f'speed has to be positive, got {speed}')
+        self.speed = speed
+
+    def wait(self, timeout=None):
+        return self.finished.wait(timeout)
+
+    #######################################
+    # frames
+    #######################################
+    def frame_ticks(self, positions, times=None):
+        '''
+        Number of firmware loops each frame is played.
+            Returns:
+                    ticks (array): (N,) int, at least 1
+        '''
+        if times is None:
+            times = getattr(positions, 'times', None)
+        if times is None:
+            times = np.arange(len(positions)) * float(self.period)
+        times = np.asarray(times, dtype=float)
+        if len(times) != len(positions):
+            raise ValueError(f'expected {len(positions)} timestamps, got {len(times)}')
+        if len(times) == 0:
+            return np.zeros(0, dtype=int)
+        # round the time of each frame, not each duration, so the rounding errors do not add up
+        edges = np.rint((times - times[0]) / self.speed / self.tick).astype(int)
+        ticks = np.maximum(np.append(np.diff(edges), 1), 1)
+        if ticks.max() > 0xFFFF:
+            raise ValueError(f'a frame lasts more than {0xFFFF * self.tick:.0f} s, split it into several frames')
+        return ticks
+
+    #######################################
+    # communication
+    #######################################
+    def send(self, data):
+        self.write(data)
+        self.bytes_written += len(data)
+
+    def command(self, command):
+        # send a control command and wait for its status line, the command is sent again if it was lost
+        for attempt in range(self.retries + 1):
+            start = self.clock()
+            self.send(serial_protocol.encode_control(command))
+            self.status_requests += 1
+            status = self.read_status()
+            if status is not None:
+                if self.metrics is not None:
+                    self.metrics.record('upload_status_round_trip', self.clock() - start)
+                return status
+            if self.metrics is not None:
+                self.metrics.count('upload_status_timeouts')
+        raise RuntimeError('no status from the firmware, it may not support uploads (see robotic_arm_ESP32.ino)')
+
+    def read_status(self):
+        # the next status line, None after `timeout`
+        deadline = self.clock() + self.timeout
+        while True:
+            self.received += self.read()
+            while b'\n' in self.received:
+                line, self.received = self.received.split(b'\n', 1)
+                status = serial_protocol.parse_status(line)
+                if status is not None:
+                    self.status = status
+                    return status
+            if self.clock() >= deadline:
+                return None
+            self.sleep(0.005)
+
+    #######################################
+    # upload loop
+    #######################################
+    def prepare(self, positions):
+        self.finished.clear()
+        self.paused = False
+        self.aborted = False
+        self.status = None
+        self.last_position = None
+        self.frames_total = len(positions)
+        self.frames_resent = 0
+        self.status_requests = 0
+        self.bytes_written = 0
+        self.upload_time = 0.0
+        self.error = None
+
+    def run(self, positions, times=None):
+        # upload and play `positions` on the calling thread, returns when the firmware finished playing or aborted
+        if not self.running:
+            self.prepare(positions)
+        try:
+            ticks = self.frame_ticks(positions, times)
+            frames = [serial_protocol.encode_queue(position, ticks[index], index)
+                      for index, position in enumerate(positions)]
+            self.upload(positions, frames)
+        except Exception as error:
+            # kept for the caller of `start`, e.g. the firmware stopped answering
+            self.error = error
+            raise
+        finally:
+            if self.on_finish is not None:
+                self.on_finish()
+            self.finished.set()
+
+    def upload(self, positions, frames):
+        start = self.clock()
+        self.received = b''
+        status = self.command(serial_protocol.QUEUE_CLEAR)
+        total = len(frames)
+        # the buffer is empty after the clear, a larger prefill would never start the playback
+        prefill = min(self.prefill, total, status['free'])
+        sent = 0
+        played = 0
+        started = False
+        ended = False
+        device_paused = False
+
+        while True:
+            if self.aborted:
+                self.command(serial_protocol.QUEUE_CLEAR)
+                break
+            if started and self.paused != device_paused:
+                device_paused = self.paused
+                self.command(serial_protocol.QUEUE_PAUSE if device_paused else serial_protocol.QUEUE_RESUME)
+
+            # write as many frames as there is free space, minus the frames not yet received
+            free = status['free'] - (sent - status['received'])
+            count = max(0, min(free, self.chunk_size, total - sent))
+            if count > 0:
+                self.send(b''.join(frames[sent:sent + count]))
+                sent += count
+                if self.metrics is not None:
+                    self.metrics.count('upload_frames', count)
+            if not started and sent >= prefill:
+                if self.on_ready is not None:
+                    self.on_ready()
+                self.command(serial_protocol.QUEUE_START)
+                started = True
+            if started and not ended and sent == total:
+                self.command(serial_protocol.QUEUE_END)
+                ended = True
+
+            written = sent
+            status = self.command(serial_protocol.QUEUE_STATUS)
+            if status['received'] < written:
+                # frames were lost, resend from the first frame the firmware did not receive
+                self.frames_resent += written - status['received']
+                if self.metrics is not None:
+                    self.metrics.count('upload_frames_resent', written - status['received'])
+                sent = status['received']
+                ended = False
+
+            # report the frames played since the last status line
+            while played < min(status['played'], total):
+                self.last_position = positions[played]
+                if self.on_frame is not None:
+                    self.on_frame(played, positions[played])
+                played += 1
+            if self.upload_time == 0.0 and status['received'] == total:
+                self.upload_time = self.clock() - start
+            if self.on_progress is not None:
+                self.on_progress(self.progress())
+
+            if status['state'] == serial_protocol.STATE_FINISHED:
+                if self.metrics is not None:
+                    self.metrics.count('upload_underruns', status['underruns'])
+                break
+            if count < self.chunk_size or sent == total:
+                # the buffer is full or everything is uploaded, wait for the firmware to play some frames
+                self.sleep(self.poll_interval)
+
+    #######################################
+    # statistics
+    #######################################
+    def progress(self):
+        status = self.status or {'state': serial_protocol.STATE_IDLE, 'received': 0, 'played': 0, 'underruns': 0}
+        return {'frames_total': self.frames_total,
+                'frames_uploaded': min(status['received'], self.frames_total),
+                'frames_played': min(status['played'], self.frames_total),
+                'underruns': status['underruns'],
+                'state': status['state']}
+
+    def stats(self):
+        stats = self.progress()
+        stats.update({'frames_sent': stats['frames_played'],
+                      'frames_resent': self.frames_resent,
+                      'status_requests': self.status_requests,
+                      'bytes_written': self.bytes_written,
+                      'upload_time': self.upload_time})
+        return stats
+
+def print_progress(progress):
+    print(f"uploaded {progress['frames_uploaded']}/{progress['frames_total']}, "
+          f"played {progress['frames_played']}/{progress['frames_total']}, underruns {progress['underruns']}")
@@ -0,0 +1,257 @@
+#%%
+'''
+This module precomputes the workspace of the first 3 joints on a voxel grid covering the range of the x,y,z sliders
+(x, y in [-25, 25] cm, z in [-8, 31] cm, 0.5 cm voxels by default), and saves it to disk.
+Many points of the slider range are out of reach of the 9.6 cm + 17.7 cm links or need angles outside the servo limits;
+the inverse kinematics then returns the closest pose pointing towards the target, which can be far from the target.
+With the grid, every lookup is O(1) (one index computation) and an unreachable target is clamped to the
+nearest reachable voxel, so only valid poses are sent to the arm.
+
+For every voxel (its centre), the grid stores:
+    reachable (bool): the centre can be reached within the servo limits
+    angles (uint8): servo 1-3 angles (degrees) of the solution closest to the middle of the servo ranges,
+                    for an unreachable voxel the angles of the nearest reachable voxel (the clamped pose)
+    nearest (int32): index of the nearest reachable voxel (the voxel itself if it is reachable)
+    margin (uint8): distance (degrees) of the solution to the closest servo limit, 0 if unreachable
+
+The stored angles are used as seeds of the inverse kinematics when no current position is given,
+so the same branch (the one furthest from the limits) is picked for nearby targets.
+The grid is built once (a few seconds with 0.5 cm voxels, `python workspace.py build`) and saved as a .npz file with
+the geometry it was built for; rebuild it if the geometry or the servo limits in `kinematics.py` change.
+`ArmController` only loads the grid (in the background), it never builds it while the arm is jogged.
+    Parameters:
+            resolution (float): voxel size (cm)
+            bounds (list): (3, 2) min/max x,y,z coordinates (cm)
+
+    Usage:
+            grid = ReachabilityGrid.load_or_build()
+            grid.reachable([[0, -20, 10]])                  # O(1) lookup
+            angles, reachable = grid.solve([[0, -30, 10]], seed=[90, 60, 110])
+
+Command line:
+    python workspace.py build                            # saves workspace_grid.npz next to this file
+    python workspace.py query 0 -30 10
+'''
+#%%
+import itertools
+import os
+
+import numpy as np
+
+import kinematics
+
+default_bounds = ((-25., 25.), (-25., 25.), (-8., 31.))
+default_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workspace_grid.npz')
+
+#######################################
+# reachability grid
+#######################################
+class ReachabilityGrid:
+    def __init__(self, reachable, angles, nearest, margin, resolution=0.5, bounds=default_bounds):
+        self.resolution = float(resolution)
+        self.bounds = np.array(bounds, dtype=float)
+        self.shape = reachable.shape
+        self.reachable_voxels = reachable.reshape(-1)
+        self.angles = angles.reshape(-1, 3)
+        self.nearest = nearest.reshape(-1)
+        self.margin_voxels = margin.reshape(-1)
+
+    @staticmethod
+    def grid_shape(resolution, bounds):
+        bounds = np.array(bounds, dtype=float)
+        return tuple(int(round((high - low) / resolution)) + 1 for low, high in bounds)
+
+    @staticmethod
+    def geometry(resolution, bounds):
+        # everything the grid depends on, saved with it to detect a stale file
+        return np.concatenate([[resolution], np.ravel(bounds), [kinematics.base_height, kinematics.link2_length,
+                                                                kinematics.link3_length], np.ravel(kinematics.servo_limits)])
+
+    #######################################
+    # build
+    #######################################
+    @classmethod
+    def build(cls, resolution=0.5, bounds=default_bounds):
+        shape = cls.grid_shape(resolution, bounds)
+        low = np.array(bounds, dtype=float)[:, 0]
+        voxels = np.indices(shape).reshape(3, -1).T
+        centres = low + voxels * resolution
+
+        # solution closest to the middle of the servo ranges, the furthest from the limits
+        limits = kinematics.servo_limits
+        angles, reachable = kinematics.inverse_kinematics_batch(centres, seed=limits.mean(axis=1))
+        margin = np.minimum(angles - limits[:, 0], limits[:, 1] - angles).min(axis=1)
+        margin = np.where(reachable, np.floor(np.clip(margin, 0, 255)), 0).astype(np.uint8)
+
+        nearest = cls.nearest_reachable(reachable.reshape(shape))
+        angles = np.rint(angles[nearest]).astype(np.uint8)
+        return cls(reachable.reshape(shape), angles, nearest, margin, resolution, bounds)
+
+    @staticmethod
+    def nearest_reachable(reachable):
+        '''
+        Index of the nearest reachable voxel of every voxel, with the jump flooding algorithm:
+        every pass looks at the nearest voxels found by the 26 neighbours `step` voxels away, halving `step`,
+        plus a last pass with step 1 to fix the few voxels jump flooding gets wrong.
+        '''
+        shape = reachable.shape
+        voxels = np.indices(shape, dtype=np.int32)
+        nearest = np.where(reachable, np.arange(reachable.size, dtype=np.int32).reshape(shape), -1)
+        # voxel coordinates of `nearest`, kept alongside to avoid unravelling the indices in every pass
+        nearest_voxels = np.where(reachable, voxels, 0)
+        distance = np.where(reachable, 0, np.iinfo(np.int32).max).astype(np.int32)
+
+        steps = [2 ** k for k in range(int(np.ceil(np.log2(max(shape)))) - 1, -1, -1)] + [1]
+        for step in steps:
+            for offset in itertools.product((-step, 0, step), repeat=3):
+                if offset == (0, 0, 0):
+                    continue
+                # voxels [target] look at the nearest voxels found by [source] = [target + offset]
+                target = tuple(slice(max(0, -o), n - max(0, o)) for o, n in zip(offset, shape))
+                source = tuple(slice(max(0, o), n - max(0, -o)) for o, n in zip(offset, shape))
+                candidate = nearest[source]
+                candidate_voxels = nearest_voxels[(slice(None),) + source]
+                candidate_distance = ((voxels[(slice(None),) + target] - candidate_voxels) ** 2).sum(axis=0)
+                better = (candidate >= 0) & (candidate_distance < distance[target])
+                nearest[target][better] = candidate[better]
+                nearest_voxels[(slice(None),) + target][:, better] = candidate_voxels[:, better]
+                distance[target][better] = candidate_distance[better]
+        return nearest.reshape(-1)
+
+    #######################################
+    # save and load
+    #######################################
+    def save(self, filename=default_filename):
+        # write to a temporary file first, so an interrupted save does not leave a broken grid
+        temporary_path = filename + '.tmp.npz'
+        np.savez_compressed(temporary_path, reachable=self.reachable_voxels.reshape(self.shape),
+                            angles=self.angles, nearest=self.nearest, margin=self.margin_voxels,
+                            geometry=self.geometry(self.resolution, self.bounds))
+        os.replace(temporary_path, filename)
+
+    @classmethod
+    def load(cls, filename=default_filename):
+        with np.load(filename) as data:
+            geometry = data['geometry']
+            resolution, bounds = geometry[0], geometry[1:7].reshape(3, 2)
+            if not np.array_equal(geometry, cls.geometry(resolution, bounds)):
+                raise ValueError(f'{filename} was built for another geometry or other servo limits')
+            return cls(data['reachable'], data['angles'], data['nearest'], data['margin'], resolution, bounds)
+
+    @classmethod
+    def load_or_build(cls, filename=default_filename, resolution=0.5, bounds=default_bounds):
+        # loads the grid, or builds and saves it if the file is missing or stale
+        try:
+            grid = cls.load(filename)
+            if grid.resolution == resolution and np.array_equal(grid.bounds, np.array(bounds, dtype=float)):
+                return grid
+        except (OSError, ValueError, KeyError):
+            pass
+        print(f'building the workspace grid: {filename}')
+        grid = cls.build(resolution, bounds)
+        try:
+            grid.save(filename)
+        except OSError as error:
+            print(f'Warning: the workspace grid could not be saved ({error}), it is rebuilt next time.')
+        return grid
+
+    #######################################
+    # lookups, all O(1) per coordinate
+    #######################################
+    def index(self, coordinates):
+        '''
+        Voxels of N coordinates.
+            Returns:
+                    index (array): (N,) flat index of the closest voxel (coordinates outside the grid are clipped)
+                    inside (array): (N,) True if the coordinate is within the bounds of the grid
+        '''
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+        voxels = np.rint((coordinates - self.bounds[:, 0]) / self.resolution).astype(int)
+        inside = np.all((coordinates >= self.bounds[:, 0]) & (coordinates <= self.bounds[:, 1]), axis=1)
+        voxels = np.clip(voxels, 0, np.array(self.shape) - 1)
+        return np.ravel_multi_index(voxels.T, self.shape), inside
+
+    def centres(self, index):
+        # coordinates (cm) of the voxel centres
+        return self.bounds[:, 0] + np.column_stack(np.unravel_index(index, self.shape)) * self.resolution
+
+    def reachable(self, coordinates):
+        index, inside = self.index(coordinates)
+        return self.reachable_voxels[index] & inside
+
+    def margin(self, coordinates):
+        index, inside = self.index(coordinates)
+        return np.where(inside, self.margin_voxels[index], 0)
+
+    def seed(self, coordinates):
+        # (N, 3) servo 1-3 angles to start the inverse kinematics from
+        index, _ = self.index(coordinates)
+        return self.angles[index].astype(float)
+
+    def clamp(self, coordinates):
+        # the unreachable coordinates are moved to the centre of the nearest reachable voxel
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+        index, inside = self.index(coordinates)
+        reachable = self.reachable_voxels[index] & inside
+        return np.where(reachable[:, None], coordinates, self.centres(self.nearest[index]))
+
+    def solve(self, coordinates, seed=None):
+        '''
+        Inverse kinematics of N coordinates that only returns valid poses.
+        Reachable coordinates are solved exactly (closed form, see `kinematics.inverse_kinematics_batch`),
+        unreachable coordinates get the pose of the nearest reachable voxel.
+            Parameters:
+                    coordinates (array): (N, 3) or (3,) x,y,z coordinates (cm)
+                    seed (array): (3,) or (N, 3) current servo 1-3 angles, defaults to the angles stored in the grid
+
+            Returns:
+                    servo_3angles (array): (N, 3) servo 1-3 angles (degrees)
+                    reachable (array): (N,) True if the coordinate itself is reachable
+        '''
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+        index, _ = self.index(coordinates)
+        seed = self.angles[index].astype(float) if seed is None else seed
+        servo_3angles, reachable = kinematics.inverse_kinematics_batch(coordinates, seed=seed)
+        if not reachable.all():
+            clamped = self.centres(self.nearest[index[~reachable]])
+            clamped_seed = seed if np.ndim(seed) == 1 else np.asarray(seed)[~reachable]
+            clamped_angles, clamped_reachable = kinematics.inverse_kinematics_batch(clamped, seed=clamped_seed)
+            # the stored pose if the voxel centre is not reachable either (no reachable voxel in the grid)
+            clamped_angles[~clamped_reachable] = self.angles[self.nearest[index[~reachable]]][~clamped_reachable]
+            servo_3angles[~reachable] = clamped_angles
+        return servo_3angles, reachable
+
+    def stats(self):
+        return {'voxels': int(self.reachable_voxels.size),
+                'reachable': int(np.count_nonzero(self.reachable_voxels)),
+                'resolution': self.resolution,
+                'shape': list(self.shape)}
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Build or query the reachability grid of the workspace.')
+    parser.add_argument('--file', default=default_filename, help='.npz file of the grid')
+    parser.add_argument('--resolution', type=float, default=0.5, help='voxel size (cm)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('build', help='build the grid and save it')
+    query_parser = subparsers.add_parser('query', help='look up a coordinate')
+    query_parser.add_argument('coordinates', type=float, nargs=3, metavar='XYZ')
+    query_parser.add_argument('--seed', type=float, nargs=3, help='current servo 1-3 angles')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        grid = ReachabilityGrid.build(args.resolution)
+        grid.save(args.file)
+        stats = grid.stats()
+        print(f"{stats['reachable']} of {stats['voxels']} voxels reachable, built in {time.perf_counter() - start:.1f} s")
+        print('saved: ' + args.file)
+    else:
+        grid = ReachabilityGrid.load_or_build(args.file, args.resolution)
+        servo_3angles, reachable = grid.solve(args.coordinates, seed=args.seed)
+        print(f'reachable: {bool(reachable[0])}, joint-limit margin: {grid.margin(args.coordinates)[0]} degrees')
+        if not reachable[0]:
+            print(f'clamped to: {grid.clamp(args.coordinates)[0].tolist()}')
+        print(f'servo 1-3 angles: {np.round(servo_3angles[0]).tolist()}')